@@ -0,0 +1,152 @@
+import ctypes
+import ctypes.util
+import gc
+import math
+import re
+import torch
+import distributed
+
+"""
+Batch size of the training scripts from a memory budget. find_batch_size
+runs one forward and backward pass of real training batches of growing
+size (doubled until a batch does not fit, then bisected) and keeps the
+largest one whose peak memory, plus the Adam state the first optimizer
+step adds, stays within the budget. On CPU the peak is the peak resident
+memory of the process (VmHWM, reset before each probe), so the budget
+covers everything the process holds; on GPU it is the peak of the CUDA
+allocator. Probes do not change the weights or the random state.
+
+The training loops then reach the wanted effective batch with gradient
+accumulation:
+
+    size = find_batch_size(model, make_inputs, parse_memory_size("6GB"), max_batch_size=32)
+    batch_size, accumulation_steps = accumulation_for(32, size)
+
+"""
+
+UNITS = {"": 1, "b": 1, "k": 1000, "kb": 1000, "m": 1000**2, "mb": 1000**2, "g": 1000**3, "gb": 1000**3,
+         "kib": 1024, "mib": 1024**2, "gib": 1024**3}
+
+
+def parse_memory_size(text):
+    # "6GB", "6 GiB", "512MiB" or a number of bytes
+    match = re.fullmatch(r"\s*([0-9]*\.?[0-9]+)\s*([a-zA-Z]*)\s*", str(text))
+    if match is None or match.group(2).lower() not in UNITS:
+        raise ValueError(f"Bad memory size {text}, expected e.g. 6GB, 512MiB or a number of bytes")
+    return int(float(match.group(1)) * UNITS[match.group(2).lower()])
+
+def format_bytes(size):
+    return f"{size / 1024**3:.2f} GiB"
+
+def _release_freed_memory():
+    # glibc keeps freed blocks in the process, give them back so the resident size drops
+    gc.collect()
+    libc_name = ctypes.util.find_library("c")
+    if libc_name:
+        libc = ctypes.CDLL(libc_name)
+        if hasattr(libc, "malloc_trim"):
+            libc.malloc_trim(0)
+
+def reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    _release_freed_memory()
+    try:
+        # Resets the peak resident size (VmHWM) to the current one
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError as e:
+        raise RuntimeError("Measuring the peak memory on CPU needs Linux /proc/self/clear_refs") from e
+
+def peak_memory(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("No VmHWM in /proc/self/status")
+
+def optimizer_state_bytes(model):
+    # Adam keeps two moments per trainable parameter
+    return 2 * sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+
+def measure_step(model, inputs):
+    # Peak memory of one training forward and backward of the model inputs `inputs`
+    device = next(model.parameters()).device
+    model.train()
+    model.zero_grad(set_to_none=True)
+    reset_peak_memory(device)
+    with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+        outputs = model(**inputs)
+        loss = sum(output.float().sum() for output in outputs if output is not None)
+        loss.backward()
+    del outputs, loss
+    peak = peak_memory(device)
+    model.zero_grad(set_to_none=True)
+    return peak + optimizer_state_bytes(model)
+
+def is_out_of_memory(error):
+    # CUDA raises OutOfMemoryError ("CUDA out of memory"), the CPU allocator a RuntimeError
+    # "DefaultCPUAllocator: not enough memory"
+    if isinstance(error, getattr(torch, "OutOfMemoryError", ())):
+        return True
+    message = str(error).lower()
+    return "out of memory" in message or "not enough memory" in message
+
+def release_probe(model):
+    # Frees what a step that ran out of memory left behind before the next, smaller one
+    device = next(model.parameters()).device
+    model.zero_grad(set_to_none=True)
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+    else:
+        _release_freed_memory()
+
+def find_batch_size(model, make_inputs, budget, max_batch_size=1024):
+    # Largest batch size up to max_batch_size whose step fits `budget` bytes, `make_inputs(size)`
+    # returns the model inputs of a training batch of that size. Ranks agree on the smallest.
+    def fits(size):
+        try:
+            peak = measure_step(model, make_inputs(size))
+        except RuntimeError as e:
+            if not is_out_of_memory(e):
+                raise
+            peak = math.inf
+        if peak == math.inf:
+            # Out of the except block, so the traceback no longer holds the step's tensors
+            release_probe(model)
+            print(f"Batch size {size}: out of memory")
+        else:
+            print(f"Batch size {size}: peak memory {format_bytes(peak)} of {format_bytes(budget)}")
+        return peak <= budget
+
+    if not fits(1):
+        raise ValueError(f"A batch of 1 does not fit in the memory budget of {format_bytes(budget)}")
+    low, high = 1, None
+    while high is None and low < max_batch_size:
+        size = min(low * 2, max_batch_size)
+        if fits(size):
+            low = size
+        else:
+            high = size
+    while high is not None and high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+
+    world_size = distributed.get_world_size()
+    if world_size > 1:
+        sizes = distributed.all_reduce_sum([low if rank == distributed.get_rank() else 0 for rank in range(world_size)])
+        low = int(min(sizes))
+    return low
+
+def accumulation_for(effective_batch_size, batch_size):
+    # (batch size, accumulation steps) reaching effective_batch_size with batches
+    # of at most batch_size; the batch is evened out so the effective batch overshoots the least
+    steps = max(math.ceil(effective_batch_size / batch_size), 1)
+    return math.ceil(effective_batch_size / steps), steps
@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import runtime
+
+"""
+Benchmark suite for the data, training and inference paths. It runs offline
+on CPU: tweets are synthetic with the word counts of the competition data,
+the tokenizer is a byte-level BPE trained on them and the model is a
+NetMultiTask with a tiny randomly initialised RoBERTa encoder. It measures
+
+    tokenize_<dataset>_per_s    items/s of DataCombined, DisasterData, SentimentData
+    train_steps_per_s           train_hydra optimizer steps/s (tokenization included)
+    valid_examples_per_s        valid_hydra examples/s
+    checkpoint_load_ms          HydraPredictor start-up
+    inference_p50/p90/p99_ms    single tweet latency of HydraPredictor
+    inference_batch_per_s       tweets/s of HydraPredictor in batches
+
+Every metric is the best of --repeats runs, to damp noise from the host.
+Results are printed and written as JSON with --output. With --baseline
+(default benchmarks/baseline.json when it exists) every metric is compared
+against the stored run, and --fail-on-regression exits with 1 when one got
+worse by more than --tolerance. Timings depend on the host, so record the
+baseline on the machine the comparisons run on.
+
+--check-resume only trains HydraTrainer twice, straight through and from
+a mid-epoch training checkpoint, and exits with 1 unless the two models
+are identical.
+
+    python src/bench.py --output bench.json
+    python src/bench.py --output benchmarks/baseline.json --no-baseline
+
+"""
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks", "baseline.json")
+
+WORDS = ["the", "a", "to", "in", "of", "and", "is", "for", "on", "my", "you", "it", "at", "this", "just",
+         "fire", "flood", "storm", "earthquake", "emergency", "evacuation", "police", "killed", "crash",
+         "burning", "wildfire", "disaster", "news", "people", "california", "video", "love", "day", "new",
+         "like", "lol", "time", "today", "body", "bags", "accident", "bomb", "hurricane", "rescue", "damage",
+         "army", "collapse", "suicide", "train", "tornado", "lightning", "sirens", "water", "home", "world"]
+
+
+def synthetic_tweets(count, seed=2023):
+    rng = np.random.default_rng(seed)
+    # Word counts of the competition tweets: about 15 on average, at most 31
+    lengths = np.clip(rng.normal(15, 6, count).round(), 1, 31).astype(int)
+    tweets = []
+    for length in lengths:
+        words = list(rng.choice(WORDS, length))
+        if rng.random() < 0.2:
+            words.insert(0, f"@user{rng.integers(1000)}")
+        if rng.random() < 0.3:
+            words.append(f"#{rng.choice(WORDS)}")
+        if rng.random() < 0.5:
+            words.append("http://t.co/" + "".join(rng.choice(list("abcdefghijkmnopqrstuvwxyz0123456789"), 10)))
+        tweets.append(" ".join(words))
+    return tweets
+
+def offline_tokenizer(texts, path, vocab_size):
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(texts, vocab_size=vocab_size, show_progress=False,
+                            special_tokens=["<s>", "<pad>", "</s>", "<unk>", "<mask>"])
+    bpe.save_model(path)
+    return RobertaTokenizer(os.path.join(path, "vocab.json"), os.path.join(path, "merges.txt"))
+
+def synthetic_frame(texts, seed=2023):
+    # Half disaster rows, half sentiment rows, the other task's label is NaN
+    rng = np.random.default_rng(seed)
+    half = len(texts) // 2
+    target = np.full(len(texts), np.nan)
+    sentiment = np.full(len(texts), np.nan)
+    target[:half] = rng.integers(0, 2, half)
+    sentiment[half:] = rng.integers(0, 3, len(texts) - half)
+    return pd.DataFrame({"text": texts, "target": target, "sentiment": sentiment})
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else 0.0
+
+def bench_tokenization(frame, tokenizer, max_len):
+    disaster = frame[frame.target.notna()].reset_index(drop=True)
+    sentiment = frame[frame.sentiment.notna()].drop(columns="target").rename(columns={"sentiment": "target"})
+    datasets = {"datacombined": DataCombined(frame, tokenizer, max_len),
+                "disasterdata": DisasterData(disaster, tokenizer, max_len),
+                "sentimentdata": SentimentData(sentiment.reset_index(drop=True), tokenizer, max_len)}
+    results = {}
+    for name, dataset in datasets.items():
+        start = time.perf_counter()
+        for index in range(len(dataset)):
+            dataset[index]
+        results[f"tokenize_{name}_per_s"] = rate(len(dataset), time.perf_counter() - start)
+    return results
+
+def bench_training(model, frame, tokenizer, max_len, batch_size, steps):
+    optimizer = torch.optim.Adam(params = model.parameters(), lr = 1e-05)
+    empty = DataLoader(DataCombined(frame.iloc[:0], tokenizer, max_len), batch_size=batch_size)
+    train_set = DataCombined(frame.iloc[:batch_size * steps].reset_index(drop=True), tokenizer, max_len)
+    warm_up = DataCombined(frame.iloc[:batch_size * 2].reset_index(drop=True), tokenizer, max_len)
+    train_hydra(model, optimizer, 0, DataLoader(warm_up, batch_size=batch_size, shuffle=True), empty,
+                lambda1 = 0.5, lambda2 = 0.5, log = lambda metrics: None)
+
+    loader = DataLoader(train_set, batch_size=batch_size, shuffle=True)
+    start = time.perf_counter()
+    train_hydra(model, optimizer, 0, loader, empty, lambda1 = 0.5, lambda2 = 0.5, log = lambda metrics: None)
+    return {"train_steps_per_s": rate(len(loader), time.perf_counter() - start)}
+
+def bench_validation(model, frame, tokenizer, max_len, batch_size):
+    loader = DataLoader(DataCombined(frame, tokenizer, max_len), batch_size=batch_size, shuffle=False)
+    start = time.perf_counter()
+    valid_hydra(model, loader)
+    return {"valid_examples_per_s": rate(len(frame), time.perf_counter() - start)}
+
+def bench_inference(model, tokenizer, texts, max_len, batch_size, path):
+    save_checkpoint(model, path, tokenizer=tokenizer, max_len=max_len)
+    start = time.perf_counter()
+    predictor = HydraPredictor(path)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    predictor.predict(texts[:batch_size])
+    latencies = []
+    for text in texts:
+        start = time.perf_counter()
+        predictor.predict([text])
+        latencies.append((time.perf_counter() - start) * 1000)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+
+    start = time.perf_counter()
+    for index in range(0, len(texts), batch_size):
+        predictor.predict(texts[index:index + batch_size])
+    return {"checkpoint_load_ms": load_ms,
+            "inference_p50_ms": float(p50),
+            "inference_p90_ms": float(p90),
+            "inference_p99_ms": float(p99),
+            "inference_batch_per_s": rate(len(texts), time.perf_counter() - start)}
+
+def check_resume(frame, tokenizer, encoder_config, max_len, batch_size, path, steps=6, epochs=2):
+    # Trains HydraTrainer straight through with checkpoints, then again from the last mid-epoch
+    # checkpoint, returns the largest weight difference between the two models (0.0 expected)
+    train_set = DataCombined(frame.iloc[:batch_size * steps].reset_index(drop=True), tokenizer, max_len)
+    val_set = DataCombined(frame.iloc[:batch_size].reset_index(drop=True), tokenizer, max_len)
+    encoder = RobertaModel(RobertaConfig(**encoder_config))
+    # Checkpoints every steps - 1 batches, the last two are one mid-epoch and the end of training
+    config = HydraConfig(path, max_len=max_len, train_batch_size=batch_size, epochs=epochs,
+                         checkpoint_steps=steps - 1, wandb_project=None)
+    trainer = HydraTrainer(config, tokenizer=tokenizer, datasets=(train_set, val_set), encoder=encoder)
+    torch.manual_seed(2023)
+    straight = trainer.new_model()
+    trainer.train(straight, checkpoint_dir=path)
+
+    final = latest_training_checkpoint(path)
+    for filename in os.listdir(final):
+        os.remove(os.path.join(final, filename))
+    os.rmdir(final)
+    print(f"Resuming from {latest_training_checkpoint(path)}")
+    trainer = HydraTrainer(replace(config, resume=True), tokenizer=tokenizer, datasets=(train_set, val_set),
+                           encoder=encoder)
+    resumed = trainer.new_model()
+    trainer.train(resumed, checkpoint_dir=path)
+    return max((a - b).abs().max().item() for a, b in zip(straight.state_dict().values(),
+                                                          resumed.state_dict().values()))
+
+def best_of(runs):
+    # Lowest time / highest rate of each metric over the runs
+    return {name: (min if name.endswith("_ms") else max)(run[name] for run in runs) for name in runs[0]}
+
+def compare(results, baseline, tolerance):
+    # Times (_ms) should not grow, rates (_per_s) should not drop
+    rows = []
+    for name, value in results.items():
+        if name not in baseline or not baseline[name]:
+            continue
+        change = (value - baseline[name]) / baseline[name]
+        worse = change > tolerance if name.endswith("_ms") else change < -tolerance
+        rows.append({"metric": name, "baseline": baseline[name], "current": value,
+                     "change_pct": change * 100, "regression": worse})
+    return pd.DataFrame(rows, columns=["metric", "baseline", "current", "change_pct", "regression"])
+
+parser = argparse.ArgumentParser(description="Benchmark tokenization, training and inference offline")
+parser.add_argument("--rows", type=int, default=512, help="synthetic tweets per benchmark")
+parser.add_argument("--max-len", type=int, default=128)
+parser.add_argument("--batch-size", type=int, default=16)
+parser.add_argument("--train-steps", type=int, default=20)
+parser.add_argument("--layers", type=int, default=2, help="encoder layers of the tiny model")
+parser.add_argument("--hidden-size", type=int, default=64)
+parser.add_argument("--vocab-size", type=int, default=2000)
+parser.add_argument("--repeats", type=int, default=3, help="runs of the suite, the best value of each metric is kept")
+parser.add_argument("--output", default=None, help="write the results to this json file")
+parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="json file of a previous run to compare against")
+parser.add_argument("--no-baseline", action="store_true", help="skip the comparison")
+parser.add_argument("--tolerance", type=float, default=0.25, help="relative change counted as a regression")
+parser.add_argument("--fail-on-regression", action="store_true")
+parser.add_argument("--check-resume", action="store_true",
+                    help="only check that a run resumed from a mid-epoch checkpoint matches an uninterrupted one")
+runtime.add_runtime_args(parser)
+args = parser.parse_args()
+
+# Heavy dependencies are imported once the arguments are parsed, so --help
+# and argument errors return without loading them
+import numpy as np
+import pandas as pd
+import torch
+import transformers
+from torch.utils.data import DataLoader
+from tokenizers import ByteLevelBPETokenizer
+from dataclasses import replace
+from transformers import RobertaTokenizer, RobertaConfig, RobertaModel
+from hydra_model import NetMultiTask
+from hydra_training import train_hydra, valid_hydra
+from tweet_data import DataCombined, DisasterData, SentimentData
+from checkpoint import save_checkpoint, latest_training_checkpoint
+from trainers import HydraConfig, HydraTrainer
+from predictor import HydraPredictor
+
+settings = runtime.configure_from_args(args)
+
+torch.manual_seed(2023)
+texts = synthetic_tweets(args.rows)
+frame = synthetic_frame(texts)
+
+with tempfile.TemporaryDirectory() as workdir:
+    tokenizer = offline_tokenizer(texts, workdir, args.vocab_size)
+    encoder_config = {"vocab_size": len(tokenizer), "hidden_size": args.hidden_size,
+                      "num_hidden_layers": args.layers, "num_attention_heads": max(args.hidden_size // 32, 1),
+                      "intermediate_size": args.hidden_size * 4, "max_position_embeddings": args.max_len + 2,
+                      "pad_token_id": tokenizer.pad_token_id, "bos_token_id": tokenizer.bos_token_id,
+                      "eos_token_id": tokenizer.eos_token_id}
+
+    if args.check_resume:
+        difference = check_resume(frame, tokenizer, encoder_config, args.max_len, args.batch_size,
+                                  os.path.join(workdir, "resume"))
+        print(f"Largest weight difference between the resumed and the uninterrupted run: {difference}")
+        sys.exit(0 if difference == 0.0 else 1)
+
+    runs = []
+    for _ in range(args.repeats):
+        model = NetMultiTask(pretrained=False, encoder_config=encoder_config)
+        run = {}
+        run.update(bench_tokenization(frame, tokenizer, args.max_len))
+        run.update(bench_training(model, frame, tokenizer, args.max_len, args.batch_size,
+                                  min(args.train_steps, args.rows // args.batch_size)))
+        run.update(bench_validation(model, frame, tokenizer, args.max_len, args.batch_size))
+        run.update(bench_inference(model, tokenizer, texts, args.max_len, args.batch_size,
+                                   os.path.join(workdir, "checkpoint")))
+        runs.append(run)
+    results = best_of(runs)
+
+report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+          "environment": {"python": platform.python_version(),
+                          "torch": torch.__version__,
+                          "transformers": transformers.__version__,
+                          "machine": platform.machine(),
+                          "cpus": os.cpu_count(),
+                          **{key: value for key, value in settings.items() if key != "cpus"}},
+          "settings": {key: value for key, value in vars(args).items()
+                       if key in ("rows", "max_len", "batch_size", "train_steps", "layers",
+                                  "hidden_size", "vocab_size", "repeats")},
+          "results": results}
+print(json.dumps(report, indent=2))
+if args.output:
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+if not args.no_baseline and os.path.exists(args.baseline):
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    if baseline.get("settings") != report["settings"]:
+        print(f"Warning: {args.baseline} was run with {baseline.get('settings')}")
+    comparison = compare(results, baseline["results"], args.tolerance)
+    print(comparison.to_string(index=False))
+    if args.fail_on_regression and comparison.regression.any():
+        sys.exit(1)
@@ -0,0 +1,241 @@
+import os
+import json
+import glob
+import time
+import queue
+import traceback
+from dataclasses import dataclass
+import pandas as pd
+import torch.multiprocessing as mp
+import runtime
+from prediction_writer import prediction_frame
+
+"""
+Scoring of every tweet file of a directory (e.g. daily dumps) by a pool of
+inference worker processes. Files are discovered under the input directory,
+queued largest first and taken by the workers one at a time; each worker
+(spawned, pinned to its own core set) loads the model once. Checkpoints of
+the multi-task model are loaded as a memory map of model.safetensors (see
+checkpoint.py), so the workers share the pages of one copy of the weights.
+
+A file is read and scored in chunks, its predictions appended to
+<output>.partial, flushed to disk and then recorded in the manifest, a
+JSON lines file written by the parent process only: one record per chunk
+with the input rows and output bytes done, and one when the file is
+complete and renamed to its final path. A record only counts for the same
+input file (size and modification time), model version and output
+columns, so changed files or a retrained model are scored again. An
+interrupted job resumes from the manifest: completed files are skipped, and
+a partial file is cut back to its last recorded chunk and continued after
+its last recorded row, so no tweet is scored twice.
+
+    files = discover_files(input_dir, "*.csv", output_dir)
+    manifest = Manifest(f"{output_dir}/manifest.jsonl")
+    jobs, done = plan_jobs(files, manifest, output_dir, settings)
+    run_scoring(jobs, manifest, settings, spec, workers=4)
+
+"""
+
+
+@dataclass
+class ScoreJob:
+    # One input file, with the rows already scored and the bytes of output written for them
+    file: str
+    source: str
+    output: str
+    size: int
+    mtime_ns: int
+    rows: int = 0
+    bytes: int = 0
+
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of a run killed while appending it
+                        continue
+                    self.records[record["file"]] = record
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.compact()
+        self.sink = open(path, "a")
+
+    def compact(self):
+        # Rewrites the manifest with the latest record of each file only
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            for record in self.records.values():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def record(self, **record):
+        self.records[record["file"]] = record
+        self.sink.write(json.dumps(record) + "\n")
+        self.sink.flush()
+        os.fsync(self.sink.fileno())
+
+    def close(self):
+        self.sink.close()
+
+
+def discover_files(input_dir, pattern="*.csv", exclude=None):
+    # (path relative to input_dir, absolute path, size, mtime_ns) of the matching files,
+    # skipping those under `exclude` (the output directory)
+    exclude = os.path.abspath(exclude) + os.sep if exclude else None
+    files = []
+    for source in sorted(glob.glob(os.path.join(input_dir, "**", pattern), recursive=True)):
+        source = os.path.abspath(source)
+        if not os.path.isfile(source) or (exclude and source.startswith(exclude)):
+            continue
+        info = os.stat(source)
+        files.append((os.path.relpath(source, input_dir), source, info.st_size, info.st_mtime_ns))
+    return files
+
+def plan_jobs(files, manifest, output_dir, settings):
+    # Jobs of the files still to score, largest first, and the number of files already done.
+    # `settings` (model version, output columns) must match the records for them to count.
+    jobs, done = [], 0
+    for file, source, size, mtime_ns in files:
+        output = os.path.join(output_dir, os.path.splitext(file)[0] + ".csv")
+        job = ScoreJob(file, source, output, size, mtime_ns)
+        record = manifest.records.get(file)
+        if record is not None and record["size"] == size and record["mtime_ns"] == mtime_ns \
+                and record["settings"] == settings:
+            if record["done"] and os.path.exists(output):
+                done += 1
+                continue
+            if not record["done"] and os.path.exists(f"{output}.partial"):
+                job.rows, job.bytes = record["rows"], record["bytes"]
+            elif not record["done"] and os.path.exists(output) and os.path.getsize(output) == record["bytes"]:
+                # Renamed after its last chunk was recorded, but stopped before the file was
+                done += 1
+                manifest.record(**{**record, "done": True})
+                continue
+        jobs.append(job)
+    jobs.sort(key=lambda job: job.size, reverse=True)
+    return jobs, done
+
+def load_predictor(spec):
+    # spec: (model, path, exit_threshold) where model is hydra or strategy1
+    model, path, exit_threshold = spec
+    if model == "hydra":
+        from predictor import HydraPredictor
+        return HydraPredictor(path, exit_threshold=exit_threshold)
+    import torch
+    from predictor import Strategy1Predictor
+    return Strategy1Predictor(path, device="cuda:0" if torch.cuda.is_available() else "cpu")
+
+def score_file(job, predictor, events, batch_size, chunk_size, keep_probs=False):
+    # Scores the rows of job.source after job.rows, appending to the partial output,
+    # and reports ("progress", file, rows, bytes) once each chunk is on disk
+    os.makedirs(os.path.dirname(os.path.abspath(job.output)), exist_ok=True)
+    partial = f"{job.output}.partial"
+    rows, written = job.rows, job.bytes
+    with open(partial, "r+" if written else "w", newline="") as sink:
+        # Rows written after the last recorded chunk were never recorded, they are scored again
+        sink.truncate(written)
+        sink.seek(written)
+        skip = rows
+        for chunk in pd.read_csv(job.source, chunksize=chunk_size):
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+            chunk, skip = chunk.iloc[skip:], 0
+            ids, texts = chunk["id"].tolist(), chunk.text.astype(str).tolist()
+            results = []
+            for start in range(0, len(texts), batch_size):
+                results.extend(predictor.predict(texts[start:start + batch_size]))
+            prediction_frame(ids, results, keep_probs).to_csv(sink, header=written == 0)
+            sink.flush()
+            os.fsync(sink.fileno())
+            rows, written = rows + len(chunk), sink.tell()
+            events.put(("progress", job.file, rows, written))
+        if written == 0:
+            # No rows, the file still gets its header
+            prediction_frame([], [], keep_probs).to_csv(sink)
+    os.replace(partial, job.output)
+    return rows
+
+def score_worker(worker, cpus, jobs, events, spec, batch_size, chunk_size, keep_probs):
+    runtime.configure_runtime(cpus=runtime.format_cpu_list(cpus))
+    try:
+        predictor = load_predictor(spec)
+    except Exception:
+        traceback.print_exc()
+        events.put(("exit", worker, traceback.format_exc(limit=1)))
+        return
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        start = time.perf_counter()
+        try:
+            rows = score_file(job, predictor, events, batch_size, chunk_size, keep_probs)
+            events.put(("done", job.file, rows, time.perf_counter() - start))
+        except Exception:
+            traceback.print_exc()
+            events.put(("error", job.file, traceback.format_exc(limit=1)))
+    events.put(("exit", worker, None))
+
+def run_scoring(jobs, manifest, settings, spec, workers=2, batch_size=32, chunk_size=10000, keep_probs=False):
+    # Scores the jobs on `workers` spawned processes, recording progress in the manifest.
+    # Returns {file: error} of the files that failed, they are retried by the next run.
+    if not jobs:
+        return {}
+    by_file = {job.file: job for job in jobs}
+    workers = max(min(workers, len(jobs)), 1)
+    context = mp.get_context("spawn")
+    job_queue, events = context.Queue(), context.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    processes = []
+    for worker, cpus in enumerate(runtime.split_cpus(workers)):
+        job_queue.put(None)
+        process = context.Process(target=score_worker, args=(worker, cpus, job_queue, events, spec,
+                                                             batch_size, chunk_size, keep_probs))
+        process.start()
+        processes.append(process)
+
+    pending, errors, running = set(by_file), {}, workers
+    try:
+        while pending and running:
+            try:
+                event = events.get(timeout=5)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    break
+                continue
+            kind, name = event[0], event[1]
+            if kind == "exit":
+                running -= 1
+                if event[2]:
+                    print(f"Worker {name} failed to load the model: {event[2]}")
+                continue
+            job = by_file[name]
+            record = {"file": name, "size": job.size, "mtime_ns": job.mtime_ns, "settings": settings}
+            if kind == "progress":
+                manifest.record(**record, rows=event[2], bytes=event[3], done=False)
+            elif kind == "done":
+                manifest.record(**record, rows=event[2], bytes=os.path.getsize(job.output), done=True)
+                pending.discard(name)
+                print(f"Scored {name}: {event[2]} tweets in {event[3]:.1f}s, {len(pending)} files left")
+            else:
+                errors[name] = event[2]
+                pending.discard(name)
+                print(f"Failed {name}: {event[2]}")
+    finally:
+        for process in processes:
+            if pending:
+                process.terminate()
+            process.join()
+    for name in pending:
+        errors[name] = "not scored, no worker left"
+    return errors
@@ -0,0 +1,273 @@
+import os
+import glob
+import json
+import queue
+import random
+import struct
+import threading
+import time
+import numpy as np
+import torch
+from safetensors.torch import save_file, load_file
+from transformers import RobertaTokenizer
+from hydra_model import NetMultiTask
+
+"""
+Checkpoint format for NetMultiTask models. A checkpoint is a directory with
+
+    model.safetensors   weights and buffers of the model
+    config.json         encoder config, head sizes, label maps, tokenizer, MAX_LEN
+    tokenizer files     written by tokenizer.save_pretrained
+
+Loading builds the model on the meta device and points every tensor at a
+private (copy-on-write) memory map of model.safetensors, so nothing is read
+until it is used and inference workers on one host share the page cache.
+
+Training checkpoints (model, optimizer, scheduler, loss weighting, RNG and sampler position)
+are separate: TrainingCheckpointer snapshots them every few steps and writes
+them on a background thread, and a run started with --resume continues from
+the latest one. Every rank writes its RNG state to rng-<rank>.pt; rank 0
+writes training_state.pt, the marker of a complete step, only once the RNG
+states of all ranks are on disk.
+
+"""
+
+WEIGHTS_NAME = "model.safetensors"
+CONFIG_NAME = "config.json"
+
+SAFETENSORS_DTYPES = {"F64": torch.float64, "F32": torch.float32, "F16": torch.float16,
+                      "BF16": torch.bfloat16, "I64": torch.int64, "I32": torch.int32,
+                      "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool}
+
+
+def save_checkpoint(model, path, tokenizer=None, max_len=None, label_maps=None):
+    os.makedirs(path, exist_ok=True)
+    # Buffers are stored as well, non-persistent ones (e.g. position_ids) are
+    # not in the state dict but are needed to rebuild the model from meta tensors
+    tensors = {**dict(model.named_buffers()), **model.state_dict()}
+    save_file({name: tensor.detach().cpu().contiguous() for name, tensor in tensors.items()},
+              os.path.join(path, WEIGHTS_NAME))
+
+    config = model.model_config()
+    config["max_len"] = max_len
+    config["label_maps"] = label_maps or {}
+    if tokenizer is not None:
+        config["tokenizer"] = tokenizer.name_or_path
+        config["do_lower_case"] = getattr(tokenizer, "do_lower_case", False)
+        tokenizer.save_pretrained(path)
+    with open(os.path.join(path, CONFIG_NAME), "w") as f:
+        json.dump(config, f, indent=2)
+    return path
+
+def load_config(path):
+    with open(os.path.join(path, CONFIG_NAME), "r") as f:
+        return json.load(f)
+
+def mmap_safetensors(filename):
+    # Minimal safetensors reader returning tensors that are views of one
+    # MAP_PRIVATE mapping of the file instead of copies of it
+    with open(filename, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+    storage = torch.UntypedStorage.from_file(filename, False, os.path.getsize(filename))
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        itemsize = torch.empty(0, dtype=dtype).element_size()
+        if (data_start + start) % itemsize:
+            raise ValueError(f"{name} is not aligned in {filename}")
+        tensor = torch.empty(0, dtype=dtype)
+        tensor.set_(storage, (data_start + start) // itemsize, tuple(info["shape"]))
+        tensors[name] = tensor
+    return tensors
+
+def load_checkpoint(path, device="cpu", mmap=True):
+    config = load_config(path)
+    weights = os.path.join(path, WEIGHTS_NAME)
+    tensors = None
+    if mmap and str(device) == "cpu":
+        try:
+            tensors = mmap_safetensors(weights)
+        except ValueError as e:
+            print(f"Falling back to a full read: {e}")
+    if tensors is None:
+        tensors = load_file(weights, device=str(device))
+
+    with torch.device("meta"):
+        model = NetMultiTask.from_config(config)
+    state_names = set(model.state_dict())
+    model.load_state_dict({name: tensors[name] for name in state_names}, assign=True)
+    for name, _ in list(model.named_buffers()):
+        if name in state_names:
+            continue
+        module_name, _, buffer_name = name.rpartition(".")
+        model.get_submodule(module_name).register_buffer(buffer_name, tensors[name], persistent=False)
+    model.eval()
+    return model, config
+
+def load_tokenizer(path):
+    config = load_config(path)
+    saved = any(os.path.exists(os.path.join(path, name)) for name in ("vocab.json", "tokenizer_config.json"))
+    source = path if saved else config["tokenizer"]
+    return RobertaTokenizer.from_pretrained(source, do_lower_case=config.get("do_lower_case", False))
+
+
+def clone_state(state):
+    # Detached CPU copy of a (nested) state dict, safe to write from another thread
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: clone_state(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(clone_state(value) for value in state)
+    return state
+
+def rng_state(loader_generator=None):
+    # `loader_generator`: the torch.Generator of the training DataLoader, kept apart from
+    # the global one so that starting a DataLoader iterator does not shift dropout masks
+    state = {"python": random.getstate(),
+             "numpy": np.random.get_state(),
+             "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    if loader_generator is not None:
+        state["loader"] = loader_generator.get_state()
+    return state
+
+def restore_rng_state(state, loader_generator=None):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    if loader_generator is not None and "loader" in state:
+        loader_generator.set_state(state["loader"])
+
+class TrainingCheckpointer:
+    def __init__(self, path, every_steps, keep=2, rank=0, loader_generator=None, world_size=1, rank_timeout=600):
+        self.path = path
+        self.every_steps = every_steps
+        self.keep = keep
+        self.rank = rank
+        self.world_size = world_size
+        # Seconds rank 0 waits for the RNG states of the other ranks before giving up on a step
+        self.rank_timeout = rank_timeout
+        self.loader_generator = loader_generator
+        os.makedirs(path, exist_ok=True)
+        # One snapshot in flight at most, a second save waits for the first write
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def should_save(self, global_step):
+        return self.every_steps > 0 and global_step % self.every_steps == 0
+
+    def save(self, global_step, epoch, batch_in_epoch, model, optimizer, scheduler=None, loss_weighting=None):
+        # Copies are taken here so training can carry on while the thread writes.
+        # Every rank keeps its own RNG state, the rest is identical on all ranks.
+        state = {"rng": rng_state(self.loader_generator)}
+        if self.rank == 0:
+            state.update({"world_size": self.world_size,
+                          "global_step": global_step,
+                          "epoch": epoch,
+                          "batch_in_epoch": batch_in_epoch,
+                          "model": clone_state(model.state_dict()),
+                          "optimizer": clone_state(optimizer.state_dict()),
+                          "scheduler": clone_state(scheduler.state_dict()) if scheduler is not None else None,
+                          "loss_weighting": (clone_state(loss_weighting.state_dict())
+                                             if loss_weighting is not None else None)})
+        self.queue.put((global_step, state))
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            global_step, state = item
+            try:
+                step_dir = os.path.join(self.path, f"step-{global_step:08d}")
+                os.makedirs(step_dir, exist_ok=True)
+                rng = state.pop("rng")
+                self._atomic_save(rng, os.path.join(step_dir, f"rng-{self.rank}.pt"))
+                if self.rank == 0:
+                    if not self._wait_for_ranks(step_dir):
+                        raise RuntimeError(f"the RNG state of every rank was not written within {self.rank_timeout}s")
+                    self._atomic_save(state, os.path.join(step_dir, "training_state.pt"))
+                    self._prune()
+            except Exception as e:
+                print(f"Failed to write checkpoint for step {global_step}: {e}")
+            self.queue.task_done()
+
+    def _atomic_save(self, obj, filename):
+        tmp = f"{filename}.tmp"
+        torch.save(obj, tmp)
+        os.replace(tmp, filename)
+
+    def _wait_for_ranks(self, step_dir):
+        deadline = time.monotonic() + self.rank_timeout
+        while not all(os.path.exists(os.path.join(step_dir, f"rng-{rank}.pt")) for rank in range(self.world_size)):
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def _prune(self):
+        # Keeps the last `keep` complete steps, older steps go too if a run died while writing them
+        complete = sorted(glob.glob(os.path.join(self.path, "step-*", "training_state.pt")))
+        if len(complete) <= self.keep:
+            return
+        oldest_kept = os.path.dirname(complete[-self.keep])
+        for step_dir in sorted(glob.glob(os.path.join(self.path, "step-*"))):
+            if step_dir >= oldest_kept:
+                break
+            # The marker goes first, a step never looks complete with files missing
+            marker = os.path.join(step_dir, "training_state.pt")
+            if os.path.exists(marker):
+                os.remove(marker)
+            for f in glob.glob(os.path.join(step_dir, "*")):
+                os.remove(f)
+            os.rmdir(step_dir)
+
+    def wait(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+def latest_training_checkpoint(path):
+    # Steps without training_state.pt were interrupted before every rank had written its state
+    complete = sorted(glob.glob(os.path.join(path, "step-*", "training_state.pt")))
+    return os.path.dirname(complete[-1]) if complete else None
+
+def load_training_checkpoint(step_dir, rank=0):
+    state = torch.load(os.path.join(step_dir, "training_state.pt"), map_location="cpu", weights_only=False)
+    rng_file = os.path.join(step_dir, f"rng-{rank}.pt")
+    if os.path.exists(rng_file):
+        state["rng"] = torch.load(rng_file, weights_only=False)
+    elif rank < state.get("world_size", 1):
+        raise FileNotFoundError(f"{step_dir} is missing the RNG state of rank {rank}")
+    else:
+        # Resumed on more ranks than the run was saved with, it cannot repeat that run exactly
+        print(f"{step_dir} was saved by {state.get('world_size', 1)} ranks, "
+              f"rank {rank} continues with a fresh RNG state")
+        state["rng"] = None
+    return state
+
+def resume_training(step_dir, model, optimizer, scheduler=None, rank=0, loader_generator=None, loss_weighting=None):
+    state = load_training_checkpoint(step_dir, rank)
+    model.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    if scheduler is not None and state["scheduler"] is not None:
+        scheduler.load_state_dict(state["scheduler"])
+    if loss_weighting is not None and state.get("loss_weighting") is not None:
+        loss_weighting.load_state_dict(state["loss_weighting"])
+    if state["rng"] is not None:
+        restore_rng_state(state["rng"], loader_generator)
+    print(f"Resumed from {step_dir} (epoch {state['epoch']}, batch {state['batch_in_epoch']})")
+    return state["global_step"], state["epoch"], state["batch_in_epoch"]
@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import runpy
+import argparse
+import builtins
+import threading
+
+"""
+Single entry point for data preparation, training, tuning, prediction and
+benchmarks. Each command runs one of the scripts with the remaining
+arguments:
+
+    python src/cli.py prepare <dir>
+    python src/cli.py train <dir> [--method hydra|separate|strategy1] [options]
+    python src/cli.py tune <dir>
+    python src/cli.py predict <dir> [--model hydra|strategy1] [options]
+    python src/cli.py cv <dir> [--folds 5 | --seeds 2023 2024 2025] [options]
+    python src/cli.py score <dir> <input dir> [--workers 4] [options]
+    python src/cli.py embed <dir> [--input train.csv ...] [options]
+    python src/cli.py similar <dir> "tweet" [--id 123] [options]
+    python src/cli.py bench [options]
+    python src/cli.py train --help
+
+Only the standard library is loaded here, and the scripts parse their
+arguments before importing torch, transformers, sklearn, wandb or ax, so
+--help and argument errors return at once. The modules the script imports
+are timed; the total is printed when it finishes, --import-time also lists
+the slowest ones.
+
+"""
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# command: (option choosing the script, {choice: script}, help)
+COMMANDS = {
+    "prepare": (None, {None: "prepare.py"}, "check a data directory and create the output directories"),
+    "train": ("--method", {"hydra": "multitask_hydra.py",
+                           "separate": "learn_multitask.py",
+                           "strategy1": "strat1_trainer.py"}, "train a model"),
+    "tune": (None, {None: "multitask_hydra_bo.py"}, "tune the loss weights with Bayesian Optimization"),
+    "predict": ("--model", {"hydra": "hydra_inference.py",
+                            "strategy1": "trainer_inference.py"}, "predict the test tweets"),
+    "cv": (None, {None: "cv.py"}, "cross-validate the models over folds or seeds"),
+    "score": (None, {None: "score_dir.py"}, "score every tweet file of a directory, resuming interrupted jobs"),
+    "embed": (None, {None: "export_embeddings.py"}, "export tweet embeddings and build their nearest-neighbour index"),
+    "similar": (None, {None: "similar_tweets.py"}, "find the most similar tweets of an exported corpus"),
+    "bench": (None, {None: "bench.py"}, "benchmark tokenization, training and inference offline"),
+}
+
+
+class ImportTimer:
+    # Times the imports of the script that load new modules. Imports made by
+    # those modules count towards them, so the times add up.
+    def __init__(self):
+        self.seconds = {}
+        self.depth = 0
+        self.thread = threading.get_ident()
+        self.original = builtins.__import__
+
+    def __call__(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if (self.depth or level or name in sys.modules or threading.get_ident() != self.thread
+                or not globals or globals.get("__name__") != "__main__"):
+            return self.original(name, globals, locals, fromlist, level)
+        self.depth += 1
+        start = time.perf_counter()
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            self.depth -= 1
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def __enter__(self):
+        builtins.__import__ = self
+        return self
+
+    def __exit__(self, *exc):
+        builtins.__import__ = self.original
+
+    def report(self, elapsed, top=None):
+        total = sum(self.seconds.values())
+        print(f"Imports took {total:.2f}s of {elapsed:.2f}s")
+        if top:
+            for name, seconds in sorted(self.seconds.items(), key=lambda item: -item[1])[:top]:
+                print(f"  {seconds:8.3f}s  {name}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Disaster tweet classification")
+    parser.add_argument("--import-time", type=int, nargs="?", const=15, default=None, metavar="N",
+                        help="also list the N slowest imports (default 15)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    subparsers = {}
+    for command, (option, scripts, help) in COMMANDS.items():
+        # Everything else, --help included, goes to the script
+        subparser = commands.add_parser(command, help=help, add_help=False,
+                                        description=f"{help}, runs src/{' or src/'.join(scripts.values())}")
+        if option is not None:
+            choices = list(scripts)
+            subparser.add_argument(option, choices=choices, default=choices[0],
+                                   help=f"script to run (default: {choices[0]})")
+        subparsers[command] = subparser
+    return parser, subparsers
+
+def main(argv=None):
+    parser, subparsers = build_parser()
+    args, rest = parser.parse_known_args(argv)
+    option, scripts, _ = COMMANDS[args.command]
+    script = scripts[getattr(args, option.lstrip("-"), None) if option else None]
+    if "-h" in rest or "--help" in rest:
+        print(subparsers[args.command].format_help())
+
+    path = os.path.join(SRC_DIR, script)
+    sys.argv = [f"{os.path.basename(sys.argv[0])} {args.command}"] + rest
+    start = time.perf_counter()
+    with ImportTimer() as timer:
+        try:
+            runpy.run_path(path, run_name="__main__")
+        finally:
+            if "-h" not in rest and "--help" not in rest:
+                timer.report(time.perf_counter() - start, top=args.import_time)
+
+if __name__ == "__main__":
+    main()
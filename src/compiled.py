@@ -0,0 +1,249 @@
+import time
+import math
+
+"""
+Compiled execution of NetMultiTask with torch.compile, for the training
+step of trainers.HydraTrainer and the forward of predictor.HydraPredictor.
+
+Graphs are compiled for static shapes only, so every batch is padded up to
+one of a few ShapeBuckets: inference batches to a bucket of rows (1, 4,
+16, ... up to the batch size) and of tokens (--compile-lengths, up to
+max_len), training batches to the full batch size (their rows are padded
+to max_len already). Padding rows are copies of the first row; training
+copies carry no labels and no weight, so losses and metrics are unchanged.
+That bounds the graphs to the bucket shapes, all compiled by warm_up()
+at startup.
+
+CompiledForward replaces the forward of the model in place, so state
+dicts, DistributedDataParallel and checkpoints see the same module. If
+compiling or running a compiled graph fails, it prints the error and runs
+eagerly from then on. The compile time of the warm-up and the steady-state
+time against the eager forward are reported separately:
+
+    compiled = CompiledForward(model)
+    warm_up(compiled, make_inputs, buckets.shapes())
+    measure_speedup(compiled, make_inputs(*buckets.shapes()[-1]))
+    compiled.print_report()
+
+torch is imported when a model is compiled, so the scripts can add the
+arguments before loading it.
+
+"""
+
+DEFAULT_LENGTHS = (32, 64, 128)
+
+
+def add_compile_args(parser, buckets=True):
+    group = parser.add_argument_group("compilation")
+    group.add_argument("--compile", action="store_true",
+                       help="run the model forward compiled by torch.compile, warmed up at startup")
+    group.add_argument("--compile-mode", choices=["default", "reduce-overhead", "max-autotune"], default="default",
+                       help="torch.compile mode")
+    if buckets:
+        group.add_argument("--compile-lengths", default=",".join(str(length) for length in DEFAULT_LENGTHS),
+                           help="token count buckets the batches are padded to, max_len is always added")
+    return parser
+
+def parse_lengths(spec):
+    return tuple(int(length) for length in str(spec).split(",") if length.strip())
+
+
+class ShapeBuckets:
+    def __init__(self, batch_sizes, lengths):
+        self.batch_sizes = sorted(set(batch_sizes))
+        self.lengths = sorted(set(lengths))
+
+    @classmethod
+    def for_inference(cls, max_batch_size, max_len, lengths=DEFAULT_LENGTHS):
+        # Rows 1, 4, 16, ... and max_batch_size, token counts up to max_len
+        batch_sizes = [max_batch_size]
+        size = 1
+        while size < max_batch_size:
+            batch_sizes.append(size)
+            size *= 4
+        return cls(batch_sizes, [min(length, max_len) for length in lengths] + [max_len])
+
+    @property
+    def max_batch_size(self):
+        return self.batch_sizes[-1]
+
+    def bucket(self, batch_size, length):
+        # Smallest (rows, tokens) bucket holding a batch of this shape
+        rows = next((size for size in self.batch_sizes if size >= batch_size), None)
+        tokens = next((size for size in self.lengths if size >= length), None)
+        if rows is None or tokens is None:
+            raise ValueError(f"Batch of {batch_size}x{length} is larger than the largest bucket "
+                             f"{self.max_batch_size}x{self.lengths[-1]}")
+        return rows, tokens
+
+    def shapes(self):
+        return [(rows, tokens) for rows in self.batch_sizes for tokens in self.lengths]
+
+
+def pad_inputs(input_ids, attention_mask, token_type_ids, shape, pad_id):
+    # Model inputs padded to shape (rows, tokens), extra rows repeat the first row
+    rows, tokens = shape
+    batch_size, length = input_ids.shape
+    padded = []
+    for tensor, value in ((input_ids, pad_id), (attention_mask, 0), (token_type_ids, 0)):
+        out = tensor.new_full((rows, tokens), value)
+        out[:batch_size, :length] = tensor
+        out[batch_size:, :length] = tensor[:1]
+        padded.append(out)
+    return tuple(padded)
+
+def pad_batch(data, batch_size):
+    # DataCombined batch padded to batch_size rows with copies of its first row that have
+    # no label for either task and no weight
+    import torch
+    rows = data['ids'].size(0)
+    if rows >= batch_size:
+        return data
+    extra = batch_size - rows
+
+    def repeat_first(tensor):
+        return torch.cat([tensor, tensor[:1].expand(extra, *tensor.shape[1:])])
+
+    def no_labels(labels):
+        return torch.cat([labels, labels.new_full((extra,), math.nan)])
+
+    return {**data,
+            'ids': repeat_first(data['ids']),
+            'mask': repeat_first(data['mask']),
+            'token_type_ids': repeat_first(data['token_type_ids']),
+            'labels': tuple(no_labels(labels) for labels in data['labels']),
+            'weight': torch.cat([data['weight'], data['weight'].new_zeros(extra)])}
+
+def padded_collate(batch_size):
+    # collate_fn of DataCombined loaders whose batches all have batch_size rows
+    from torch.utils.data import default_collate
+
+    def collate(items):
+        return pad_batch(default_collate(items), batch_size)
+    return collate
+
+
+def raise_recompile_limits(graphs):
+    # Lets dynamo keep `graphs` graphs of one function, the limits were named
+    # cache_size_limit before torch 2.6
+    import torch._dynamo
+    config = torch._dynamo.config
+    for names in (("recompile_limit", "cache_size_limit"),
+                  ("accumulated_recompile_limit", "accumulated_cache_size_limit")):
+        name = next((name for name in names if hasattr(config, name)), None)
+        if name is not None:
+            setattr(config, name, max(getattr(config, name), graphs))
+
+
+class CompiledForward:
+    def __init__(self, model, mode="default", graphs=8):
+        # `graphs`: compiled graphs to expect, the bucket shapes of every train/eval mode used
+        import torch
+        self.model = model
+        self.mode = mode
+        self.eager_forward = model.forward
+        self.compiled_forward = None
+        self.eager = False
+        self.error = None
+        self.compile_seconds = 0.0
+        self.warmed_shapes = 0
+        self.compiled_ms = None
+        self.eager_ms = None
+        try:
+            raise_recompile_limits(graphs)
+            self.compiled_forward = torch.compile(self.eager_forward, mode=mode, dynamic=False)
+        except Exception as e:
+            self.fall_back(e)
+        model.forward = self
+
+    def __call__(self, *args, **kwargs):
+        if self.eager:
+            return self.eager_forward(*args, **kwargs)
+        try:
+            return self.compiled_forward(*args, **kwargs)
+        except Exception as e:
+            self.fall_back(e)
+            return self.eager_forward(*args, **kwargs)
+
+    def fall_back(self, error):
+        message = str(error).strip().splitlines()[0] if str(error).strip() else ""
+        self.error = f"{type(error).__name__}: {message}"
+        print(f"torch.compile failed ({self.error}), running the model eagerly")
+        self.eager = True
+
+    def report(self):
+        if self.eager:
+            return f"torch.compile fell back to eager ({self.error})"
+        line = (f"torch.compile ({self.mode}): {self.warmed_shapes} shapes compiled in "
+                f"{self.compile_seconds:.1f}s")
+        if self.compiled_ms is not None:
+            line += (f"; steady state {self.compiled_ms:.2f} ms per batch compiled vs {self.eager_ms:.2f} ms eager "
+                     f"({self.eager_ms / self.compiled_ms:.2f}x)")
+        return line
+
+    def print_report(self):
+        print(self.report())
+
+def _run(model, inputs, train):
+    # One forward (and backward in training) of the model inputs `inputs`
+    import torch
+    if train:
+        model.train()
+        outputs = model(**inputs)
+        sum(output.float().sum() for output in outputs if output is not None).backward()
+        model.zero_grad(set_to_none=True)
+    else:
+        model.eval()
+        with torch.no_grad():
+            model(**inputs)
+
+def warm_up(compiled, make_inputs, shapes, train=False):
+    # Compiles the graph of every shape (forward and backward with train) before the first batch.
+    # `make_inputs(rows, tokens)` returns model inputs of that shape. Weights and RNG are untouched.
+    import torch
+    model = compiled.model
+    was_training = model.training
+    device = next(model.parameters()).device
+    start = time.perf_counter()
+    with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+        for shape in shapes:
+            if compiled.eager:
+                break
+            try:
+                _run(model, make_inputs(*shape), train)
+                compiled.warmed_shapes += 1
+            except Exception as e:
+                compiled.fall_back(e)
+    compiled.compile_seconds += time.perf_counter() - start
+    model.train(was_training)
+
+def measure_speedup(compiled, inputs, train=False, repeats=10):
+    # Steady-state ms per batch of the compiled and of the eager forward (and backward with train)
+    import torch
+    if compiled.eager:
+        return
+    model = compiled.model
+    was_training = model.training
+    device = next(model.parameters()).device
+    with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+        timings = {}
+        for name, forward in (("compiled", compiled.compiled_forward), ("eager", compiled.eager_forward)):
+            model.forward = forward
+            try:
+                _run(model, inputs, train)
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    _run(model, inputs, train)
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                timings[name] = (time.perf_counter() - start) * 1000 / repeats
+            except Exception as e:
+                compiled.fall_back(e)
+                break
+            finally:
+                model.forward = compiled
+    if len(timings) == 2:
+        compiled.compiled_ms, compiled.eager_ms = timings["compiled"], timings["eager"]
+    model.train(was_training)
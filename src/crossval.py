@@ -0,0 +1,258 @@
+import copy
+import itertools
+import queue
+import time
+import traceback
+from dataclasses import dataclass, replace
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset
+from sklearn.model_selection import StratifiedKFold, train_test_split
+import runtime
+from evaluation import PredictionCollector
+from tweet_text import normalise_text
+
+"""
+Cross-validation and multi-seed runs of the multi-task model (NetMultiTask,
+trained by trainers.HydraTrainer) and of Strategy 1 (strategy1.py) on one
+tokenization of the data.
+
+Every tweet of both tasks is tokenized once, in the parent process, into a
+SharedTokens table: one flat int32 tensor of token ids plus offsets, both in
+shared memory. Runs only hold row numbers into it, so worker processes
+(spawned, each pinned to its own core set with a matching thread count)
+read the same pages instead of receiving copies. Each worker loads the
+pretrained models once and trains a copy for every run it takes from the
+queue. Rows are padded to the longest tweet instead of MAX_LEN.
+
+roberta-base and roberta-large share their tokenizer, so both models read
+the same token ids. Strategy 1 is trained and scored on the disaster tweets
+only.
+
+"""
+
+MODELS = ("hydra", "strategy1")
+
+
+@dataclass
+class CVRun:
+    # Row numbers of one run into the disaster and sentiment rows of the tables,
+    # training rows come with their dedup weight
+    name: str
+    seed: int
+    fold: int
+    d_train: np.ndarray
+    d_train_weight: np.ndarray
+    d_val: np.ndarray
+    s_train: np.ndarray
+    s_train_weight: np.ndarray
+    s_val: np.ndarray
+
+
+class SharedTokens:
+    def __init__(self, input_ids, pad_id):
+        lengths = torch.tensor([len(ids) for ids in input_ids], dtype=torch.int64)
+        self.offsets = torch.zeros(len(input_ids) + 1, dtype=torch.int64)
+        self.offsets[1:] = torch.cumsum(lengths, dim=0)
+        self.flat = torch.tensor(list(itertools.chain.from_iterable(input_ids)), dtype=torch.int32)
+        # Passed to spawned workers as handles to the same memory
+        self.flat.share_memory_()
+        self.offsets.share_memory_()
+        self.pad_id = pad_id
+        self.max_length = int(lengths.max()) if len(lengths) else 0
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def row(self, index):
+        # ids and attention mask of one tweet, padded to the longest tweet
+        ids = torch.full((self.max_length,), self.pad_id, dtype=torch.long)
+        mask = torch.zeros(self.max_length, dtype=torch.long)
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        ids[:end - start] = self.flat[start:end]
+        mask[:end - start] = 1
+        return ids, mask
+
+class TokenCombined(Dataset):
+    # Rows of both tasks with DataCombined items, read from SharedTokens
+    def __init__(self, tokens, rows, target, sentiment, weight=None):
+        self.tokens = tokens
+        self.rows = rows
+        self.target = target
+        self.sentiment = sentiment
+        self.weight = weight if weight is not None else np.ones(len(rows), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        row = self.rows[index]
+        ids, mask = self.tokens.row(row)
+        return {
+            'ids': ids,
+            'mask': mask,
+            'token_type_ids': torch.zeros_like(ids),
+            'labels': (self.target[row], self.sentiment[row]),
+            'weight': torch.tensor(self.weight[index], dtype=torch.float)
+        }
+
+class TokenHugging(Dataset):
+    # Disaster rows with the items of strategy1.HuggingData, read from SharedTokens
+    def __init__(self, tokens, rows, target):
+        self.tokens = tokens
+        self.rows = rows
+        self.target = target
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        row = self.rows[index]
+        ids, mask = self.tokens.row(row)
+        return {'input_ids': ids, 'attention_mask': mask,
+                'labels': torch.tensor(int(self.target[row]))}
+
+
+def tokenize_tweets(tokenizer, texts, max_len):
+    texts = [" ".join(str(text).split()) for text in texts]
+    input_ids = tokenizer(texts, add_special_tokens=True, truncation=True, max_length=max_len)["input_ids"]
+    return SharedTokens(input_ids, tokenizer.pad_token_id)
+
+def dedup_rows(rows, keys, labels, enabled=True):
+    # One row per (normalised text, label) of `rows` weighted by its count, like dedup.dedup_weighted
+    if not enabled:
+        return rows, np.ones(len(rows), dtype=np.float32)
+    frame = pd.DataFrame({"key": keys[rows], "label": labels[rows], "row": rows})
+    deduped = frame.groupby(["key", "label"], sort=False, dropna=False).agg(row=("row", "first"), weight=("row", "size"))
+    return deduped.row.to_numpy(), deduped.weight.to_numpy(dtype=np.float32)
+
+def split_rows(labels, folds=None, seeds=(2023,), test_size=0.2):
+    # (seed, fold, train, val) row numbers: stratified k-fold with the first seed,
+    # or one train_test_split per seed (2023 gives the split of the training scripts)
+    rows = np.arange(len(labels))
+    if folds:
+        kfold = StratifiedKFold(n_splits=folds, shuffle=True, random_state=seeds[0])
+        return [(seeds[0], fold, rows[train], rows[val]) for fold, (train, val) in enumerate(kfold.split(rows, labels))]
+    return [(seed, 0) + tuple(train_test_split(rows, test_size=test_size, stratify=labels, random_state=seed))
+            for seed in seeds]
+
+def build_runs(d_frame, s_frame, folds=None, seeds=(2023,), dedup=True):
+    # Fold i (or seed i) of the disaster tweets is paired with that of the sentiment
+    # tweets. Sentiment rows follow the disaster rows in the tables.
+    offset = len(d_frame)
+    d_keys = d_frame.text.astype(str).map(normalise_text).to_numpy()
+    s_keys = s_frame.text.astype(str).map(normalise_text).to_numpy()
+    runs = []
+    for (seed, fold, d_train, d_val), (_, _, s_train, s_val) in zip(split_rows(d_frame.target.to_numpy(), folds, seeds),
+                                                                    split_rows(s_frame.target.to_numpy(), folds, seeds)):
+        d_train, d_weight = dedup_rows(d_train, d_keys, d_frame.target.to_numpy(), dedup)
+        s_train, s_weight = dedup_rows(s_train, s_keys, s_frame.target.to_numpy(), dedup)
+        name = f"fold{fold}" if folds else f"seed{seed}"
+        runs.append(CVRun(name, seed, fold, d_train, d_weight, d_val, s_train + offset, s_weight, s_val + offset))
+    return runs
+
+
+def hydra_run(run, tokens, tables, config, encoder):
+    from trainers import HydraTrainer
+    target, sentiment = tables["target"], tables["sentiment"]
+    train_rows = np.concatenate([run.d_train, run.s_train])
+    weights = np.concatenate([run.d_train_weight, run.s_train_weight])
+    datasets = (TokenCombined(tokens, train_rows, target, sentiment, weights),
+                TokenCombined(tokens, np.concatenate([run.d_val, run.s_val]), target, sentiment))
+    trainer = HydraTrainer(replace(config, seed=run.seed), datasets=datasets, encoder=encoder)
+    model = trainer.new_model()
+    trainer.train(model)
+    d1_predict, d2_predict = trainer.evaluate(model)
+    d1_metrics = d1_predict.metrics()
+    d2_metrics = d2_predict.metrics()
+    return {"d1_f1": d1_metrics["f1_weighted"], "d1_accuracy": d1_metrics["accuracy"],
+            "d2_f1": d2_metrics["f1_weighted"], "d2_accuracy": d2_metrics["accuracy"]}
+
+def strategy1_run(run, tokens, tables, config, model):
+    from strategy1 import Strategy1Trainer
+    target = tables["target"]
+    datasets = (TokenHugging(tokens, run.d_train, target), TokenHugging(tokens, run.d_val, target))
+    config = replace(config, seed=run.seed, checkpoint_steps=0, output=f"{config.dir}/models/cv/{run.name}")
+    trainer = Strategy1Trainer(config, datasets=datasets).trainer(copy.deepcopy(model))
+    trainer.train()
+    logits = torch.from_numpy(np.asarray(trainer.predict(datasets[1]).predictions))
+    predicts = PredictionCollector(num_classes=logits.size(1), size=len(datasets[1]))
+    predicts.update(logits, torch.from_numpy(target[run.d_val].astype(np.int64)))
+    d1_metrics = predicts.metrics()
+    return {"d1_f1": d1_metrics["f1_weighted"], "d1_accuracy": d1_metrics["accuracy"]}
+
+def cv_worker(worker, cpus, jobs, results, tokens, tables, configs):
+    runtime.configure_runtime(cpus=runtime.format_cpu_list(cpus))
+    # Pretrained weights are loaded once per worker, each run trains a copy
+    pretrained = {}
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        model, run = job
+        start = time.perf_counter()
+        result = {"model": model, "run": run.name, "seed": run.seed, "fold": run.fold, "worker": worker}
+        try:
+            torch.manual_seed(run.seed + run.fold)
+            if model == "hydra":
+                if model not in pretrained:
+                    from transformers import RobertaModel
+                    pretrained[model] = RobertaModel.from_pretrained(configs[model].encoder)
+                result.update(hydra_run(run, tokens, tables, configs[model], pretrained[model]))
+            else:
+                if model not in pretrained:
+                    from transformers import AutoModelForSequenceClassification
+                    pretrained[model] = AutoModelForSequenceClassification.from_pretrained(configs[model].model)
+                result.update(strategy1_run(run, tokens, tables, configs[model], pretrained[model]))
+        except Exception:
+            traceback.print_exc()
+            result["error"] = traceback.format_exc(limit=1)
+        result["seconds"] = time.perf_counter() - start
+        results.put(result)
+
+def run_cv(runs, tokens, tables, configs, models=MODELS, workers=2):
+    # Runs every (model, run) pair on `workers` spawned processes, returns one row per pair
+    jobs = [(model, run) for model in models for run in runs]
+    workers = max(min(workers, len(jobs)), 1)
+    context = mp.get_context("spawn")
+    job_queue, result_queue = context.Queue(), context.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    processes = []
+    for worker, cpus in enumerate(runtime.split_cpus(workers)):
+        job_queue.put(None)
+        process = context.Process(target=cv_worker, args=(worker, cpus, job_queue, result_queue, tokens, tables, configs))
+        process.start()
+        processes.append(process)
+    results, pending = [], {(model, run.name): run for model, run in jobs}
+    try:
+        while pending:
+            try:
+                result = result_queue.get(timeout=5)
+            except queue.Empty:
+                # A worker killed mid-run (e.g. out of memory) never reports its run
+                if not any(process.is_alive() for process in processes):
+                    break
+                continue
+            pending.pop((result["model"], result["run"]), None)
+            status = result.get("error", f"d1_f1 {result.get('d1_f1', float('nan')):.4f}")
+            print(f"{result['model']} {result['run']}: {status} in {result['seconds']:.1f}s")
+            results.append(result)
+    finally:
+        for process in processes:
+            if pending:
+                process.terminate()
+            process.join()
+    for (model, name), run in pending.items():
+        print(f"{model} {name}: not run, no worker left")
+        results.append({"model": model, "run": name, "seed": run.seed, "fold": run.fold,
+                        "error": "not run, no worker left", "seconds": float("nan")})
+    return pd.DataFrame(results)
+
+def summarise(results):
+    # Mean and standard deviation over the runs of each model
+    metrics = [column for column in ("d1_f1", "d1_accuracy", "d2_f1", "d2_accuracy") if column in results]
+    done = results[results["error"].isna()] if "error" in results else results
+    return done.groupby("model")[metrics].agg(["mean", "std", "count"])
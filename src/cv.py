@@ -0,0 +1,72 @@
+import argparse
+import runtime
+
+"""
+This script estimates how much the F1 scores depend on the split: it trains
+the multi-task model and/or Strategy 1 on k stratified folds (--folds) or on
+the 80/20 split of several seeds (--seeds), and prints the mean and
+standard deviation of the F1 and accuracy of each model over the runs.
+
+The tweets are tokenized once and shared with the worker processes through
+shared memory (see crossval.py). --workers runs that many folds at a time,
+each worker pinned to its share of the cores (--cpus or all available ones).
+One row per run is written to <dir>/predicts/cv_results.csv. Runs are not
+logged to wandb and write no checkpoints.
+
+"""
+
+
+parser = argparse.ArgumentParser(description="Cross-validate the multi-task and Strategy 1 models")
+parser.add_argument("dir", help="data directory")
+split = parser.add_mutually_exclusive_group()
+split.add_argument("--folds", type=int, default=None, help="number of stratified folds (default 5)")
+split.add_argument("--seeds", type=int, nargs="+", default=None,
+                   help="one 80/20 split per seed instead of folds, e.g. 2023 2024 2025")
+parser.add_argument("--models", nargs="+", choices=["hydra", "strategy1"], default=["hydra", "strategy1"])
+parser.add_argument("--workers", type=int, default=2, help="runs trained at the same time")
+parser.add_argument("--epochs", type=int, default=None, help="epochs per run (default: as the training scripts)")
+parser.add_argument("--no-dedup", action="store_true",
+                    help="train on every copy of repeated tweets instead of weighted unique rows")
+parser.add_argument("--output", default=None, help="results CSV (default: <dir>/predicts/cv_results.csv)")
+runtime.add_runtime_args(parser)
+args = parser.parse_args()
+dir = args.dir
+if args.seeds is None and args.folds is None:
+    args.folds = 5
+
+# Heavy dependencies are imported once the arguments are parsed, so --help
+# and argument errors return without loading them
+import os
+import numpy as np
+import pandas as pd
+from transformers import RobertaTokenizer
+from tweet_data import read_disaster, read_sentiment
+from trainers import HydraConfig
+from crossval import tokenize_tweets, build_runs, run_cv, summarise
+
+if __name__ == "__main__":
+    # Only restricts the cores the workers split between them
+    runtime.configure_from_args(args)
+
+    epochs = {"epochs": args.epochs} if args.epochs else {}
+    configs = {"hydra": HydraConfig(dir, dedup=not args.no_dedup, wandb_project=None, checkpoint_steps=0, **epochs)}
+    if "strategy1" in args.models:
+        from strategy1 import Strategy1Config
+        configs["strategy1"] = Strategy1Config(dir, **epochs)
+
+    d_frame = read_disaster(dir).reset_index(drop=True)
+    s_frame = read_sentiment(dir).reset_index(drop=True)
+    tokenizer = RobertaTokenizer.from_pretrained(configs["hydra"].encoder, do_lower_case=True)
+    tokens = tokenize_tweets(tokenizer, pd.concat([d_frame.text, s_frame.text]).tolist(), configs["hydra"].max_len)
+    tables = {"target": np.concatenate([d_frame.target.to_numpy(dtype=np.float64), np.full(len(s_frame), np.nan)]),
+              "sentiment": np.concatenate([np.full(len(d_frame), np.nan), s_frame.target.to_numpy(dtype=np.float64)])}
+    print(f"Tokenized {len(tokens)} tweets once, {tokens.flat.numel()} tokens, longest {tokens.max_length}")
+
+    runs = build_runs(d_frame, s_frame, folds=args.folds, seeds=args.seeds or (2023,), dedup=not args.no_dedup)
+    results = run_cv(runs, tokens, tables, configs, models=args.models, workers=args.workers)
+
+    output = args.output or f"{dir}/predicts/cv_results.csv"
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    results.to_csv(output, index=False)
+    print(summarise(results).to_string())
+    print(f"Wrote {output}")
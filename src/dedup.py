@@ -0,0 +1,38 @@
+from tweet_text import normalise_text
+
+"""
+Collapses repeated training tweets into one row per (normalised text, label)
+with a `weight` column holding how often it occurred. Training on the
+weighted rows with a weighted loss gives the same objective as training on
+every copy, while each epoch tokenizes and forwards fewer rows.
+
+Tweets that appear with more than one label are kept as one row per label
+and flagged in the `conflict` column.
+
+"""
+
+
+def dedup_weighted(df, label="target"):
+    data = df.copy()
+    data["text_key"] = data.text.astype(str).map(normalise_text)
+    deduped = (data.groupby(["text_key", label], sort=False, dropna=False)
+                   .agg(text=("text", "first"), weight=("text", "size"))
+                   .reset_index())
+    deduped["conflict"] = deduped.groupby("text_key")[label].transform("size") > 1
+    deduped["weight"] = deduped["weight"].astype("float32")
+    return deduped[["text", label, "weight", "conflict"]]
+
+def print_dedup_summary(name, original, deduped, label="target", examples=5):
+    conflicts = deduped[deduped.conflict]
+    print(f"{name}: {len(original)} rows -> {len(deduped)} unique, "
+          f"{conflicts.text.nunique()} texts with conflicting labels")
+    if len(conflicts):
+        print(conflicts[["text", label, "weight"]].head(examples).to_string(index=False))
+
+def dedup_task(name, df, label="target", enabled=True):
+    # Rows for one task, with a weight column either way
+    if not enabled:
+        return df.assign(weight=1.0)
+    deduped = dedup_weighted(df, label)
+    print_dedup_summary(name, df, deduped, label)
+    return deduped.drop(columns=["conflict"])
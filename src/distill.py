@@ -0,0 +1,273 @@
+import os
+import sys
+import time
+import argparse
+import hashlib
+import runtime
+from tweet_text import normalise_text
+from prediction_cache import model_version
+
+"""
+This script distills a trained multi-task model (the teacher, written by
+multitask_hydra.py) into a smaller student for low-latency CPU scoring.
+The student learns both heads on every training tweet from the softened
+teacher logits, mixed with the hard labels of the tweet's own task:
+
+    loss = alpha * T^2 * KL(teacher / T || student / T) + (1 - alpha) * CE(labels)
+
+Teacher logits are computed once and cached under <dir>/models/teacher_logits,
+keyed by the teacher files and the tweets, so further students (other sizes,
+temperatures) skip the teacher entirely. The student is a pretrained small
+encoder (distilroberta-base by default), optionally cut to its first
+--student-layers layers.
+
+The teacher and the student are compared on the validation split (F1,
+accuracy, parameters, ms per tweet at batch size 1 and --batch-size), the
+table is printed and written to <dir>/predicts/distill_report.csv, and the
+student is saved as a checkpoint that hydra_inference.py and serve.py load.
+
+"""
+
+
+def encode(tokenizer, texts, max_len):
+    # Token ids without padding, batches are padded to their longest tweet
+    return tokenizer([normalise_text(text) for text in texts], truncation=True, max_length=max_len)["input_ids"]
+
+def batches(input_ids, batch_size, pad_id, order=None):
+    order = np.arange(len(input_ids)) if order is None else order
+    for start in range(0, len(order), batch_size):
+        index = order[start:start + batch_size]
+        length = max(len(input_ids[i]) for i in index)
+        ids = torch.full((len(index), length), pad_id, dtype=torch.long)
+        mask = torch.zeros((len(index), length), dtype=torch.long)
+        for row, i in enumerate(index):
+            ids[row, :len(input_ids[i])] = torch.tensor(input_ids[i])
+            mask[row, :len(input_ids[i])] = 1
+        yield index, ids.to(device), mask.to(device)
+
+def predict_logits(model, input_ids, batch_size, pad_id):
+    model.eval()
+    logits1 = np.zeros((len(input_ids), model.num_labels1), dtype=np.float32)
+    logits2 = np.zeros((len(input_ids), model.num_labels2), dtype=np.float32)
+    # Sorted by length so that batches carry little padding
+    order = np.argsort([len(ids) for ids in input_ids], kind="stable")
+    with torch.no_grad():
+        for index, ids, mask in tqdm(batches(input_ids, batch_size, pad_id, order),
+                                     total=(len(order) + batch_size - 1) // batch_size):
+            output1, output2 = model(ids, mask)
+            logits1[index] = output1.float().cpu().numpy()
+            logits2[index] = output2.float().cpu().numpy()
+    return logits1, logits2
+
+def teacher_logits(teacher, tokenizer, texts, max_len, batch_size, cache_dir, version):
+    key = hashlib.sha1(f"{version}:{max_len}".encode())
+    for text in texts:
+        key.update(normalise_text(text).encode() + b"\0")
+    filename = os.path.join(cache_dir, f"{key.hexdigest()[:16]}.npz")
+    if os.path.exists(filename):
+        print(f"Loading cached teacher logits from {filename}")
+        cached = np.load(filename)
+        return cached["logits1"], cached["logits2"]
+
+    logits1, logits2 = predict_logits(teacher, encode(tokenizer, texts, max_len), batch_size, tokenizer.pad_token_id)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(filename, logits1=logits1, logits2=logits2)
+    return logits1, logits2
+
+def distill_loss(student_logits, teacher_logits, temperature):
+    # Per-row KL divergence to the softened teacher, scaled by T^2 to keep the
+    # gradient magnitude independent of the temperature
+    return F.kl_div(F.log_softmax(student_logits / temperature, dim=1),
+                    F.softmax(teacher_logits / temperature, dim=1),
+                    reduction="none").sum(dim=1) * temperature ** 2
+
+def hard_loss(logits, targets):
+    # Cross-entropy on the rows labelled for the task, zero elsewhere
+    rows = ~torch.isnan(targets)
+    loss = F.cross_entropy(logits, torch.where(rows, targets, torch.zeros_like(targets)).long(), reduction="none")
+    return loss * rows
+
+def train_student(student, input_ids, logits1, logits2, targets, sentiment, weights, epoch):
+    student.train()
+    order = np.random.default_rng(2023 + epoch).permutation(len(input_ids))
+    for index, ids, mask in tqdm(batches(input_ids, TRAIN_BATCH_SIZE, student_tokenizer.pad_token_id, order),
+                                 total=(len(order) + TRAIN_BATCH_SIZE - 1) // TRAIN_BATCH_SIZE):
+        output1, output2 = student(ids, mask)
+        teacher1 = torch.from_numpy(logits1[index]).to(device)
+        teacher2 = torch.from_numpy(logits2[index]).to(device)
+        weight = torch.from_numpy(weights[index]).to(device)
+
+        soft = distill_loss(output1, teacher1, TEMPERATURE) + distill_loss(output2, teacher2, TEMPERATURE)
+        hard = (hard_loss(output1, torch.from_numpy(targets[index]).to(device))
+                + hard_loss(output2, torch.from_numpy(sentiment[index]).to(device)))
+        loss = ((ALPHA * soft + (1 - ALPHA) * hard) * weight).sum() / weight.sum()
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        wandb.log({"train_loss": loss.item(),
+                   "train_soft_loss": (soft * weight).sum().item() / weight.sum().item(),
+                   "train_hard_loss": (hard * weight).sum().item() / weight.sum().item()})
+
+def task_metrics(logits, targets):
+    rows = ~np.isnan(targets)
+    return metrics_from_confusion(confusion_matrix(targets[rows].astype(np.int64),
+                                                   logits[rows].argmax(axis=1), logits.shape[1]))
+
+def ms_per_tweet(model, input_ids, batch_size, pad_id):
+    model.eval()
+    with torch.no_grad():
+        # Warm-up batch, not timed
+        for _, ids, mask in batches(input_ids[:batch_size], batch_size, pad_id):
+            model(ids, mask)
+        start = time.perf_counter()
+        for _, ids, mask in batches(input_ids, batch_size, pad_id):
+            model(ids, mask)
+    return (time.perf_counter() - start) * 1000 / len(input_ids)
+
+def report_row(name, model, tokenizer, logits1, logits2):
+    d1_metrics = task_metrics(logits1, val_targets)
+    d2_metrics = task_metrics(logits2, val_sentiment)
+    bench_ids = encode(tokenizer, bench_texts, MAX_LEN)
+    return {"model": name,
+            "encoder": model.encoder_name,
+            "layers": model.net.config.num_hidden_layers,
+            "params_m": sum(p.numel() for p in model.parameters()) / 1e6,
+            "d1_f1": d1_metrics["f1_weighted"],
+            "d1_accuracy": d1_metrics["accuracy"],
+            "d2_f1": d2_metrics["f1_weighted"],
+            "d2_accuracy": d2_metrics["accuracy"],
+            "ms_per_tweet_b1": ms_per_tweet(model, bench_ids, 1, tokenizer.pad_token_id),
+            f"ms_per_tweet_b{VALID_BATCH_SIZE}": ms_per_tweet(model, bench_ids, VALID_BATCH_SIZE,
+                                                              tokenizer.pad_token_id)}
+
+parser = argparse.ArgumentParser(description="Distill the multi-task model into a smaller student")
+parser.add_argument("dir", help="data directory")
+parser.add_argument("--teacher", default=None, help="teacher checkpoint (default: <dir>/models/net_hydra)")
+parser.add_argument("--student", default="distilroberta-base", help="pretrained encoder of the student")
+parser.add_argument("--student-layers", type=int, default=None,
+                    help="keep only the first N encoder layers of the student")
+parser.add_argument("--output", default=None, help="student checkpoint (default: <dir>/models/net_student)")
+parser.add_argument("--temperature", type=float, default=2.0)
+parser.add_argument("--alpha", type=float, default=0.5, help="weight of the distillation loss against the labels")
+parser.add_argument("--epochs", type=int, default=3)
+parser.add_argument("--batch-size", type=int, default=32)
+parser.add_argument("--bench-tweets", type=int, default=256, help="validation tweets timed for the latency report")
+parser.add_argument("--no-dedup", action="store_true",
+                    help="train on every copy of repeated tweets instead of weighted unique rows")
+runtime.add_runtime_args(parser)
+args = parser.parse_args()
+dir = args.dir
+
+# Heavy dependencies are imported once the arguments are parsed, so --help
+# and argument errors return without loading them
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from torch import cuda
+from tqdm import tqdm
+from transformers import RobertaTokenizer
+import wandb
+from hydra_model import NetMultiTask, DISASTER_LABELS, SENTIMENT_LABELS
+from checkpoint import load_checkpoint, load_tokenizer, save_checkpoint
+from metrics import confusion_matrix, metrics_from_confusion
+from tweet_data import load_splits, combine_tasks
+device = 'cuda' if cuda.is_available() else 'cpu'
+
+runtime.configure_from_args(args)
+
+teacher_path = args.teacher or f"{dir}/models/net_hydra"
+output_path = args.output or f"{dir}/models/net_student"
+
+teacher, teacher_config = load_checkpoint(teacher_path, device=device)
+if teacher.tasks != (1, 2):
+    sys.exit(f"{teacher_path} has the heads of tasks {teacher.tasks}, the teacher needs both")
+teacher_tokenizer = load_tokenizer(teacher_path)
+
+MAX_LEN = teacher_config["max_len"] or 512
+TRAIN_BATCH_SIZE = args.batch_size
+VALID_BATCH_SIZE = args.batch_size
+LEARNING_RATE = 5e-05
+EPOCHS = args.epochs
+TEMPERATURE = args.temperature
+ALPHA = args.alpha
+
+with open(f"{dir}/wandb_key.txt", "r") as f:
+    wandb_key = f.read()
+
+wandb.login(key=wandb_key)
+
+# Same splits as multitask_hydra.py, so the teacher never saw the validation tweets
+splits = load_splits(dir, dedup=not args.no_dedup)
+sd_train_data = combine_tasks(splits.d_train, splits.s_train)
+sd_val_data = combine_tasks(splits.d_val, splits.s_val)
+
+train_texts = sd_train_data.text.astype(str).tolist()
+val_texts = sd_val_data.text.astype(str).tolist()
+train_targets = sd_train_data.target.to_numpy(dtype=np.float32)
+train_sentiment = sd_train_data.sentiment.to_numpy(dtype=np.float32)
+train_weights = sd_train_data.weight.to_numpy(dtype=np.float32)
+val_targets = sd_val_data.target.to_numpy(dtype=np.float32)
+val_sentiment = sd_val_data.sentiment.to_numpy(dtype=np.float32)
+bench_texts = val_texts[:args.bench_tweets]
+
+# Teacher logits, computed once per teacher and data
+cache_dir = f"{dir}/models/teacher_logits"
+version = model_version(teacher_path)
+train_logits1, train_logits2 = teacher_logits(teacher, teacher_tokenizer, train_texts, MAX_LEN,
+                                              VALID_BATCH_SIZE, cache_dir, version)
+val_teacher1, val_teacher2 = teacher_logits(teacher, teacher_tokenizer, val_texts, MAX_LEN,
+                                            VALID_BATCH_SIZE, cache_dir, version)
+
+student_tokenizer = RobertaTokenizer.from_pretrained(args.student)
+student = NetMultiTask(encoder=args.student)
+if args.student_layers is not None:
+    student.net.encoder.layer = student.net.encoder.layer[:args.student_layers]
+    student.net.config.num_hidden_layers = len(student.net.encoder.layer)
+student.to(device)
+train_ids = encode(student_tokenizer, train_texts, MAX_LEN)
+val_ids = encode(student_tokenizer, val_texts, MAX_LEN)
+
+optimizer = torch.optim.Adam(params = student.parameters(), lr = LEARNING_RATE)
+
+wandb.init(
+        project="bt5151_distill",
+        group=args.student,
+        config={
+            "epochs": EPOCHS,
+            "batch_size": TRAIN_BATCH_SIZE,
+            "lr": LEARNING_RATE,
+            "optimizer": "Adam",
+            "student": args.student,
+            "student_layers": student.net.config.num_hidden_layers,
+            "temperature": TEMPERATURE,
+            "alpha": ALPHA,
+            "max_length": MAX_LEN,
+            "dedup": not args.no_dedup,
+            })
+
+for epoch in range(EPOCHS):
+    train_student(student, train_ids, train_logits1, train_logits2,
+                  train_targets, train_sentiment, train_weights, epoch)
+    val_logits1, val_logits2 = predict_logits(student, val_ids, VALID_BATCH_SIZE, student_tokenizer.pad_token_id)
+    d1_metrics = task_metrics(val_logits1, val_targets)
+    d2_metrics = task_metrics(val_logits2, val_sentiment)
+    wandb.log({"d1_test_f1": d1_metrics["f1_weighted"], "d1_test_accuracy": d1_metrics["accuracy"]*100,
+               "d2_test_f1": d2_metrics["f1_weighted"], "d2_test_accuracy": d2_metrics["accuracy"]*100})
+    print(f"Epoch {epoch}: D1 F1 {d1_metrics['f1_weighted']:.4f}, D2 F1 {d2_metrics['f1_weighted']:.4f}")
+print('Finished training')
+
+save_checkpoint(student, output_path, tokenizer=student_tokenizer, max_len=MAX_LEN,
+                label_maps={"disaster": DISASTER_LABELS, "sentiment": SENTIMENT_LABELS})
+
+# Speed / F1 trade-off of the two serving tiers
+report = pd.DataFrame([report_row("teacher", teacher, teacher_tokenizer, val_teacher1, val_teacher2),
+                       report_row("student", student, student_tokenizer, val_logits1, val_logits2)])
+report["speedup_b1"] = report.ms_per_tweet_b1.iloc[0] / report.ms_per_tweet_b1
+print(report.to_string(index=False))
+os.makedirs(f"{dir}/predicts", exist_ok=True)
+report.to_csv(f"{dir}/predicts/distill_report.csv", index=False)
+wandb.log({"distill_report": wandb.Table(dataframe=report)})
+wandb.finish()
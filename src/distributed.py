@@ -0,0 +1,102 @@
+import os
+import math
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+"""
+Helpers for running the training scripts under torchrun. When the script is
+launched without torchrun every helper falls back to single-process behaviour,
+so the same code path is used in both cases.
+
+    torchrun --nnodes 2 --nproc_per_node 4 --rdzv_backend c10d \
+        --rdzv_endpoint host:29400 src/multitask_hydra.py <dir>
+
+"""
+
+
+def init_distributed(backend="gloo"):
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=os.environ.get("DIST_BACKEND", backend))
+    return get_rank(), get_world_size()
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_local_rank():
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def all_reduce_sum(values):
+    # Sums a list of python numbers over all ranks and returns a list of floats
+    if not is_distributed():
+        return [float(v) for v in values]
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+class ShardSampler(Sampler):
+    # Contiguous shard of the dataset for this rank, in order. Unlike DistributedSampler
+    # nothing is padded, so every example is counted by exactly one rank; shard sizes
+    # differ by one at most.
+    def __init__(self, dataset):
+        rank, world_size = get_rank(), get_world_size()
+        self.start = len(dataset) * rank // world_size
+        self.end = len(dataset) * (rank + 1) // world_size
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
+
+class ResumableSampler(Sampler):
+    # Same ordering and sharding as DistributedSampler (a seeded RandomSampler
+    # when not distributed), but an epoch can be started part way through so a
+    # resumed run sees exactly the batches it had left.
+    def __init__(self, dataset, shuffle=True, seed=0):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = get_world_size()
+        self.rank = get_rank()
+        self.num_samples = math.ceil(len(dataset) / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        # Pad so every rank gets the same number of samples
+        indices += indices[:(self.total_size - len(indices))]
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+        return iter(indices[self.start_index:])
+
+    def __len__(self):
+        return self.num_samples - self.start_index
@@ -0,0 +1,147 @@
+import argparse
+import time
+import runtime
+from tweet_text import normalise_text
+
+"""
+This script adds early-exit classifiers to a trained multi-task checkpoint.
+Each exit is a linear Task 1 classifier on the CLS state after one encoder
+layer. They are trained post-hoc with the encoder frozen: the CLS states of
+the exit layers are computed once for the training tweets and the exits are
+fitted on them, so training takes minutes and leaves the full model's
+predictions unchanged.
+
+The model with exits is saved as a new checkpoint, and every --thresholds
+value is evaluated on the validation split with forward_early_exit: average
+layers used, F1/accuracy against the full model and ms per tweet at
+--eval-batch-size. The table is printed and written to
+<dir>/predicts/early_exit_report.csv. Serve the checkpoint with
+hydra_inference.py or serve.py and --exit-threshold.
+
+"""
+
+
+def tokenize(tokenizer, texts, max_len):
+    return tokenizer([normalise_text(text) for text in texts], padding=True, truncation=True,
+                     max_length=max_len, return_tensors="pt")
+
+def exit_features(model, tokenizer, texts, layers, max_len, batch_size, device):
+    # CLS state after each exit layer, the encoder is frozen so this is computed once
+    features = {layer: [] for layer in layers}
+    with torch.no_grad():
+        for start in tqdm(range(0, len(texts), batch_size)):
+            inputs = tokenize(tokenizer, texts[start:start + batch_size], max_len)
+            output = model.net(input_ids=inputs["input_ids"].to(device),
+                               attention_mask=inputs["attention_mask"].to(device), output_hidden_states=True)
+            for layer in layers:
+                features[layer].append(output.hidden_states[layer][:, 0].float().cpu())
+    return {layer: torch.cat(values) for layer, values in features.items()}
+
+def train_exit(features, targets, weights, num_labels, epochs, batch_size, lr):
+    head = torch.nn.Linear(features.size(1), num_labels)
+    optimizer = torch.optim.Adam(head.parameters(), lr=lr)
+    loss_function = torch.nn.CrossEntropyLoss(reduction='none')
+    generator = torch.Generator().manual_seed(2023)
+    for _ in range(epochs):
+        for index in torch.randperm(len(features), generator=generator).split(batch_size):
+            loss = (loss_function(head(features[index]), targets[index]) * weights[index]).sum() / weights[index].sum()
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    return head
+
+def evaluate(model, tokenizer, texts, targets, threshold, max_len, batch_size, device):
+    # threshold None runs the full model
+    predicts = np.empty(len(texts), dtype=np.int64)
+    layers_used = np.empty(len(texts), dtype=np.int64)
+    model.eval()
+    with torch.no_grad():
+        start_time = time.perf_counter()
+        for start in range(0, len(texts), batch_size):
+            inputs = tokenize(tokenizer, texts[start:start + batch_size], max_len)
+            ids, mask = inputs["input_ids"].to(device), inputs["attention_mask"].to(device)
+            if threshold is None:
+                logits, _ = model(ids, mask)
+                used = torch.full((ids.size(0),), model.net.config.num_hidden_layers)
+            else:
+                logits, used = model.forward_early_exit(ids, mask, threshold)
+            predicts[start:start + len(used)] = logits.argmax(dim=1).cpu().numpy()
+            layers_used[start:start + len(used)] = used.numpy()
+        elapsed = time.perf_counter() - start_time
+    metrics = metrics_from_confusion(confusion_matrix(targets, predicts, model.num_labels1))
+    return {"threshold": "full" if threshold is None else threshold,
+            "average_layers": layers_used.mean(),
+            "d1_f1": metrics["f1_weighted"],
+            "d1_accuracy": metrics["accuracy"],
+            "ms_per_tweet": elapsed * 1000 / len(texts)}
+
+parser = argparse.ArgumentParser(description="Train early-exit classifiers for the multi-task model")
+parser.add_argument("dir", help="data directory")
+parser.add_argument("--checkpoint", default=None, help="checkpoint directory (default: <dir>/models/net_hydra)")
+parser.add_argument("--output", default=None, help="checkpoint with exits (default: <dir>/models/net_hydra_exit)")
+parser.add_argument("--exit-layers", default="3,6,9", help="comma separated encoder layers to attach exits to")
+parser.add_argument("--thresholds", default="0.8,0.9,0.95,0.99", help="comma separated confidence thresholds to report")
+parser.add_argument("--epochs", type=int, default=5)
+parser.add_argument("--batch-size", type=int, default=32)
+parser.add_argument("--eval-batch-size", type=int, default=1, help="batch size of the latency measurement")
+parser.add_argument("--no-dedup", action="store_true",
+                    help="train on every copy of repeated tweets instead of weighted unique rows")
+runtime.add_runtime_args(parser)
+args = parser.parse_args()
+dir = args.dir
+
+# Heavy dependencies are imported once the arguments are parsed, so --help
+# and argument errors return without loading them
+import numpy as np
+import pandas as pd
+import torch
+from torch import cuda
+from tqdm import tqdm
+from checkpoint import load_checkpoint, load_tokenizer, save_checkpoint
+from metrics import confusion_matrix, metrics_from_confusion
+from tweet_data import load_splits
+device = 'cuda' if cuda.is_available() else 'cpu'
+
+runtime.configure_from_args(args)
+
+checkpoint = args.checkpoint or f"{dir}/models/net_hydra"
+output_path = args.output or f"{dir}/models/net_hydra_exit"
+exit_layers = sorted(int(layer) for layer in args.exit_layers.split(","))
+thresholds = [float(threshold) for threshold in args.thresholds.split(",")]
+
+model, config = load_checkpoint(checkpoint, device=device)
+model.eval()
+tokenizer = load_tokenizer(checkpoint)
+MAX_LEN = config["max_len"] or 512
+LEARNING_RATE = 1e-03
+if any(layer < 1 or layer >= model.net.config.num_hidden_layers for layer in exit_layers):
+    parser.error(f"--exit-layers must be between 1 and {model.net.config.num_hidden_layers - 1}")
+
+# Same split as the training scripts
+splits = load_splits(dir, dedup=not args.no_dedup)
+d_train_data, d_val_data = splits.d_train, splits.d_val
+
+train_texts = d_train_data.text.astype(str).tolist()
+train_targets = torch.tensor(d_train_data.target.to_numpy(), dtype=torch.long)
+train_weights = torch.tensor(d_train_data.weight.to_numpy(), dtype=torch.float)
+
+features = exit_features(model, tokenizer, train_texts, exit_layers, MAX_LEN, args.batch_size, device)
+model.exit_layers = tuple(exit_layers)
+model.exits = torch.nn.ModuleDict({str(layer): train_exit(features[layer], train_targets, train_weights,
+                                                          model.num_labels1, args.epochs, args.batch_size,
+                                                          LEARNING_RATE)
+                                   for layer in exit_layers}).to(device)
+save_checkpoint(model, output_path, tokenizer=tokenizer, max_len=MAX_LEN, label_maps=config["label_maps"])
+print(f"Saved {output_path} with exits after layers {exit_layers}")
+
+# Accuracy impact and latency of each threshold against the full model
+val_texts = d_val_data.text.astype(str).tolist()
+val_targets = d_val_data.target.to_numpy(dtype=np.int64)
+rows = [evaluate(model, tokenizer, val_texts, val_targets, threshold, MAX_LEN, args.eval_batch_size, device)
+        for threshold in [None] + thresholds]
+report = pd.DataFrame(rows)
+report["d1_f1_change"] = report.d1_f1 - report.d1_f1.iloc[0]
+report["d1_accuracy_change"] = report.d1_accuracy - report.d1_accuracy.iloc[0]
+report["speedup"] = report.ms_per_tweet.iloc[0] / report.ms_per_tweet
+print(report.to_string(index=False))
+report.to_csv(f"{dir}/predicts/early_exit_report.csv", index=False)
@@ -0,0 +1,210 @@
+import os
+import json
+import math
+import time
+import numpy as np
+import pandas as pd
+from prediction_writer import PredictionWriter
+
+"""
+Tweet embeddings and a nearest-neighbour index over them, for finding the
+past tweets most similar to a new one without running the model on the
+corpus again.
+
+export_embeddings writes the pooled <s> vector of every tweet (the state
+the heads of NetMultiTask read, see HydraPredictor.embed) to a float16
+.npy matrix filled through a memory map, with the ids and texts of its
+rows in tweets.csv. Both are opened memory-mapped, so a corpus larger than
+memory can be searched.
+
+IVFIndex is an inverted-file index built with NumPy: spherical k-means
+(on a sample of the rows) splits the unit vectors into `lists` clusters,
+and a query computes the cosine similarity to the rows of the `nprobe`
+clusters whose centroids are closest to it only. exact_search scans every
+row, benchmark compares the two for query latency and recall@k.
+
+    export_embeddings(predictor, [f"{dir}/train.csv"], out_dir)
+    embeddings = load_embeddings(out_dir)
+    index = IVFIndex.build(embeddings)
+    index.save(out_dir)
+    rows, scores = IVFIndex.load(out_dir).search(embeddings, predictor.embed(texts), k=10)
+
+"""
+
+EMBEDDINGS_NAME = "embeddings.npy"
+TWEETS_NAME = "tweets.csv"
+META_NAME = "embeddings.json"
+INDEX_NAME = "index.json"
+INDEX_ARRAYS = ("centroids", "order", "offsets", "norms")
+
+
+def count_rows(paths, chunk_size=10000):
+    return sum(len(chunk) for path in paths for chunk in pd.read_csv(path, usecols=["id"], chunksize=chunk_size))
+
+def export_embeddings(predictor, paths, out_dir, batch_size=64, chunk_size=10000, progress=None):
+    # Embeds the tweets (id and text columns) of the CSV files `paths` into out_dir, returns the row count
+    os.makedirs(out_dir, exist_ok=True)
+    rows = count_rows(paths, chunk_size)
+    dim = predictor.model.net.config.hidden_size
+    final = os.path.join(out_dir, EMBEDDINGS_NAME)
+    partial = f"{final}.partial"
+    matrix = np.lib.format.open_memmap(partial, mode="w+", dtype=np.float16, shape=(rows, dim))
+    row = 0
+    with PredictionWriter(os.path.join(out_dir, TWEETS_NAME)) as writer:
+        for path in paths:
+            for chunk in pd.read_csv(path, chunksize=chunk_size):
+                ids, texts = chunk["id"].tolist(), chunk.text.astype(str).tolist()
+                for start in range(0, len(texts), batch_size):
+                    vectors = predictor.embed(texts[start:start + batch_size])
+                    matrix[row:row + len(vectors)] = vectors
+                    row += len(vectors)
+                    if progress is not None:
+                        progress.update(len(vectors))
+                writer.write(pd.DataFrame({"text": texts}, index=pd.Index(ids, name="id")))
+    matrix.flush()
+    del matrix
+    os.replace(partial, final)
+    return rows
+
+def load_embeddings(out_dir):
+    return np.load(os.path.join(out_dir, EMBEDDINGS_NAME), mmap_mode="r")
+
+def load_tweets(out_dir):
+    return pd.read_csv(os.path.join(out_dir, TWEETS_NAME))
+
+def write_meta(out_dir, meta):
+    with open(os.path.join(out_dir, META_NAME), "w") as f:
+        json.dump(meta, f, indent=2)
+
+def load_meta(out_dir):
+    with open(os.path.join(out_dir, META_NAME), "r") as f:
+        return json.load(f)
+
+def unit(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+def row_norms(embeddings, block=65536):
+    norms = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), block):
+        norms[start:start + block] = np.linalg.norm(embeddings[start:start + block].astype(np.float32), axis=1)
+    return np.maximum(norms, 1e-12)
+
+def top_k(scores, k):
+    # Indices of the k largest scores, best first
+    k = min(k, len(scores))
+    best = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind="stable")]
+
+
+class IVFIndex:
+    def __init__(self, centroids, order, offsets, norms, build_seconds=0.0):
+        self.centroids = centroids
+        # Row numbers grouped by cluster, those of cluster c are order[offsets[c]:offsets[c + 1]]
+        self.order = order
+        self.offsets = offsets
+        self.norms = norms
+        self.build_seconds = build_seconds
+
+    @property
+    def lists(self):
+        return len(self.centroids)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in INDEX_ARRAYS)
+
+    @classmethod
+    def build(cls, embeddings, lists=None, iterations=10, sample_size=50000, seed=2023, block=65536):
+        # About 4 * sqrt(rows) clusters by default, trained on at most sample_size rows
+        start = time.perf_counter()
+        rows = len(embeddings)
+        if rows == 0:
+            raise ValueError("No embeddings to index")
+        rng = np.random.default_rng(seed)
+        sample = unit(embeddings[np.sort(rng.choice(rows, min(rows, sample_size), replace=False))])
+        lists = min(lists or max(int(4 * math.sqrt(rows)), 1), len(sample))
+        centroids = sample[rng.choice(len(sample), lists, replace=False)]
+        for _ in range(iterations):
+            labels = cls._assign(sample, centroids, block)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=lists) == 0
+            # Empty clusters restart from random rows
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = unit(sums)
+
+        labels = np.concatenate([cls._assign(unit(embeddings[i:i + block]), centroids, block)
+                                 for i in range(0, rows, block)])
+        order = np.argsort(labels, kind="stable").astype(np.int64)
+        offsets = np.zeros(lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(labels, minlength=lists))
+        return cls(centroids, order, offsets, row_norms(embeddings, block), time.perf_counter() - start)
+
+    @staticmethod
+    def _assign(vectors, centroids, block):
+        return np.concatenate([np.argmax(vectors[i:i + block] @ centroids.T, axis=1)
+                               for i in range(0, len(vectors), block)])
+
+    def save(self, out_dir):
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(out_dir, f"ivf_{name}.npy"), getattr(self, name))
+        with open(os.path.join(out_dir, INDEX_NAME), "w") as f:
+            json.dump({"lists": self.lists, "rows": len(self.order), "build_seconds": self.build_seconds}, f, indent=2)
+
+    @classmethod
+    def load(cls, out_dir):
+        with open(os.path.join(out_dir, INDEX_NAME), "r") as f:
+            info = json.load(f)
+        arrays = {name: np.load(os.path.join(out_dir, f"ivf_{name}.npy"), mmap_mode="r") for name in INDEX_ARRAYS}
+        return cls(np.asarray(arrays["centroids"]), arrays["order"], np.asarray(arrays["offsets"]),
+                   arrays["norms"], info["build_seconds"])
+
+    def search(self, embeddings, queries, k=10, nprobe=8):
+        # (rows, cosine similarities) [len(queries), k] of the nearest rows among the nprobe
+        # closest clusters, padded with -1 and -inf when they hold fewer than k rows
+        queries = unit(np.atleast_2d(queries))
+        nprobe = min(nprobe, self.lists)
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        found = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, (query, probe) in enumerate(zip(queries, probes)):
+            candidates = np.sort(np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe]))
+            if len(candidates) == 0:
+                continue
+            similarity = (embeddings[candidates].astype(np.float32) @ query) / self.norms[candidates]
+            best = top_k(similarity, k)
+            found[q, :len(best)] = candidates[best]
+            scores[q, :len(best)] = similarity[best]
+        return found, scores
+
+def exact_search(embeddings, norms, queries, k=10, block=65536):
+    # Same as IVFIndex.search, scanning every row
+    queries = unit(np.atleast_2d(queries))
+    similarity = np.empty((len(queries), len(embeddings)), dtype=np.float32)
+    for start in range(0, len(embeddings), block):
+        similarity[:, start:start + block] = (queries @ embeddings[start:start + block].astype(np.float32).T
+                                              / norms[start:start + block])
+    found = np.full((len(queries), k), -1, dtype=np.int64)
+    scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    for q in range(len(queries)):
+        best = top_k(similarity[q], k)
+        found[q, :len(best)], scores[q, :len(best)] = best, similarity[q, best]
+    return found, scores
+
+def benchmark(index, embeddings, queries, k=10, nprobe=8):
+    # Latency of one query at a time, index against exact scan, and recall@k of the index
+    index_ms, exact_ms, recall = [], [], []
+    for query in queries:
+        start = time.perf_counter()
+        found, _ = index.search(embeddings, query, k, nprobe)
+        index_ms.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        expected, _ = exact_search(embeddings, index.norms, query, k)
+        exact_ms.append((time.perf_counter() - start) * 1000)
+        expected = set(expected[0][expected[0] >= 0])
+        recall.append(len(expected & set(found[0])) / max(len(expected), 1))
+    return {"queries": len(queries), "k": k, "nprobe": nprobe,
+            "index_p50_ms": float(np.percentile(index_ms, 50)), "index_p95_ms": float(np.percentile(index_ms, 95)),
+            "exact_p50_ms": float(np.percentile(exact_ms, 50)), "exact_p95_ms": float(np.percentile(exact_ms, 95)),
+            f"recall@{k}": float(np.mean(recall))}
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import torch
+from metrics import confusion_matrix, metrics_from_confusion
+
+"""
+Collects the predictions of a validation loop. Each batch is reduced to its
+argmax (and optionally its softmax probabilities) on the device and copied
+into preallocated arrays in one transfer, instead of one .item() per example.
+Metrics are computed once, vectorized, at the end. Given a
+prediction_writer.PredictionWriter, each batch is also streamed to the
+prediction file as it is collected.
+
+"""
+
+
+class PredictionCollector:
+    def __init__(self, num_classes, size, keep_probs=False, writer=None):
+        # size is an upper bound on the number of examples, e.g. len(dataset)
+        self.num_classes = num_classes
+        self.keep_probs = keep_probs
+        self.writer = writer
+        self.count = 0
+        self._predicts = np.empty(size, dtype=np.int64)
+        self._targets = np.empty(size, dtype=np.int64)
+        self._probs = np.empty((size, num_classes), dtype=np.float32) if keep_probs else None
+
+    def update(self, logits, targets):
+        n = targets.size(0)
+        if n == 0:
+            return
+        end = self.count + n
+        if end > len(self._predicts):
+            self._grow(end)
+        self._predicts[self.count:end] = torch.argmax(logits, dim=1).cpu().numpy()
+        self._targets[self.count:end] = targets.cpu().numpy()
+        if self.keep_probs:
+            self._probs[self.count:end] = torch.softmax(logits.float(), dim=1).cpu().numpy()
+        if self.writer is not None:
+            self.writer.write(self.frame(self.count, end))
+        self.count = end
+
+    def _grow(self, size):
+        size = max(size, 2 * len(self._predicts))
+        self._predicts = np.resize(self._predicts, size)
+        self._targets = np.resize(self._targets, size)
+        if self.keep_probs:
+            self._probs = np.resize(self._probs, (size, self.num_classes))
+
+    @property
+    def predicts(self):
+        return self._predicts[:self.count]
+
+    @property
+    def targets(self):
+        return self._targets[:self.count]
+
+    @property
+    def probs(self):
+        return self._probs[:self.count] if self.keep_probs else None
+
+    def metrics(self):
+        return metrics_from_confusion(confusion_matrix(self.targets, self.predicts, self.num_classes))
+
+    def frame(self, start, end):
+        # Examples start to end, indexed by their position
+        df = pd.DataFrame({"predict": self._predicts[start:end], "target": self._targets[start:end]},
+                          index=pd.RangeIndex(start, end))
+        if self.keep_probs:
+            for label in range(self.num_classes):
+                df[f"prob_{label}"] = self._probs[start:end, label]
+        return df
+
+    def to_frame(self):
+        return self.frame(0, self.count)
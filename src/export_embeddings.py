@@ -0,0 +1,90 @@
+import argparse
+import runtime
+
+"""
+This script exports the embeddings of a tweet corpus with the multi-task
+model checkpoint and builds a nearest-neighbour index over them, see
+embedding_index.py. The pooled vector of every tweet of the --input CSV
+files (id and text columns, default <dir>/train.csv) is written to a
+float16 matrix <output-dir>/embeddings.npy, with the ids and texts in
+tweets.csv, and the IVF index next to them. similar_tweets.py then finds
+the past tweets most similar to new ones from these files.
+
+It reports the time and memory of the export and of the index build, and
+the latency of --bench-queries queries (corpus tweets) through the index
+against an exact scan, with the recall@k of the index. --index-only
+rebuilds the index from existing embeddings, e.g. with other --lists.
+
+"""
+
+
+parser = argparse.ArgumentParser(description="Export tweet embeddings and build a nearest-neighbour index")
+parser.add_argument("dir", help="data directory")
+parser.add_argument("--input", nargs="+", default=None, help="tweet CSV files (default: <dir>/train.csv)")
+parser.add_argument("--checkpoint", default=None, help="checkpoint directory (default: <dir>/models/net_hydra)")
+parser.add_argument("--output-dir", default=None, help="embeddings and index (default: <dir>/embeddings)")
+parser.add_argument("--batch-size", type=int, default=64)
+parser.add_argument("--chunk-size", type=int, default=10000, help="tweets read from a file at a time")
+parser.add_argument("--index-only", action="store_true", help="rebuild the index of the embeddings in --output-dir")
+index_args = parser.add_argument_group("index")
+index_args.add_argument("--lists", type=int, default=None, help="IVF clusters (default: about 4 * sqrt(tweets))")
+index_args.add_argument("--iterations", type=int, default=10, help="k-means iterations")
+index_args.add_argument("--bench-queries", type=int, default=200, help="corpus tweets queried for the benchmark")
+index_args.add_argument("--k", type=int, default=10, help="neighbours per benchmark query")
+index_args.add_argument("--nprobe", type=int, default=8, help="clusters searched per benchmark query")
+runtime.add_runtime_args(parser)
+args = parser.parse_args()
+dir = args.dir
+
+# Heavy dependencies are imported once the arguments are parsed, so --help
+# and argument errors return without loading them
+import os
+import time
+import numpy as np
+import torch
+from tqdm import tqdm
+from prediction_cache import model_version
+from batch_sizing import reset_peak_memory, peak_memory, format_bytes
+from embedding_index import (IVFIndex, export_embeddings, load_embeddings, write_meta, load_meta, benchmark,
+                             EMBEDDINGS_NAME)
+
+runtime.configure_from_args(args)
+
+output_dir = args.output_dir or f"{dir}/embeddings"
+cpu = torch.device("cpu")
+if not args.index_only:
+    from predictor import HydraPredictor
+    checkpoint = args.checkpoint or f"{dir}/models/net_hydra"
+    inputs = args.input or [f"{dir}/train.csv"]
+    predictor = HydraPredictor(checkpoint)
+    reset_peak_memory(cpu)
+    start = time.perf_counter()
+    progress = tqdm(unit="tweets")
+    rows = export_embeddings(predictor, inputs, output_dir, batch_size=args.batch_size, chunk_size=args.chunk_size,
+                             progress=progress)
+    progress.close()
+    seconds = time.perf_counter() - start
+    write_meta(output_dir, {"checkpoint": os.path.abspath(checkpoint), "version": model_version(checkpoint),
+                            "inputs": [os.path.abspath(path) for path in inputs], "rows": rows,
+                            "dim": predictor.model.net.config.hidden_size, "dtype": "float16",
+                            "export_seconds": seconds})
+    print(f"Exported {rows} embeddings in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} tweets/s), "
+          f"{format_bytes(os.path.getsize(os.path.join(output_dir, EMBEDDINGS_NAME)))} on disk, "
+          f"peak memory {format_bytes(peak_memory(cpu))}")
+
+meta = load_meta(output_dir)
+embeddings = load_embeddings(output_dir)
+reset_peak_memory(cpu)
+index = IVFIndex.build(embeddings, lists=args.lists, iterations=args.iterations)
+index.save(output_dir)
+print(f"Built an IVF index of {index.lists} lists over {len(embeddings)} embeddings in {index.build_seconds:.1f}s, "
+      f"{format_bytes(index.nbytes)}, peak memory {format_bytes(peak_memory(cpu))}")
+
+queries = np.random.default_rng(2023).choice(len(embeddings), min(args.bench_queries, len(embeddings)), replace=False)
+results = benchmark(index, embeddings, embeddings[np.sort(queries)], k=args.k, nprobe=args.nprobe)
+print(f"Query latency over {results['queries']} queries (k={args.k}, nprobe={args.nprobe}): "
+      f"index p50 {results['index_p50_ms']:.2f} ms, p95 {results['index_p95_ms']:.2f} ms; "
+      f"exact scan p50 {results['exact_p50_ms']:.2f} ms, p95 {results['exact_p95_ms']:.2f} ms; "
+      f"recall@{args.k} {results[f'recall@{args.k}']:.3f}")
+write_meta(output_dir, {**meta, "index": {"lists": index.lists, "build_seconds": index.build_seconds},
+                        "benchmark": results})
@@ -0,0 +1,81 @@
+import argparse
+import time
+import runtime
+from prediction_cache import add_cache_args, cached_from_args
+from profiling import add_profiling_args, timer_from_args
+from compiled import add_compile_args, parse_lengths
+
+"""
+This script makes predictions on the test tweets with the multi-task model
+checkpoint written by multitask_hydra.py (Task 1 head) and outputs a
+submission file. The tweets are read in chunks and the predictions streamed
+to the file (CSV, or Parquet with a .parquet --output) by a background
+writer, see prediction_writer.py, so memory does not grow with the number
+of tweets. With --cache-size repeated tweets (retweets, copy-pasted
+alerts) are scored once, see prediction_cache.py. --profile times the
+tokenize, forward and postprocess phases of each batch, see profiling.py.
+--compile runs the forward compiled by torch.compile on batches padded to
+shape buckets, compiled at startup (see compiled.py).
+
+"""
+
+
+def predict_disaster(predictor, tweets, batch_size, writer, timer, keep_probs=False):
+    # tweets: DataFrames with id and text columns, e.g. the chunks of read_csv
+    progress = tqdm(unit="tweets")
+    for chunk in tweets:
+        ids, texts = chunk["id"].tolist(), chunk.text.tolist()
+        for start in range(0, len(texts), batch_size):
+            results = predictor.predict(texts[start:start + batch_size])
+            writer.write(prediction_frame(ids[start:start + batch_size], results, keep_probs))
+            progress.update(len(results))
+            timer.step()
+    progress.close()
+
+parser = argparse.ArgumentParser(description="Predict with the multi-task model")
+parser.add_argument("dir", help="data directory")
+parser.add_argument("--checkpoint", default=None, help="checkpoint directory (default: <dir>/models/net_hydra)")
+parser.add_argument("--batch-size", type=int, default=32)
+parser.add_argument("--output", default=None,
+                    help="prediction file, .csv or .parquet (default: <dir>/predicts/submit_hydra.csv)")
+parser.add_argument("--keep-probs", action="store_true",
+                    help="add the label, its score and the probability of each class to the prediction file")
+parser.add_argument("--chunk-size", type=int, default=10000, help="tweets read from test.csv at a time")
+parser.add_argument("--exit-threshold", type=float, default=None,
+                    help="stop each tweet at the first early exit this confident (checkpoints from early_exit.py)")
+add_cache_args(parser)
+add_profiling_args(parser)
+add_compile_args(parser)
+runtime.add_runtime_args(parser)
+args = parser.parse_args()
+dir = args.dir
+
+# Heavy dependencies are imported once the arguments are parsed, so --help
+# and argument errors return without loading them
+import pandas as pd
+from tqdm import tqdm
+from predictor import HydraPredictor
+from prediction_writer import PredictionWriter, prediction_frame
+
+runtime.configure_from_args(args)
+
+checkpoint = args.checkpoint or f"{dir}/models/net_hydra"
+timer = timer_from_args(args)
+start = time.perf_counter()
+hydra_predictor = HydraPredictor(checkpoint, exit_threshold=args.exit_threshold, timer=timer, compile=args.compile,
+                                 max_batch_size=args.batch_size, compile_mode=args.compile_mode,
+                                 compile_lengths=parse_lengths(args.compile_lengths))
+predictor = cached_from_args(args, hydra_predictor, checkpoint, {"exit_threshold": args.exit_threshold})
+print(f"Loaded {checkpoint} in {time.perf_counter() - start:.2f}s")
+
+output = args.output or f"{dir}/predicts/submit_hydra.csv"
+with PredictionWriter(output) as writer:
+    predict_disaster(predictor, pd.read_csv(f"{dir}/test.csv", chunksize=args.chunk_size), args.batch_size,
+                     writer, timer, keep_probs=args.keep_probs)
+timer.close()
+print(f"Wrote {writer.rows} predictions to {output}")
+print(f"Average encoder layers per tweet: {hydra_predictor.average_layers:.2f}")
+if hasattr(predictor, "cache"):
+    print(f"Prediction cache: {predictor.cache.stats()}")
+    predictor.cache.close()
+timer.print_summary()
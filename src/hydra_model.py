@@ -0,0 +1,188 @@
+import torch
+from transformers import RobertaConfig, RobertaModel
+
+"""
+The multi-task network shared by the training scripts: a RoBERTa encoder with
+one classification head for disaster tweets (Task 1) and one for sentiment
+(Task 2), either of which can be left out. Kept in its own module so
+checkpoints can be loaded without importing (and running) a training script.
+Early exits (early_exit.py), pruned encoders (prune.py) and packed rows
+(packing.py) are supported by the methods below.
+
+"""
+
+DISASTER_LABELS = {0: "not_disaster", 1: "disaster"}
+SENTIMENT_LABELS = {0: "neutral", 1: "negative", 2: "positive"}
+
+
+def prune_linear(linear, index, dim):
+    # Copy of `linear` keeping only the outputs (dim 0) or inputs (dim 1) in `index`
+    index = index.to(linear.weight.device)
+    pruned = torch.nn.Linear(linear.in_features if dim == 0 else len(index),
+                             len(index) if dim == 0 else linear.out_features,
+                             device=linear.weight.device, dtype=linear.weight.dtype)
+    with torch.no_grad():
+        pruned.weight.copy_(linear.weight.index_select(dim, index))
+        pruned.bias.copy_(linear.bias if dim == 1 else linear.bias.index_select(0, index))
+    return pruned
+
+
+class NetMultiTask(torch.nn.Module):
+    def __init__(self, encoder="roberta-base", num_labels1=2, num_labels2=3,
+                 pretrained=True, encoder_config=None, tasks=(1, 2), exit_layers=(), layer_sizes=None, net=None):
+        super(NetMultiTask, self).__init__()
+        self.encoder_name = encoder
+        self.tasks = tuple(tasks)
+        self.num_labels1 = num_labels1
+        self.num_labels2 = num_labels2
+        self.exit_layers = tuple(sorted(exit_layers))
+        if net is not None:
+            # Encoder built by the caller, e.g. a copy of one loaded once for many models
+            self.net = net
+        elif pretrained:
+            self.net = RobertaModel.from_pretrained(encoder)
+        else:
+            # Architecture only, weights are expected to be loaded afterwards
+            config = RobertaConfig.from_dict(encoder_config) if encoder_config else RobertaConfig.from_pretrained(encoder)
+            self.net = RobertaModel(config)
+        hidden_size = self.net.config.hidden_size
+
+        self.layer_sizes = None
+        if layer_sizes:
+            # Architecture of a pruned encoder, weights are loaded afterwards
+            self.prune_encoder({layer: range(heads) for layer, (heads, _) in enumerate(layer_sizes)},
+                               {layer: range(neurons) for layer, (_, neurons) in enumerate(layer_sizes)})
+
+        if 1 in self.tasks:
+            self.pre_classifier1 = torch.nn.Linear(hidden_size, hidden_size)
+            self.dropout1 = torch.nn.Dropout(0.3)
+            self.classifier1 = torch.nn.Linear(hidden_size, num_labels1)
+
+        if 2 in self.tasks:
+            self.pre_classifier2 = torch.nn.Linear(hidden_size, hidden_size)
+            self.dropout2 = torch.nn.Dropout(0.3)
+            self.classifier2 = torch.nn.Linear(hidden_size, num_labels2)
+
+        # Task 1 classifiers on the CLS state of intermediate layers, keyed by layer number
+        self.exits = torch.nn.ModuleDict({str(layer): torch.nn.Linear(hidden_size, num_labels1)
+                                          for layer in self.exit_layers})
+
+    def prune_encoder(self, heads, neurons):
+        # Keeps, per encoder layer number, the attention heads in heads[layer] and
+        # the FFN neurons in neurons[layer], shrinking the weight matrices
+        head_size = self.net.config.hidden_size // self.net.config.num_attention_heads
+        for number, layer in enumerate(self.net.encoder.layer):
+            if number in heads:
+                kept = torch.tensor(sorted(heads[number]), dtype=torch.long)
+                index = (kept[:, None] * head_size + torch.arange(head_size)).flatten()
+                attention = layer.attention.self
+                attention.query = prune_linear(attention.query, index, 0)
+                attention.key = prune_linear(attention.key, index, 0)
+                attention.value = prune_linear(attention.value, index, 0)
+                attention.num_attention_heads = len(kept)
+                attention.all_head_size = len(index)
+                layer.attention.output.dense = prune_linear(layer.attention.output.dense, index, 1)
+            if number in neurons:
+                index = torch.tensor(sorted(neurons[number]), dtype=torch.long)
+                layer.intermediate.dense = prune_linear(layer.intermediate.dense, index, 0)
+                layer.output.dense = prune_linear(layer.output.dense, index, 1)
+        self.layer_sizes = [[layer.attention.self.num_attention_heads, layer.intermediate.dense.out_features]
+                            for layer in self.net.encoder.layer]
+
+    def freeze_pooler(self):
+        # The heads pool the <s> hidden state, the encoder pooler never gets gradients,
+        # DistributedDataParallel would wait for them at the end of the first backward
+        if getattr(self.net, "pooler", None) is not None:
+            self.net.pooler.requires_grad_(False)
+        return self
+
+    def enable_gradient_checkpointing(self):
+        # Encoder layers keep only their inputs for the backward pass and run their forward
+        # again there, less activation memory for about one more forward per step
+        self.net.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+        return self
+
+    def head1(self, pooler):
+        pooler1 = self.pre_classifier1(pooler)
+        pooler1 = torch.relu(pooler1)
+        pooler1 = self.dropout1(pooler1)
+        return self.classifier1(pooler1)
+
+    def head2(self, pooler):
+        pooler2 = self.pre_classifier2(pooler)
+        pooler2 = torch.relu(pooler2)
+        pooler2 = self.dropout2(pooler2)
+        return self.classifier2(pooler2)
+
+    def forward(self, input_ids, attention_mask, token_type_ids=None, position_ids=None, cls_index=None):
+        if attention_mask.dim() == 3:
+            # Block-diagonal [batch, seq, seq] mask of packed rows, made additive for the encoder
+            dtype = self.net.dtype
+            attention_mask = (1.0 - attention_mask[:, None].to(dtype)) * torch.finfo(dtype).min
+        output_1 = self.net(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids,
+                            position_ids=position_ids)
+        hidden_state = output_1[0]
+        if cls_index is None:
+            pooler = hidden_state[:, 0]
+        else:
+            # One row per packed tweet, the state of its <s> token
+            pooler = hidden_state[cls_index[:, 0], cls_index[:, 1]]
+
+        output1 = None
+        if 1 in self.tasks:
+            output1 = self.head1(pooler)
+
+        output2 = None
+        if 2 in self.tasks:
+            output2 = self.head2(pooler)
+
+        return output1, output2
+
+    def embed(self, input_ids, attention_mask, token_type_ids=None):
+        # The <s> hidden state the heads read, one vector per tweet
+        return self.net(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0][:, 0]
+
+    def forward_early_exit(self, input_ids, attention_mask, threshold, token_type_ids=None):
+        # Task 1 logits where each row leaves at the first exit whose top class
+        # probability reaches `threshold`, and the number of layers each row ran.
+        # Rows that have left are dropped from the batch for the remaining layers.
+        layers = self.net.encoder.layer
+        logits = torch.empty(input_ids.size(0), self.num_labels1, device=input_ids.device)
+        layers_used = torch.full((input_ids.size(0),), len(layers), dtype=torch.long)
+        active = torch.arange(input_ids.size(0), device=input_ids.device)
+
+        hidden = self.net.embeddings(input_ids=input_ids, token_type_ids=token_type_ids)
+        # Additive [batch, 1, 1, seq] mask, accepted by the eager and SDPA attention layers
+        mask = (1.0 - attention_mask[:, None, None, :].to(hidden.dtype)) * torch.finfo(hidden.dtype).min
+        for depth, layer in enumerate(layers, start=1):
+            output = layer(hidden, attention_mask=mask)
+            hidden = output[0] if isinstance(output, tuple) else output
+            if str(depth) not in self.exits or depth == len(layers):
+                continue
+            exit_logits = self.exits[str(depth)](hidden[:, 0])
+            done = torch.softmax(exit_logits, dim=1).max(dim=1).values >= threshold
+            if done.any():
+                logits[active[done]] = exit_logits[done].to(logits.dtype)
+                layers_used[active[done].cpu()] = depth
+                active, hidden, mask = active[~done], hidden[~done], mask[~done]
+                if active.numel() == 0:
+                    return logits, layers_used
+
+        logits[active] = self.head1(hidden[:, 0]).to(logits.dtype)
+        return logits, layers_used
+
+    def model_config(self):
+        return {"encoder": self.encoder_name,
+                "encoder_config": self.net.config.to_dict(),
+                "num_labels1": self.num_labels1,
+                "num_labels2": self.num_labels2,
+                "tasks": list(self.tasks),
+                "exit_layers": list(self.exit_layers),
+                "layer_sizes": self.layer_sizes}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(encoder=config["encoder"], num_labels1=config["num_labels1"],
+                   num_labels2=config["num_labels2"], pretrained=False,
+                   encoder_config=config["encoder_config"], tasks=config.get("tasks", (1, 2)),
+                   exit_layers=config.get("exit_layers", ()), layer_sizes=config.get("layer_sizes"))
@@ -0,0 +1,228 @@
+import contextlib
+import torch
+from tqdm import tqdm
+import wandb
+import distributed
+from evaluation import PredictionCollector
+from metrics import StreamingMetrics
+from profiling import NO_TIMER
+from loss_weighting import FixedWeights
+
+"""
+Training and validation loops of the multi-task model. One forward per
+batch feeds both heads, each head is scored on the rows labelled for its
+task, and the task losses are normalised over the global batch, so the
+loops run unchanged under DistributedDataParallel, then combined by a
+loss_weighting strategy.
+
+"""
+
+# Per-row loss, weighted and summed in weighted_loss and normalised per task in task_loss
+loss_function = torch.nn.CrossEntropyLoss(reduction='none')
+
+
+def log_metrics(metrics):
+    if distributed.is_main_process():
+        wandb.log({**metrics})
+
+def hydra_inputs(data, device):
+    ids = data['ids'].to(device, dtype = torch.long)
+    mask = data['mask'].to(device, dtype = torch.long)
+    token_type_ids = data['token_type_ids'].to(device, dtype = torch.long)
+
+    d1_rows = ~torch.isnan(data['labels'][0])
+    d2_rows = ~torch.isnan(data['labels'][1])
+    d1_targets = data['labels'][0][d1_rows].to(device, dtype = torch.long)
+    d2_sentiment = data['labels'][1][d2_rows].to(device, dtype = torch.long)
+    d1_weights = data['weight'][d1_rows].to(device)
+    d2_weights = data['weight'][d2_rows].to(device)
+
+    return (ids, mask, token_type_ids, d1_rows.to(device), d2_rows.to(device),
+            d1_targets, d2_sentiment, d1_weights, d2_weights)
+
+def packing_inputs(data, device):
+    # Extra model inputs of a packed batch (see packing.py), whose rows hold several tweets
+    if 'cls_index' not in data:
+        return {}
+    return {'position_ids': data['position_ids'].to(device, dtype = torch.long),
+            'cls_index': data['cls_index'].to(device, dtype = torch.long)}
+
+def weighted_loss(output, targets, weights):
+    # Each row stands for `weights` identical tweets
+    return (loss_function(output, targets) * weights).sum()
+
+def task_loss(loss_sum, global_count):
+    # Summed loss scaled by the task's (weighted) row count over the global batch. DDP averages
+    # gradients over ranks, so this equals the per-example mean of the global batch.
+    # A rank (or batch) without rows for the task still yields a zero loss that is
+    # connected to the head, instead of a NaN that has to be dropped.
+    return loss_sum * distributed.get_world_size() / max(global_count, 1)
+
+def accumulation_context(model, sync_step):
+    # DistributedDataParallel averages gradients only on the batch that steps the optimizer
+    if sync_step or not hasattr(model, "no_sync"):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+def train_hydra(model, optimizer, epoch, training_loader, testing_loader, lambda1=None, lambda2=None,
+                checkpointer=None, global_step=0, start_batch=0, log=log_metrics, timer=NO_TIMER, weighting=None,
+                accumulation_steps=1, log_steps=10):
+    # weighting (see loss_weighting.py) combines the task losses, fixed lambda1/lambda2 by default.
+    # The optimizer steps every accumulation_steps batches and after the last batch of the epoch.
+    # Training metrics are computed and logged every log_steps batches and after the last one.
+    if weighting is None:
+        weighting = FixedWeights(lambda1, lambda2)
+    num_batches = len(training_loader)
+    device = next(model.parameters()).device
+    d1_tr_loss = 0
+    d2_tr_loss = 0
+    d1_train = StreamingMetrics(num_classes=2, device=device)
+    d2_train = StreamingMetrics(num_classes=3, device=device)
+
+    d1_val_loss = 0
+    d2_val_loss = 0
+    d1_val = StreamingMetrics(num_classes=2, device=device)
+    d2_val = StreamingMetrics(num_classes=3, device=device)
+
+    show_progress = distributed.is_main_process()
+
+    model.train()
+    for loop, data in enumerate(timer.iterate(tqdm(training_loader, 0, disable = not show_progress))):
+        with timer.phase("to_device"):
+            ids, mask, token_type_ids, d1_rows, d2_rows, d1_targets, d2_sentiment, d1_weights, d2_weights = hydra_inputs(data, device)
+
+        sync_step = (loop + 1) % accumulation_steps == 0 or loop + 1 == num_batches
+        with accumulation_context(model, sync_step):
+            # Single forward over the whole batch, each head is scored on its own rows
+            with timer.phase("forward"):
+                output1, output2 = model(ids, mask, token_type_ids, **packing_inputs(data, device))
+                output1 = output1[d1_rows]
+                output2 = output2[d2_rows]
+
+            with timer.phase("loss"):
+                d1_count, d2_count = distributed.all_reduce_sum([d1_weights.sum().item(), d2_weights.sum().item()])
+                loss1_sum = weighted_loss(output1, d1_targets, d1_weights)
+                loss2_sum = weighted_loss(output2, d2_sentiment, d2_weights)
+                loss1 = task_loss(loss1_sum, d1_count)
+                loss2 = task_loss(loss2_sum, d2_count)
+                lambda1, lambda2 = weighting.weights()
+                total_loss = weighting.combine(loss1, loss2) / accumulation_steps
+
+            with timer.phase("backward"):
+                if loop % accumulation_steps == 0:
+                    optimizer.zero_grad()
+                total_loss.backward()
+        if sync_step:
+            with timer.phase("optimizer"):
+                optimizer.step()
+                weighting.after_step()
+            global_step += 1
+
+        if sync_step and checkpointer is not None and checkpointer.should_save(global_step):
+            with timer.phase("checkpoint"):
+                checkpointer.save(global_step, epoch, start_batch + loop + 1,
+                                  getattr(model, "module", model), optimizer, loss_weighting=weighting)
+
+        with timer.phase("metrics"):
+            # Kept on the device, read back only when the metrics are logged
+            d1_tr_loss += lambda1*loss1_sum.detach()
+            d2_tr_loss += lambda2*loss2_sum.detach()
+
+            d1_train.update(output1.data, d1_targets, d1_weights)
+            d2_train.update(output2.data, d2_sentiment, d2_weights)
+        if (loop + 1) % log_steps == 0 or loop + 1 == num_batches:
+            with timer.phase("metrics"):
+                d1_step = d1_train.compute()
+                d2_step = d2_train.compute()
+
+                d1_loss_step = float(d1_tr_loss)/max(d1_step["support"].sum(), 1)
+                d2_loss_step = float(d2_tr_loss)/max(d2_step["support"].sum(), 1)
+
+                tr_loss_step = d1_loss_step + d2_loss_step
+
+                train_metrics = {"d1_train_loss": d1_loss_step,
+                    "d1_train_accuracy": d1_step["accuracy"]*100,
+                    "d1_train_f1": d1_step["f1_weighted"],
+                    "d2_train_loss": d2_loss_step,
+                    "d2_train_accuracy": d2_step["accuracy"]*100,
+                    "d2_train_f1": d2_step["f1_weighted"],
+                    "total_train_loss": tr_loss_step,
+                    **weighting.metrics()}
+
+            with timer.phase("logging"):
+                log(train_metrics)
+        timer.step()
+    weighting.end_epoch()
+    lambda1, lambda2 = weighting.weights()
+
+    # Ranks may run a different number of validation batches, the wrapped module
+    # runs them without the collectives of DistributedDataParallel
+    val_model = getattr(model, "module", model)
+    val_model.eval()
+    with torch.no_grad():
+        for _, data in enumerate(timer.iterate(tqdm(testing_loader, 0, disable = not show_progress), "val_data")):
+            with timer.phase("val_to_device"):
+                (ids_val, mask_val, token_type_ids_val, d1_rows_val, d2_rows_val,
+                 d1_targets_val, d2_sentiment_val, d1_weights_val, d2_weights_val) = hydra_inputs(data, device)
+
+            with timer.phase("val_forward"):
+                output1_val, output2_val = val_model(ids_val, mask_val, token_type_ids_val)
+                output1_val = output1_val[d1_rows_val]
+                output2_val = output2_val[d2_rows_val]
+
+            with timer.phase("val_metrics"):
+                d1_val_loss += lambda1*weighted_loss(output1_val, d1_targets_val, d1_weights_val).item()
+                d2_val_loss += lambda2*weighted_loss(output2_val, d2_sentiment_val, d2_weights_val).item()
+
+                d1_val.update(output1_val.data, d1_targets_val, d1_weights_val)
+                d2_val.update(output2_val.data, d2_sentiment_val, d2_weights_val)
+
+    # Metrics over all ranks
+    d1_val_loss, d2_val_loss = distributed.all_reduce_sum([d1_val_loss, d2_val_loss])
+    d1_epoch_val = d1_val.compute(all_ranks=True)
+    d2_epoch_val = d2_val.compute(all_ranks=True)
+
+    d1_loss_step_val = d1_val_loss/max(d1_epoch_val["support"].sum(), 1)
+    d2_loss_step_val = d2_val_loss/max(d2_epoch_val["support"].sum(), 1)
+
+    test_metrics = {"d1_test_loss": d1_loss_step_val,
+        "d1_test_accuracy": d1_epoch_val["accuracy"]*100,
+        "d1_test_f1": d1_epoch_val["f1_weighted"],
+        "d2_test_loss": d2_loss_step_val,
+        "d2_test_accuracy": d2_epoch_val["accuracy"]*100,
+        "d2_test_f1": d2_epoch_val["f1_weighted"],
+        "total_test_loss": d1_loss_step_val + d2_loss_step_val}
+
+    log(test_metrics)
+
+    d1_epoch_accuracy = d1_train.accuracy(all_ranks=True)
+    d2_epoch_accuracy = d2_train.accuracy(all_ranks=True)
+
+    if distributed.is_main_process():
+        print(f'Total D1 Accuracy for Epoch {epoch}: {d1_epoch_accuracy*100}')
+        print(f'Total D2 Accuracy for Epoch {epoch}: {d2_epoch_accuracy*100}')
+
+    return global_step
+
+def valid_hydra(model, testing_loader, keep_probs=False, timer=NO_TIMER, writers=(None, None)):
+    # writers: PredictionWriter of each task, receiving its predictions batch by batch
+    device = next(model.parameters()).device
+    model.eval()
+    d1_predicts = PredictionCollector(num_classes=2, size=len(testing_loader.dataset), keep_probs=keep_probs,
+                                      writer=writers[0])
+    d2_predicts = PredictionCollector(num_classes=3, size=len(testing_loader.dataset), keep_probs=keep_probs,
+                                      writer=writers[1])
+
+    with torch.no_grad():
+        for _, data in enumerate(timer.iterate(tqdm(testing_loader, 0), "val_data")):
+            with timer.phase("val_to_device"):
+                ids, mask, token_type_ids, d1_rows, d2_rows, d1_targets, d2_sentiment, _, _ = hydra_inputs(data, device)
+
+            with timer.phase("val_forward"):
+                output1, output2 = model(ids, mask, token_type_ids)
+
+            with timer.phase("val_collect"):
+                d1_predicts.update(output1.data[d1_rows], d1_targets)
+                d2_predicts.update(output2.data[d2_rows], d2_sentiment)
+
+    return d1_predicts, d2_predicts
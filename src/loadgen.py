@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlparse
+import numpy as np
+import pandas as pd
+
+"""
+Local load generator for serve.py. A fixed number of clients each keep one
+connection open and send requests back to back, and the client-side latency
+percentiles and throughput are printed together with the server's /metrics.
+
+    python src/serve.py --checkpoint <dir>/models/net_hydra
+    python src/loadgen.py --requests 2000 --concurrency 32
+
+"""
+
+SAMPLE_TWEETS = [
+    "Forest fire near La Ronge Sask. Canada",
+    "All residents asked to 'shelter in place' are being notified by officers",
+    "13,000 people receive #wildfires evacuation orders in California",
+    "Just got sent this photo from Ruby #Alaska as smoke from #wildfires pours into a school",
+    "What a goooooooaaaaaal!!!!!!",
+    "I love fruits",
+    "Summer is lovely",
+    "this movie was the bomb, go watch it",
+    "Flood warning in effect until 6 PM for the river basin, avoid low lying roads",
+    "Earthquake of magnitude 5.2 strikes off the coast, no tsunami warning issued",
+    "My car is so fast it's a total disaster for my speeding tickets lol",
+    "Ablaze for you Lord :D",
+]
+
+
+async def post(reader, writer, host, path, payload):
+    body = json.dumps(payload).encode()
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    return await read_response(reader)
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        if key.strip().lower() == "content-length":
+            length = int(value.strip())
+    return status, json.loads(await reader.readexactly(length))
+
+async def get(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+    response = await read_response(reader)
+    writer.close()
+    return response
+
+async def client(host, port, jobs, texts, batch, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in jobs:
+            payload = {"text": random.choice(texts)} if batch == 1 else {"texts": random.choices(texts, k=batch)}
+            start = time.perf_counter()
+            try:
+                status, _ = await post(reader, writer, host, "/predict", payload)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                errors.append("connection")
+                reader, writer = await asyncio.open_connection(host, port)
+                continue
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status)
+    finally:
+        writer.close()
+
+async def run(args, texts):
+    url = urlparse(args.url)
+    host, port = url.hostname, url.port or 80
+    # Shared iterator, each client takes the next request number until none are left
+    jobs = iter(range(args.requests))
+    latencies, errors = [], []
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, jobs, texts, args.batch, latencies, errors)
+                           for _ in range(args.concurrency)])
+    duration = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    p50, p90, p99 = np.percentile(latencies_ms, [50, 90, 99]) if len(latencies_ms) else (0.0, 0.0, 0.0)
+    _, server_metrics = await get(host, port, "/metrics")
+    return {"requests": args.requests,
+            "concurrency": args.concurrency,
+            "tweets_per_request": args.batch,
+            "completed": len(latencies),
+            "errors": len(errors),
+            "duration_s": duration,
+            "throughput_rps": len(latencies) / duration,
+            "throughput_tweets_per_s": len(latencies) * args.batch / duration,
+            "latency_ms": {"p50": float(p50), "p90": float(p90), "p99": float(p99),
+                           "mean": float(latencies_ms.mean()) if len(latencies_ms) else 0.0},
+            "server": server_metrics}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive serve.py with concurrent clients")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=1, help="tweets per request")
+    parser.add_argument("--texts", default=None, help="csv file with a text column to sample tweets from")
+    parser.add_argument("--output", default=None, help="write the results to this json file")
+    args = parser.parse_args()
+
+    texts = pd.read_csv(args.texts).text.astype(str).tolist() if args.texts else SAMPLE_TWEETS
+    results = asyncio.run(run(args, texts))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,214 @@
+import math
+import torch
+import distributed
+
+"""
+Weights of the two task losses of the multi-task model, chosen online
+during training instead of by a Bayesian Optimization search over full
+trainings (multitask_hydra_bo.py).
+
+    fixed        lambda1 * loss1 + lambda2 * loss2 (the tuned weights by default)
+    uncertainty  homoscedastic uncertainty weighting (Kendall et al., 2018):
+                 exp(-s_k) * loss_k + s_k / 2 with a learnt log variance s_k
+    gradnorm     GradNorm (Chen et al., 2018): learnt weights that balance
+                 the gradient norms of the weighted losses on the last shared
+                 encoder weights, tasks that train slower get larger gradients
+    dwa          Dynamic Weight Averaging (Liu et al., 2019): weights from the
+                 ratio of the mean losses of the two previous epochs
+
+train_hydra calls combine() with the per-task losses of each step,
+after_step() once the model optimizer has stepped, and end_epoch() after
+the training batches of an epoch. The learnt weights have their own Adam
+optimizer; their gradients are averaged over ranks so that every rank keeps
+the same weights. The state is saved in the training checkpoints, so
+--resume continues with the same weights.
+
+"""
+
+NUM_TASKS = 2
+
+
+def sync_grads(parameters):
+    # Mean gradient over ranks, like DistributedDataParallel does for the model
+    world_size = distributed.get_world_size()
+    if world_size == 1:
+        return
+    for parameter in parameters:
+        grad = parameter.grad if parameter.grad is not None else torch.zeros_like(parameter)
+        summed = distributed.all_reduce_sum(grad.flatten().tolist())
+        parameter.grad = torch.tensor(summed, dtype=parameter.dtype, device=parameter.device).view_as(parameter) / world_size
+
+
+class FixedWeights:
+    name = "fixed"
+
+    def __init__(self, lambda1, lambda2):
+        self.lambdas = [float(lambda1), float(lambda2)]
+
+    def weights(self):
+        return list(self.lambdas)
+
+    def combine(self, loss1, loss2):
+        lambda1, lambda2 = self.weights()
+        return (lambda1*loss1) + (lambda2*loss2)
+
+    def after_step(self):
+        pass
+
+    def end_epoch(self):
+        pass
+
+    def metrics(self):
+        lambda1, lambda2 = self.weights()
+        return {"lambda1": lambda1, "lambda2": lambda2}
+
+    def state_dict(self):
+        return {"lambdas": list(self.lambdas)}
+
+    def load_state_dict(self, state):
+        self.lambdas = list(state["lambdas"])
+
+class UncertaintyWeights(FixedWeights):
+    name = "uncertainty"
+
+    def __init__(self, lr=1e-3, device="cpu"):
+        self.log_vars = torch.zeros(NUM_TASKS, device=device, requires_grad=True)
+        self.optimizer = torch.optim.Adam([self.log_vars], lr=lr)
+
+    def weights(self):
+        return torch.exp(-self.log_vars.detach()).tolist()
+
+    def combine(self, loss1, loss2):
+        losses = torch.stack([loss1, loss2])
+        return (torch.exp(-self.log_vars) * losses + self.log_vars / 2).sum()
+
+    def after_step(self):
+        sync_grads([self.log_vars])
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+
+    def metrics(self):
+        metrics = super().metrics()
+        log_var1, log_var2 = self.log_vars.detach().tolist()
+        return {**metrics, "log_var1": log_var1, "log_var2": log_var2}
+
+    def state_dict(self):
+        return {"log_vars": self.log_vars.detach().cpu(), "optimizer": self.optimizer.state_dict()}
+
+    def load_state_dict(self, state):
+        with torch.no_grad():
+            self.log_vars.copy_(state["log_vars"])
+        self.optimizer.load_state_dict(state["optimizer"])
+
+class GradNorm(FixedWeights):
+    name = "gradnorm"
+
+    def __init__(self, shared_parameters, alpha=1.5, lr=0.025, device="cpu"):
+        self.shared = [p for p in shared_parameters if p.requires_grad]
+        self.alpha = alpha
+        self.task_weights = torch.ones(NUM_TASKS, device=device, requires_grad=True)
+        self.optimizer = torch.optim.Adam([self.task_weights], lr=lr)
+        # Loss of each task at its first step with rows, the reference for its training rate
+        self.initial_losses = [None] * NUM_TASKS
+        self.weight_grad = None
+
+    def weights(self):
+        return self.task_weights.detach().tolist()
+
+    def combine(self, loss1, loss2):
+        losses = torch.stack([loss1, loss2])
+        values = losses.detach().tolist()
+        for task, value in enumerate(values):
+            if self.initial_losses[task] is None and value > 0:
+                self.initial_losses[task] = value
+        # The weights only learn from batches where both tasks have rows. With gradient
+        # accumulation the gradients of the micro-batches add up until after_step.
+        if all(value > 0 for value in values) and None not in self.initial_losses:
+            norms = torch.stack([self.grad_norm(self.task_weights[task] * losses[task]) for task in range(NUM_TASKS)])
+            rates = torch.tensor([value / initial for value, initial in zip(values, self.initial_losses)],
+                                 device=norms.device)
+            targets = (norms.mean() * (rates / rates.mean()) ** self.alpha).detach()
+            weight_grad = torch.autograd.grad((norms - targets).abs().sum(), self.task_weights, retain_graph=True)[0]
+            self.weight_grad = weight_grad if self.weight_grad is None else self.weight_grad + weight_grad
+        # The model is trained with the current weights as constants
+        return (self.task_weights.detach() * losses).sum()
+
+    def grad_norm(self, loss):
+        grads = torch.autograd.grad(loss, self.shared, retain_graph=True, create_graph=True, allow_unused=True)
+        return torch.sqrt(sum((grad ** 2).sum() for grad in grads if grad is not None))
+
+    def after_step(self):
+        self.task_weights.grad = self.weight_grad if self.weight_grad is not None else torch.zeros_like(self.task_weights)
+        sync_grads([self.task_weights])
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+        with torch.no_grad():
+            # Positive weights summing to the number of tasks
+            self.task_weights.clamp_(min=1e-3)
+            self.task_weights.mul_(NUM_TASKS / self.task_weights.sum())
+        self.weight_grad = None
+
+    def state_dict(self):
+        return {"task_weights": self.task_weights.detach().cpu(), "optimizer": self.optimizer.state_dict(),
+                "initial_losses": list(self.initial_losses)}
+
+    def load_state_dict(self, state):
+        with torch.no_grad():
+            self.task_weights.copy_(state["task_weights"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.initial_losses = list(state["initial_losses"])
+
+class DynamicWeightAverage(FixedWeights):
+    name = "dwa"
+
+    def __init__(self, temperature=2.0):
+        self.temperature = temperature
+        self.lambdas = [1.0] * NUM_TASKS
+        # Mean loss of each task over the previous epochs, and the sums of the current one
+        self.history = []
+        self.loss_sums = [0.0] * NUM_TASKS
+        self.counts = [0] * NUM_TASKS
+
+    def combine(self, loss1, loss2):
+        for task, value in enumerate(torch.stack([loss1, loss2]).detach().tolist()):
+            if value > 0:
+                self.loss_sums[task] += value
+                self.counts[task] += 1
+        return super().combine(loss1, loss2)
+
+    def end_epoch(self):
+        sums = distributed.all_reduce_sum(self.loss_sums + self.counts)
+        self.history.append([total / max(count, 1) for total, count in zip(sums[:NUM_TASKS], sums[NUM_TASKS:])])
+        self.loss_sums = [0.0] * NUM_TASKS
+        self.counts = [0] * NUM_TASKS
+        if len(self.history) >= 2:
+            ratios = [last / max(before, 1e-12) for last, before in zip(self.history[-1], self.history[-2])]
+            exps = [math.exp(ratio / self.temperature) for ratio in ratios]
+            self.lambdas = [NUM_TASKS * value / sum(exps) for value in exps]
+
+    def state_dict(self):
+        return {"lambdas": list(self.lambdas), "history": [list(h) for h in self.history],
+                "loss_sums": list(self.loss_sums), "counts": list(self.counts)}
+
+    def load_state_dict(self, state):
+        self.lambdas = list(state["lambdas"])
+        self.history = [list(h) for h in state["history"]]
+        self.loss_sums = list(state["loss_sums"])
+        self.counts = list(state["counts"])
+
+
+WEIGHTINGS = ("fixed", "uncertainty", "gradnorm", "dwa")
+
+def make_weighting(name, model, lambda1, lambda2):
+    # `model` is the NetMultiTask being trained, GradNorm balances the gradients on the
+    # output projection of its last encoder layer
+    device = next(model.parameters()).device
+    if name == "fixed":
+        return FixedWeights(lambda1, lambda2)
+    if name == "uncertainty":
+        return UncertaintyWeights(device=device)
+    if name == "gradnorm":
+        return GradNorm([model.net.encoder.layer[-1].output.dense.weight], device=device)
+    if name == "dwa":
+        return DynamicWeightAverage()
+    raise ValueError(f"Unknown loss weighting {name}, choose from {', '.join(WEIGHTINGS)}")
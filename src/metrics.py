@@ -0,0 +1,86 @@
+import numpy as np
+import torch
+import distributed
+
+"""
+Classification metrics computed from a confusion matrix, so that accuracy,
+weighted/macro F1 and the per-class report all come out of one pass over
+the predictions. Rows of the confusion matrix are targets, columns are
+predictions. Results match sklearn's f1_score/accuracy_score.
+
+StreamingMetrics keeps only the confusion counts, updated per batch on the
+device the logits are on, so metrics can be read at any point of a training
+epoch or of an unbounded stream in O(classes^2) memory. Rows can carry
+integer count weights, as produced by dedup.py.
+
+"""
+
+
+def confusion_matrix(targets, predicts, num_classes):
+    targets = np.asarray(targets, dtype=np.int64)
+    predicts = np.asarray(predicts, dtype=np.int64)
+    counts = np.bincount(targets * num_classes + predicts, minlength=num_classes * num_classes)
+    return counts.reshape(num_classes, num_classes)
+
+def metrics_from_confusion(confusion):
+    confusion = np.asarray(confusion, dtype=np.float64)
+    true_positives = np.diag(confusion)
+    support = confusion.sum(axis=1)
+    predicted = confusion.sum(axis=0)
+    total = confusion.sum()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(predicted > 0, true_positives / predicted, 0.0)
+        recall = np.where(support > 0, true_positives / support, 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+    # Like sklearn, macro averages over the classes seen in targets or predictions
+    seen = (support + predicted) > 0
+    return {"accuracy": true_positives.sum() / total if total else 0.0,
+            "f1_weighted": (f1 * support).sum() / support.sum() if support.sum() else 0.0,
+            "f1_macro": f1[seen].mean() if seen.any() else 0.0,
+            "precision": precision,
+            "recall": recall,
+            "f1": f1,
+            "support": support.astype(np.int64),
+            "confusion": confusion.astype(np.int64)}
+
+
+class StreamingMetrics:
+    def __init__(self, num_classes, device="cpu"):
+        self.num_classes = num_classes
+        self.counts = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
+
+    def update(self, logits, targets, weights=None):
+        if targets.numel() == 0:
+            return
+        predicts = torch.argmax(logits, dim=1)
+        index = targets.to(self.counts.device) * self.num_classes + predicts.to(self.counts.device)
+        if weights is None:
+            self.counts += torch.bincount(index, minlength=self.num_classes * self.num_classes)
+        else:
+            counts = torch.bincount(index, weights=weights.to(self.counts.device, dtype=torch.float64),
+                                    minlength=self.num_classes * self.num_classes)
+            self.counts += counts.round().long()
+
+    def reset(self):
+        self.counts.zero_()
+
+    @property
+    def count(self):
+        return int(self.counts.sum().item())
+
+    def confusion(self, all_ranks=False):
+        counts = self.counts.cpu().numpy()
+        if all_ranks:
+            counts = np.asarray(distributed.all_reduce_sum(counts.tolist()), dtype=np.int64)
+        return counts.reshape(self.num_classes, self.num_classes)
+
+    def compute(self, all_ranks=False):
+        return metrics_from_confusion(self.confusion(all_ranks))
+
+    def accuracy(self, all_ranks=False):
+        return self.compute(all_ranks)["accuracy"]
+
+    def f1(self, average="weighted", all_ranks=False):
+        return self.compute(all_ranks)[f"f1_{average}"]
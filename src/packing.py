@@ -0,0 +1,102 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+"""
+Sequence packing of the training tweets of the multi-task model. Tweets
+average about 30 tokens, so instead of padding each one to MAX_LEN,
+PackedData concatenates several tweets (of either task) into one row of at
+most max_len tokens. Every tweet keeps its own <s> token and its position
+ids restart at each tweet, and collate_packed builds block-diagonal
+attention masks, so a tweet never attends to the other tweets of its row
+and its encoder output is the same as on its own.
+
+A batch holds one entry per tweet (segment) in 'labels' and 'weight', like
+a DataCombined batch holds one per row, plus 'cls_index', the (row,
+position) of the <s> token of each segment that NetMultiTask pools for the
+heads. The training loop and the weighted loss are unchanged.
+
+    loader = DataLoader(PackedData(frame, tokenizer, 512), batch_size=2, collate_fn=collate_packed)
+
+"""
+
+
+def pack_rows(lengths, max_len, order):
+    # Next-fit in the given order: a new row starts when the tweet does not fit
+    rows = []
+    row, used = [], 0
+    for index in order:
+        if row and used + lengths[index] > max_len:
+            rows.append(np.array(row))
+            row, used = [], 0
+        row.append(index)
+        used += lengths[index]
+    if row:
+        rows.append(np.array(row))
+    return rows
+
+class PackedData(Dataset):
+    def __init__(self, dataframe, tokenizer, max_len, seed=2023):
+        self.max_len = max_len
+        self.pad_id = tokenizer.pad_token_id
+        texts = [" ".join(str(text).split()) for text in dataframe.text]
+        self.input_ids = tokenizer(texts, add_special_tokens=True, truncation=True, max_length=max_len)["input_ids"]
+        self.target = dataframe.target.to_numpy(dtype=np.float64)
+        self.sentiment = dataframe.sentiment.to_numpy(dtype=np.float64)
+        self.weight = (dataframe.weight.to_numpy(dtype=np.float32) if "weight" in dataframe
+                       else np.ones(len(dataframe), dtype=np.float32))
+        # Rows mix the tasks, the order of the rows is shuffled again by the sampler
+        order = np.random.default_rng(seed).permutation(len(texts))
+        self.rows = pack_rows([len(ids) for ids in self.input_ids], max_len, order)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def num_tweets(self):
+        return len(self.input_ids)
+
+    def __getitem__(self, index):
+        tweets = self.rows[index]
+        ids = torch.full((self.max_len,), self.pad_id, dtype=torch.long)
+        segments = torch.zeros(self.max_len, dtype=torch.long)
+        # RoBERTa positions start after the padding index, padding keeps the padding index
+        position_ids = torch.full((self.max_len,), self.pad_id, dtype=torch.long)
+        cls_positions = torch.empty(len(tweets), dtype=torch.long)
+        start = 0
+        for segment, tweet in enumerate(tweets):
+            tweet_ids = self.input_ids[tweet]
+            end = start + len(tweet_ids)
+            ids[start:end] = torch.tensor(tweet_ids, dtype=torch.long)
+            segments[start:end] = segment + 1
+            position_ids[start:end] = torch.arange(len(tweet_ids)) + self.pad_id + 1
+            cls_positions[segment] = start
+            start = end
+
+        return {
+            'ids': ids,
+            'segments': segments,
+            'position_ids': position_ids,
+            'cls_positions': cls_positions,
+            'labels': (torch.from_numpy(self.target[tweets]), torch.from_numpy(self.sentiment[tweets])),
+            'weight': torch.from_numpy(self.weight[tweets])
+        }
+
+def collate_packed(batch):
+    # Rows are cut to the longest row of the batch
+    length = max(int((item['segments'] > 0).sum()) for item in batch)
+    segments = torch.stack([item['segments'][:length] for item in batch])
+    ids = torch.stack([item['ids'][:length] for item in batch])
+    # Tokens attend to their own tweet, padding attends to padding so no row is fully masked
+    mask = segments[:, :, None] == segments[:, None, :]
+    cls_index = torch.cat([torch.stack([torch.full_like(item['cls_positions'], row), item['cls_positions']], dim=1)
+                           for row, item in enumerate(batch)])
+    return {
+        'ids': ids,
+        'mask': mask,
+        'token_type_ids': torch.zeros_like(ids),
+        'position_ids': torch.stack([item['position_ids'][:length] for item in batch]),
+        'cls_index': cls_index,
+        'labels': (torch.cat([item['labels'][0] for item in batch]), torch.cat([item['labels'][1] for item in batch])),
+        'weight': torch.cat([item['weight'] for item in batch])
+    }
@@ -0,0 +1,155 @@
+import os
+import glob
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from tweet_text import normalise_text
+
+"""
+Bounded LRU/TTL cache in front of model inference. Retweets and copy-pasted
+alerts are scored once: entries are keyed by a hash of the whitespace
+normalised tweet and the model version (model files and the inference
+settings, such as the early-exit threshold), so a retrained model never
+reuses old predictions. An optional sqlite file keeps entries across runs, and
+hit-rate counters are exposed by stats().
+
+"""
+
+
+def model_version(path, settings=None):
+    # Changes whenever a file of the model directory is rewritten, or with `settings`,
+    # the inference options that change the predictions (e.g. exit_threshold)
+    h = hashlib.sha1(os.path.abspath(path).encode())
+    for filename in sorted(glob.glob(os.path.join(path, "*"))):
+        info = os.stat(filename)
+        h.update(f"{os.path.basename(filename)}:{info.st_size}:{info.st_mtime_ns}".encode())
+    if settings:
+        h.update(json.dumps(settings, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+class PredictionCache:
+    def __init__(self, model_version, maxsize=100000, ttl=None, disk_path=None):
+        self.model_version = model_version
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = None
+        if disk_path is not None:
+            os.makedirs(disk_path, exist_ok=True)
+            self.db = sqlite3.connect(os.path.join(disk_path, "predictions.sqlite"), check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            self.db.commit()
+
+    def key(self, text):
+        return hashlib.sha1(f"{self.model_version}\0{normalise_text(text)}".encode()).hexdigest()
+
+    def _expires(self):
+        return time.time() + self.ttl if self.ttl else None
+
+    def get(self, key):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires is None or expires > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+
+        if self.db is not None:
+            row = self.db.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and (row[1] is None or row[1] > now):
+                value = json.loads(row[0])
+                self._put_memory(key, value, row[1])
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def _put_memory(self, key, value, expires):
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def put_many(self, items):
+        expires = self._expires()
+        for key, value in items:
+            self._put_memory(key, value, expires)
+        if self.db is not None and items:
+            self.db.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                                [(key, json.dumps(value), expires) for key, value in items])
+            self.db.commit()
+
+    def lookup(self, texts):
+        # (keys, cached results or None, {key: text} of the distinct misses)
+        with self.lock:
+            keys = [self.key(text) for text in texts]
+            results = [self.get(key) for key in keys]
+            missing = OrderedDict()
+            for text, key, result in zip(texts, keys, results):
+                if result is None and key not in missing:
+                    missing[key] = text
+        return keys, results, missing
+
+    def fill(self, keys, results, missing, values):
+        # Stores the predictions `values` of the misses, returns the results of every tweet
+        computed = dict(zip(missing.keys(), values))
+        with self.lock:
+            self.put_many(list(computed.items()))
+        return [computed[key] if result is None else result for key, result in zip(keys, results)]
+
+    def predict(self, texts, predict):
+        # Looks every tweet up, runs `predict` once on the distinct misses
+        keys, results, missing = self.lookup(texts)
+        if missing:
+            results = self.fill(keys, results, missing, predict(list(missing.values())))
+        return results
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {"size": len(self.entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+class CachedPredictor:
+    def __init__(self, predictor, cache):
+        self.predictor = predictor
+        self.cache = cache
+
+    def predict(self, texts):
+        return self.cache.predict(texts, self.predictor.predict)
+
+def add_cache_args(parser):
+    group = parser.add_argument_group("prediction cache")
+    group.add_argument("--cache-size", type=int, default=0,
+                       help="number of predictions kept in memory, 0 disables the cache")
+    group.add_argument("--cache-ttl", type=float, default=None, help="seconds a cached prediction stays valid")
+    group.add_argument("--cache-dir", default=None, help="directory of the on-disk cache tier")
+    return parser
+
+def cache_from_args(args, model_path, settings=None):
+    # `settings`: inference options of the predictor that change its predictions
+    if args.cache_size <= 0:
+        return None
+    return PredictionCache(model_version(model_path, settings), maxsize=args.cache_size,
+                           ttl=args.cache_ttl, disk_path=args.cache_dir)
+
+def cached_from_args(args, predictor, model_path, settings=None):
+    cache = cache_from_args(args, model_path, settings)
+    return predictor if cache is None else CachedPredictor(predictor, cache)
@@ -0,0 +1,133 @@
+import importlib.util
+import os
+import queue
+import threading
+import pandas as pd
+
+"""
+Streaming writer of prediction files. Batches of predictions are handed to
+write() as DataFrames whose index holds the ids (tweet ids, or row numbers
+of a validation split) and are appended, in the order they were written,
+by a background thread. Ids travel with their rows, so the file needs no
+final merge, and the queue holds at most `buffers` batches (two by
+default: the caller fills the next batch while the thread writes the
+previous one), so memory stays flat whatever the number of tweets.
+
+The format follows the extension: CSV, or Parquet (one row group per batch,
+needs pyarrow). The file is written as <path>.partial and renamed when the
+writer is closed, so an interrupted run never leaves a truncated file at
+the final path.
+
+    with PredictionWriter(f"{dir}/predicts/submit_hydra.csv") as writer:
+        for ids, texts in batches:
+            writer.write(prediction_frame(ids, predictor.predict(texts)))
+
+"""
+
+
+def prediction_frame(ids, results, keep_probs=False):
+    # Rows of predictor results (dicts with target, label, score and probs) indexed by id,
+    # keep_probs adds the label, score and prob_<class> columns like evaluation.PredictionCollector
+    frame = pd.DataFrame({"target": [result["target"] for result in results]}, index=pd.Index(ids, name="id"))
+    if keep_probs:
+        frame["label"] = [result["label"] for result in results]
+        frame["score"] = [result["score"] for result in results]
+        for label in range(len(results[0]["probs"]) if results else 0):
+            frame[f"prob_{label}"] = [result["probs"][label] for result in results]
+    return frame
+
+
+class PredictionWriter:
+    def __init__(self, path, format=None, buffers=2):
+        self.path = str(path)
+        self.format = format or ("parquet" if self.path.endswith(".parquet") else "csv")
+        if self.format not in ("csv", "parquet"):
+            raise ValueError(f"Unknown prediction file format {self.format}, use csv or parquet")
+        if self.format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+            raise ImportError("Parquet prediction files need pyarrow (pip install pyarrow)")
+        self.partial = f"{self.path}.partial"
+        self.rows = 0
+        self.closed = False
+        self.error = None
+        self.queue = queue.Queue(maxsize=buffers)
+        self.thread = threading.Thread(target=self._write_loop, name="prediction-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, frame):
+        # Appends the rows of `frame` after those of the previous calls
+        self._raise_error()
+        if self.closed:
+            raise ValueError(f"{self.path} is already closed")
+        self.rows += len(frame)
+        self.queue.put(frame)
+
+    def close(self):
+        # Waits for the pending batches and moves the file to its path, returns the path
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+            if self.error is None:
+                os.replace(self.partial, self.path)
+        self._raise_error()
+        return self.path
+
+    def abort(self):
+        # Stops the thread and removes the partial file, the path is left untouched
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError(f"Writing {self.path} failed: {self.error}") from self.error
+
+    def _write_loop(self):
+        sink = None
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                # After an error the batches are only drained, so write() never blocks
+                continue
+            try:
+                sink = self._append(sink, frame)
+            except Exception as e:
+                self.error = e
+        try:
+            if sink is None and self.error is None:
+                # No rows, an empty file still marks the run as done
+                open(self.partial, "w").close()
+            elif sink is not None:
+                sink.close()
+        except Exception as e:
+            self.error = self.error or e
+
+    def _append(self, sink, frame):
+        if self.format == "csv":
+            if sink is None:
+                sink = open(self.partial, "w", newline="")
+                frame.to_csv(sink)
+            else:
+                frame.to_csv(sink, header=False)
+            return sink
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(frame.reset_index(), preserve_index=False)
+        if sink is None:
+            sink = pq.ParquetWriter(self.partial, table.schema)
+        sink.write_table(table)
+        return sink
@@ -0,0 +1,140 @@
+import numpy as np
+import torch
+from transformers import RobertaTokenizer, pipeline
+from checkpoint import load_checkpoint, load_tokenizer
+from profiling import NO_TIMER
+from tweet_text import normalise_text
+from compiled import CompiledForward, ShapeBuckets, DEFAULT_LENGTHS, pad_inputs, warm_up, measure_speedup
+
+"""
+Batch predictors for disaster tweets, shared by the inference scripts and
+the HTTP server. Both take a list of tweets and return one dict per tweet
+with the predicted target (1 for a real disaster), its label and score, and
+the probability of each class.
+
+HydraPredictor runs the Task 1 head of a NetMultiTask checkpoint (with
+exit_threshold, tweets leave at the first confident early exit),
+Strategy1Predictor wraps the text-classification pipeline of the Strategy 1
+model. Passing a profiling.PhaseTimer times the phases of each batch.
+With compile, HydraPredictor runs a torch.compile forward on batches padded
+to shape buckets (see compiled.py), warmed up when it is created.
+HydraPredictor.embed returns the pooled encoder vectors of the tweets
+instead, see embedding_index.py.
+
+"""
+
+
+class HydraPredictor:
+    def __init__(self, checkpoint, device="cpu", exit_threshold=None, timer=NO_TIMER, compile=False,
+                 max_batch_size=32, compile_mode="default", compile_lengths=DEFAULT_LENGTHS):
+        self.device = device
+        self.timer = timer
+        self.model, self.config = load_checkpoint(checkpoint, device=device)
+        if exit_threshold is not None and not self.model.exit_layers:
+            raise ValueError(f"{checkpoint} has no early exits, add them with early_exit.py")
+        self.exit_threshold = exit_threshold
+        self.layers_used = 0
+        self.predicted = 0
+        self.tokenizer = load_tokenizer(checkpoint)
+        self.max_len = self.config["max_len"]
+        labels = self.config["label_maps"].get("disaster", {"0": "0", "1": "1"})
+        self.labels = {int(key): value for key, value in labels.items()}
+        self.buckets = None
+        self.compiled = None
+        if compile:
+            if exit_threshold is not None:
+                raise ValueError("Early exits run eagerly, use either compile or exit_threshold")
+            self.compile(max_batch_size, compile_mode, compile_lengths)
+
+    def compile(self, max_batch_size, mode="default", lengths=DEFAULT_LENGTHS):
+        # Compiles and warms up the forward for every bucket shape, then reports compile time and speedup
+        self.buckets = ShapeBuckets.for_inference(max_batch_size, self.max_len, lengths)
+        shapes = self.buckets.shapes()
+        self.compiled = CompiledForward(self.model, mode=mode, graphs=len(shapes) + 8)
+
+        def make_inputs(rows, tokens):
+            ids = torch.full((rows, tokens), self.tokenizer.pad_token_id, dtype=torch.long)
+            ids[:, 0] = self.tokenizer.bos_token_id
+            return {"input_ids": ids.to(self.device), "attention_mask": torch.ones_like(ids).to(self.device),
+                    "token_type_ids": torch.zeros_like(ids).to(self.device)}
+
+        warm_up(self.compiled, make_inputs, shapes)
+        measure_speedup(self.compiled, make_inputs(*shapes[-1]))
+        self.compiled.print_report()
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        # Task 1 logits, with compile over chunks of the largest bucket padded up to a bucket
+        if self.buckets is None:
+            return self.model(input_ids, attention_mask, token_type_ids)[0]
+        logits = []
+        for start in range(0, len(input_ids), self.buckets.max_batch_size):
+            chunk = slice(start, start + self.buckets.max_batch_size)
+            rows = len(input_ids[chunk])
+            shape = self.buckets.bucket(rows, input_ids.size(1))
+            output1, _ = self.model(*pad_inputs(input_ids[chunk], attention_mask[chunk], token_type_ids[chunk],
+                                                shape, self.tokenizer.pad_token_id))
+            logits.append(output1[:rows])
+        return torch.cat(logits)
+
+    def tokenize(self, texts):
+        with self.timer.phase("tokenize"):
+            return self.tokenizer([normalise_text(text) for text in texts], padding=True, truncation=True,
+                                  max_length=self.max_len, return_token_type_ids=True, return_tensors="pt")
+
+    def embed(self, texts):
+        # Pooled <s> vectors of the encoder, float32 [len(texts), hidden_size]
+        if len(texts) == 0:
+            return np.empty((0, self.model.net.config.hidden_size), dtype=np.float32)
+        inputs = self.tokenize(texts)
+        with torch.no_grad(), self.timer.phase("forward"):
+            vectors = self.model.embed(inputs["input_ids"].to(self.device), inputs["attention_mask"].to(self.device),
+                                       inputs["token_type_ids"].to(self.device))
+        return vectors.float().cpu().numpy()
+
+    def predict_proba(self, texts):
+        if len(texts) == 0:
+            return np.empty((0, len(self.labels)), dtype=np.float32)
+        inputs = self.tokenize(texts)
+        with torch.no_grad(), self.timer.phase("forward"):
+            if self.exit_threshold is None:
+                output1 = self.forward(inputs["input_ids"].to(self.device), inputs["attention_mask"].to(self.device),
+                                       inputs["token_type_ids"].to(self.device))
+                self.layers_used += len(texts) * self.model.net.config.num_hidden_layers
+            else:
+                output1, layers_used = self.model.forward_early_exit(
+                    inputs["input_ids"].to(self.device), inputs["attention_mask"].to(self.device),
+                    self.exit_threshold, inputs["token_type_ids"].to(self.device))
+                self.layers_used += int(layers_used.sum())
+        self.predicted += len(texts)
+        with self.timer.phase("postprocess"):
+            return torch.softmax(output1.float(), dim=1).cpu().numpy()
+
+    @property
+    def average_layers(self):
+        return self.layers_used / self.predicted if self.predicted else 0.0
+
+    def predict(self, texts):
+        probs = self.predict_proba(texts)
+        targets = probs.argmax(axis=1)
+        return [{"target": int(target), "label": self.labels[int(target)], "score": float(prob[target]),
+                 "probs": prob.tolist()}
+                for target, prob in zip(targets, probs)]
+
+class Strategy1Predictor:
+    def __init__(self, model_dir, tokenizer="roberta-large", device="cpu", timer=NO_TIMER):
+        self.timer = timer
+        self.pipeline = pipeline("text-classification", model=model_dir,
+                                 tokenizer=RobertaTokenizer.from_pretrained(tokenizer),
+                                 device=device, function_to_apply="softmax")
+
+    def predict(self, texts):
+        # Tokenization and forward run inside the pipeline
+        with self.timer.phase("pipeline"):
+            outputs = self.pipeline([str(text) for text in texts], batch_size=max(len(texts), 1))
+        results = []
+        for out in outputs:
+            target, score = 1 if out["label"] == "POSITIVE" else 0, float(out["score"])
+            # Two classes, the score is the probability of the predicted one
+            results.append({"target": target, "label": out["label"], "score": score,
+                            "probs": [1 - score, score] if target else [score, 1 - score]})
+        return results
@@ -0,0 +1,68 @@
+import os
+import argparse
+
+"""
+This script checks a data directory before training: the competition and
+sentiment CSVs must be present with the columns the training scripts read,
+their row counts, missing texts and label distributions are printed, and
+the repeated and conflicting tweets that the training scripts collapse
+(see dedup.py) are summarised. It creates the models/ and predicts/
+directories the scripts write to. Only pandas is loaded, so it returns in
+about a second.
+
+"""
+
+# Columns read by the training and inference scripts
+REQUIRED_COLUMNS = {"train.csv": ["id", "text", "target"],
+                    "test.csv": ["id", "text"],
+                    "tweets.csv": ["textID", "text", "sentiment"]}
+# Directories written by the training and inference scripts
+OUTPUT_DIRS = ["models", "predicts"]
+
+
+def check_columns(name, df):
+    missing = [column for column in REQUIRED_COLUMNS[name] if column not in df.columns]
+    if missing:
+        raise SystemExit(f"{name} is missing the columns {missing}")
+
+def describe(name, df, label=None):
+    print(f"{name}: {len(df)} rows, {df.text.isna().sum()} without text")
+    if label is not None:
+        counts = df[label].value_counts(dropna=False)
+        print("  " + ", ".join(f"{label}={value}: {count}" for value, count in counts.items()))
+
+parser = argparse.ArgumentParser(description="Check a data directory and create the output directories")
+parser.add_argument("dir", help="data directory")
+parser.add_argument("--no-dedup", action="store_true", help="skip the summary of repeated tweets")
+args = parser.parse_args()
+dir = args.dir
+
+missing = [name for name in REQUIRED_COLUMNS if not os.path.exists(os.path.join(dir, name))]
+if missing:
+    parser.error(f"{dir} is missing {', '.join(missing)}")
+if not os.path.exists(os.path.join(dir, "wandb_key.txt")):
+    print(f"Warning: {dir}/wandb_key.txt not found, the training scripts log to wandb with it")
+
+# Imported after parsing, so --help and a missing file return at once
+import pandas as pd
+from dedup import dedup_weighted, print_dedup_summary
+
+d_train = pd.read_csv(f"{dir}/train.csv")
+d_test = pd.read_csv(f"{dir}/test.csv")
+s_train = pd.read_csv(f"{dir}/tweets.csv")
+for name, df in (("train.csv", d_train), ("test.csv", d_test), ("tweets.csv", s_train)):
+    check_columns(name, df)
+
+describe("train.csv", d_train, "target")
+describe("test.csv", d_test)
+describe("tweets.csv", s_train, "sentiment")
+
+if not args.no_dedup:
+    d_train_select = d_train[['text','target']].copy()
+    s_train_select = s_train[['text','sentiment']].dropna(subset=['text'])
+    print_dedup_summary("Disaster", d_train_select, dedup_weighted(d_train_select, "target"), "target")
+    print_dedup_summary("Sentiment", s_train_select, dedup_weighted(s_train_select, "sentiment"), "sentiment")
+
+for output in OUTPUT_DIRS:
+    os.makedirs(os.path.join(dir, output), exist_ok=True)
+print(f"Created {', '.join(f'{dir}/{output}' for output in OUTPUT_DIRS)}")
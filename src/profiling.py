@@ -0,0 +1,151 @@
+import time
+import contextlib
+from collections import defaultdict
+
+"""
+Opt-in instrumentation of the training, validation and inference loops.
+PhaseTimer records the wall time of every named phase (data loading,
+forward, backward, optimizer, ...) each time it runs and prints a summary
+table. Disabled, phase() returns a shared null context, so the loops pay
+next to nothing, and torch is only imported once a timer is enabled.
+
+With a trace path, torch.profiler records the steps START:END (counted by
+step()) with every phase annotated, writes a Chrome trace (chrome://tracing
+or https://ui.perfetto.dev) and prints the top operators.
+
+    python src/multitask_hydra.py <dir> --profile --profile-trace trace.json --profile-steps 5:10
+
+"""
+
+NULL_CONTEXT = contextlib.nullcontext()
+
+
+class PhaseTimer:
+    def __init__(self, enabled=True, trace_path=None, trace_steps=(5, 10)):
+        self.enabled = enabled or trace_path is not None
+        self.durations = defaultdict(list)
+        self.steps = 0
+        self.started = None
+        self.trace_path = trace_path
+        self.profiler = None
+        self.sync = False
+        if not self.enabled:
+            return
+        import torch
+        # CUDA kernels run asynchronously, wait for them so time lands in the right phase
+        self.sync = torch.cuda.is_available()
+        self.synchronize = torch.cuda.synchronize
+        self.record_function = torch.profiler.record_function
+        if trace_path is not None:
+            start, end = trace_steps
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(skip_first=max(start - 1, 0), wait=0, warmup=min(start, 1),
+                                                 active=max(end - start, 1), repeat=1),
+                on_trace_ready=self._export_trace, record_shapes=True)
+            self.profiler.start()
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_CONTEXT
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        if self.sync:
+            self.synchronize()
+        start = time.perf_counter()
+        if self.started is None:
+            self.started = start
+        try:
+            with self.record_function(name) if self.profiler is not None else NULL_CONTEXT:
+                yield
+        finally:
+            if self.sync:
+                self.synchronize()
+            self.durations[name].append(time.perf_counter() - start)
+
+    def iterate(self, iterable, name="data"):
+        # Yields the items of `iterable`, timing each fetch (e.g. from a DataLoader) as `name`
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        end = object()
+        while True:
+            with self.phase(name):
+                item = next(iterator, end)
+            if item is end:
+                # The fetch that found the end is not a step
+                self.durations[name].pop()
+                return
+            yield item
+
+    def step(self):
+        if not self.enabled:
+            return
+        self.steps += 1
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def _export_trace(self, profiler):
+        profiler.export_chrome_trace(self.trace_path)
+        print(profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=15))
+        print(f"Wrote profiler trace to {self.trace_path}")
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    def summary(self):
+        import numpy as np
+        import pandas as pd
+        total = sum(sum(values) for values in self.durations.values())
+        rows = []
+        for name, values in self.durations.items():
+            values_ms = np.array(values) * 1000
+            rows.append({"phase": name,
+                         "calls": len(values),
+                         "total_s": values_ms.sum() / 1000,
+                         "mean_ms": values_ms.mean(),
+                         "p50_ms": np.percentile(values_ms, 50),
+                         "p90_ms": np.percentile(values_ms, 90),
+                         "max_ms": values_ms.max(),
+                         "share_pct": values_ms.sum() / 10 / total if total else 0.0})
+        return pd.DataFrame(rows, columns=["phase", "calls", "total_s", "mean_ms", "p50_ms",
+                                           "p90_ms", "max_ms", "share_pct"])
+
+    def print_summary(self, title="Phase timings"):
+        if not self.enabled or not self.durations:
+            return
+        wall = time.perf_counter() - self.started
+        print(f"{title}: {self.steps} steps, {wall:.2f}s wall time")
+        print(self.summary().to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+def add_profiling_args(parser):
+    group = parser.add_argument_group("profiling")
+    group.add_argument("--profile", action="store_true",
+                       help="time every phase of the loops and print a summary table")
+    group.add_argument("--profile-trace", default=None,
+                       help="write a torch.profiler Chrome trace of --profile-steps to this file")
+    group.add_argument("--profile-steps", default="5:10",
+                       help="steps START:END recorded with --profile-trace")
+    return parser
+
+def timer_from_args(args, name=None):
+    # `name` tells apart the traces of several loops in one process
+    import distributed
+    start, end = (int(step) for step in args.profile_steps.split(":"))
+    trace_path = args.profile_trace
+    if trace_path is not None and name is not None:
+        trace_path = f"{trace_path}.{name}"
+    if trace_path is not None and distributed.get_rank() > 0:
+        # One trace per rank
+        trace_path = f"{trace_path}.rank{distributed.get_rank()}"
+    return PhaseTimer(enabled=args.profile, trace_path=trace_path, trace_steps=(start, end))
+
+NO_TIMER = PhaseTimer(enabled=False)
@@ -0,0 +1,193 @@
+import argparse
+import time
+import runtime
+from tweet_text import normalise_text
+
+"""
+This script structurally prunes the RoBERTa encoder of a multi-task
+checkpoint for faster CPU inference. Attention heads and FFN neurons are
+scored on the disaster validation split by first-order importance
+(|weight * gradient| of the Task 1 loss, summed over the weights of each
+unit), normalised per layer and ranked globally. For every --sparsities
+value the lowest-scoring fraction of heads and of neurons is removed (each
+layer keeps at least its best head and neuron), the weight matrices are
+physically shrunk, and the model is fine-tuned for --finetune-steps on the
+training split.
+
+Pruned models keep only the Task 1 head and are saved as checkpoints
+(<dir>/models/net_hydra_pruned<percent>) that hydra_inference.py and
+serve.py load. Parameters, F1/accuracy and ms per tweet at batch size 1
+and --batch-size are printed for every sparsity and the unpruned model and
+written to <dir>/predicts/prune_report.csv.
+
+"""
+
+
+def tokenize(tokenizer, texts, max_len, device):
+    inputs = tokenizer([normalise_text(text) for text in texts], padding=True, truncation=True,
+                       max_length=max_len, return_tensors="pt")
+    return inputs["input_ids"].to(device), inputs["attention_mask"].to(device)
+
+def unit_scores(linear, dim):
+    # |w * dL/dw| summed per output row (dim 0) or input column (dim 1)
+    scores = (linear.weight * linear.weight.grad).abs().sum(dim=1 - dim)
+    if dim == 0:
+        scores = scores + (linear.bias * linear.bias.grad).abs()
+    return scores.detach()
+
+def importance_scores(model, tokenizer, texts, targets, max_len, batch_size):
+    device = next(model.parameters()).device
+    layers = model.net.encoder.layer
+    config = model.net.config
+    head_scores = torch.zeros(len(layers), config.num_attention_heads, device=device)
+    neuron_scores = torch.zeros(len(layers), config.intermediate_size, device=device)
+    loss_function = torch.nn.CrossEntropyLoss(reduction='sum')
+
+    # Dropout off, gradients on
+    model.eval()
+    for start in tqdm(range(0, len(texts), batch_size)):
+        ids, mask = tokenize(tokenizer, texts[start:start + batch_size], max_len, device)
+        output1, _ = model(ids, mask)
+        model.zero_grad()
+        loss_function(output1, targets[start:start + batch_size].to(device)).backward()
+        for number, layer in enumerate(layers):
+            attention = layer.attention.self
+            heads = (unit_scores(attention.query, 0) + unit_scores(attention.key, 0) + unit_scores(attention.value, 0)
+                     + unit_scores(layer.attention.output.dense, 1))
+            head_scores[number] += heads.view(config.num_attention_heads, -1).sum(dim=1)
+            neuron_scores[number] += unit_scores(layer.intermediate.dense, 0) + unit_scores(layer.output.dense, 1)
+    model.zero_grad()
+    return head_scores.cpu(), neuron_scores.cpu()
+
+def units_to_keep(scores, sparsity):
+    # Per-layer normalised scores, the globally lowest `sparsity` fraction is removed
+    scores = scores / scores.norm(dim=1, keepdim=True).clamp_min(1e-12)
+    removed = torch.zeros(scores.numel(), dtype=torch.bool)
+    removed[scores.flatten().argsort()[:int(round(sparsity * scores.numel()))]] = True
+    removed = removed.view_as(scores)
+    removed[torch.arange(scores.size(0)), scores.argmax(dim=1)] = False
+    return {layer: (~removed[layer]).nonzero().flatten().tolist() for layer in range(scores.size(0))}
+
+def finetune(model, tokenizer, texts, targets, weights, max_len, steps, batch_size, lr):
+    device = next(model.parameters()).device
+    optimizer = torch.optim.Adam(params = model.parameters(), lr = lr)
+    loss_function = torch.nn.CrossEntropyLoss(reduction='none')
+    generator = torch.Generator().manual_seed(2023)
+    order = torch.randperm(len(texts), generator=generator)
+    model.train()
+    for step in tqdm(range(steps)):
+        start = (step * batch_size) % len(texts)
+        index = order[start:start + batch_size]
+        ids, mask = tokenize(tokenizer, [texts[i] for i in index], max_len, device)
+        output1, _ = model(ids, mask)
+        weight = weights[index].to(device)
+        loss = (loss_function(output1, targets[index].to(device)) * weight).sum() / weight.sum()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    model.eval()
+
+def evaluate(model, tokenizer, texts, targets, max_len, batch_size):
+    device = next(model.parameters()).device
+    predicts = []
+    with torch.no_grad():
+        for start in range(0, len(texts), batch_size):
+            output1, _ = model(*tokenize(tokenizer, texts[start:start + batch_size], max_len, device))
+            predicts.append(output1.argmax(dim=1).cpu().numpy())
+    return metrics_from_confusion(confusion_matrix(targets, np.concatenate(predicts), model.num_labels1))
+
+def ms_per_tweet(model, tokenizer, texts, max_len, batch_size):
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        # Warm-up batch, not timed
+        model(*tokenize(tokenizer, texts[:batch_size], max_len, device))
+        start = time.perf_counter()
+        for index in range(0, len(texts), batch_size):
+            model(*tokenize(tokenizer, texts[index:index + batch_size], max_len, device))
+    return (time.perf_counter() - start) * 1000 / len(texts)
+
+def report_row(sparsity, model, tokenizer, val_texts, val_targets, bench_texts, max_len, batch_size):
+    metrics = evaluate(model, tokenizer, val_texts, val_targets, max_len, batch_size)
+    return {"sparsity": sparsity,
+            "heads": sum(sizes[0] for sizes in model.layer_sizes) if model.layer_sizes
+                     else model.net.config.num_attention_heads * model.net.config.num_hidden_layers,
+            "params_m": sum(p.numel() for p in model.parameters()) / 1e6,
+            "d1_f1": metrics["f1_weighted"],
+            "d1_accuracy": metrics["accuracy"],
+            "ms_per_tweet_b1": ms_per_tweet(model, tokenizer, bench_texts, max_len, 1),
+            f"ms_per_tweet_b{batch_size}": ms_per_tweet(model, tokenizer, bench_texts, max_len, batch_size)}
+
+parser = argparse.ArgumentParser(description="Structurally prune the encoder of the multi-task model")
+parser.add_argument("dir", help="data directory")
+parser.add_argument("--checkpoint", default=None, help="checkpoint directory (default: <dir>/models/net_hydra)")
+parser.add_argument("--sparsities", default="0.2,0.4,0.6",
+                    help="comma separated fractions of heads and FFN neurons to remove")
+parser.add_argument("--finetune-steps", type=int, default=200)
+parser.add_argument("--batch-size", type=int, default=32)
+parser.add_argument("--bench-tweets", type=int, default=256, help="validation tweets timed for the latency report")
+parser.add_argument("--no-dedup", action="store_true",
+                    help="fine-tune on every copy of repeated tweets instead of weighted unique rows")
+runtime.add_runtime_args(parser)
+args = parser.parse_args()
+dir = args.dir
+
+# Heavy dependencies are imported once the arguments are parsed, so --help
+# and argument errors return without loading them
+import numpy as np
+import pandas as pd
+import torch
+from torch import cuda
+from tqdm import tqdm
+from checkpoint import load_checkpoint, load_tokenizer, save_checkpoint
+from metrics import confusion_matrix, metrics_from_confusion
+from tweet_data import load_splits
+device = 'cuda' if cuda.is_available() else 'cpu'
+
+runtime.configure_from_args(args)
+
+checkpoint = args.checkpoint or f"{dir}/models/net_hydra"
+sparsities = [float(sparsity) for sparsity in args.sparsities.split(",")]
+tokenizer = load_tokenizer(checkpoint)
+model, config = load_checkpoint(checkpoint, device=device)
+if model.layer_sizes:
+    parser.error(f"{checkpoint} is already pruned, start from an unpruned checkpoint")
+MAX_LEN = config["max_len"] or 512
+TRAIN_BATCH_SIZE = args.batch_size
+VALID_BATCH_SIZE = args.batch_size
+LEARNING_RATE = 2e-05
+
+# Same split as the training scripts
+splits = load_splits(dir, dedup=not args.no_dedup)
+d_train_data, d_val_data = splits.d_train, splits.d_val
+
+train_texts = d_train_data.text.astype(str).tolist()
+train_targets = torch.tensor(d_train_data.target.to_numpy(), dtype=torch.long)
+train_weights = torch.tensor(d_train_data.weight.to_numpy(), dtype=torch.float)
+val_texts = d_val_data.text.astype(str).tolist()
+val_targets = torch.tensor(d_val_data.target.to_numpy(), dtype=torch.long)
+bench_texts = val_texts[:args.bench_tweets]
+
+head_scores, neuron_scores = importance_scores(model, tokenizer, val_texts, val_targets, MAX_LEN, VALID_BATCH_SIZE)
+report_data = (tokenizer, val_texts, val_targets.numpy(), bench_texts, MAX_LEN, VALID_BATCH_SIZE)
+rows = [report_row(0.0, model, *report_data)]
+
+for sparsity in sparsities:
+    # Each sparsity starts again from the unpruned weights
+    model, _ = load_checkpoint(checkpoint, device=device)
+    model.tasks = (1,)
+    del model.pre_classifier2, model.dropout2, model.classifier2
+    model.prune_encoder(units_to_keep(head_scores, sparsity), units_to_keep(neuron_scores, sparsity))
+    finetune(model, tokenizer, train_texts, train_targets, train_weights, MAX_LEN, args.finetune_steps,
+             TRAIN_BATCH_SIZE, LEARNING_RATE)
+
+    output_path = f"{dir}/models/net_hydra_pruned{int(round(sparsity * 100))}"
+    save_checkpoint(model, output_path, tokenizer=tokenizer, max_len=MAX_LEN, label_maps=config["label_maps"])
+    print(f"Saved {output_path} with layer sizes (heads, FFN) {model.layer_sizes}")
+    rows.append(report_row(sparsity, model, *report_data))
+
+# Latency vs F1
+report = pd.DataFrame(rows)
+report["d1_f1_change"] = report.d1_f1 - report.d1_f1.iloc[0]
+report["speedup_b1"] = report.ms_per_tweet_b1.iloc[0] / report.ms_per_tweet_b1
+print(report.to_string(index=False))
+report.to_csv(f"{dir}/predicts/prune_report.csv", index=False)
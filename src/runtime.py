@@ -0,0 +1,136 @@
+import os
+import glob
+
+"""
+Runtime settings shared by the training and inference scripts: intra-op and
+inter-op thread pools, OpenMP/MKL thread counts and CPU affinity. Running
+several trainers or BO trials on one host without these oversubscribes the
+cores, so each process should get its own core set, e.g.
+
+    python src/multitask_hydra.py <dir> --cpus 0-15 --num-threads 16
+    torchrun --nproc_per_node 2 src/multitask_hydra.py <dir> --numa-node auto
+
+"""
+
+
+def add_runtime_args(parser):
+    group = parser.add_argument_group("runtime")
+    group.add_argument("--num-threads", type=int, default=None,
+                       help="intra-op threads (default: number of pinned cores)")
+    group.add_argument("--interop-threads", type=int, default=None,
+                       help="inter-op threads")
+    group.add_argument("--cpus", default=None,
+                       help="core list to pin to, e.g. 0-7,16-23, or 'auto' to split "
+                            "the available cores evenly between local ranks")
+    group.add_argument("--numa-node", default=None,
+                       help="NUMA node to pin to, or 'auto' to spread local ranks over nodes")
+    return parser
+
+def parse_cpu_list(spec):
+    cpus = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return sorted(set(cpus))
+
+def format_cpu_list(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{a}-{b}" if a != b else f"{a}" for a, b in ranges)
+
+def numa_nodes():
+    # {node id: [cpus]} as reported by sysfs, empty when not available
+    nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        node = int(os.path.basename(os.path.dirname(path))[len("node"):])
+        with open(path, "r") as f:
+            nodes[node] = parse_cpu_list(f.read())
+    return nodes
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def split_cpus(parts, cpus=None):
+    # Splits `cpus` (default the cores this process may use) into contiguous core sets
+    allowed = sorted(cpus) if cpus else available_cpus()
+    size = max(len(allowed) // parts, 1)
+    return [allowed[(i * size) % len(allowed):(i * size) % len(allowed) + size] for i in range(parts)]
+
+def select_cpus(cpus=None, numa_node=None, local_rank=0, local_world_size=1):
+    if numa_node is not None:
+        nodes = numa_nodes()
+        if not nodes:
+            print("NUMA topology not available, ignoring --numa-node")
+        else:
+            node_ids = sorted(nodes)
+            node = node_ids[local_rank % len(node_ids)] if numa_node == "auto" else int(numa_node)
+            if node not in nodes:
+                raise ValueError(f"Unknown NUMA node {node}, available: {node_ids}")
+            allowed = set(available_cpus())
+            node_cpus = [c for c in nodes[node] if c in allowed]
+            if numa_node == "auto":
+                # Ranks sharing a node split its cores
+                ranks_on_node = [r for r in range(local_world_size) if node_ids[r % len(node_ids)] == node]
+                chunks = [node_cpus[i::len(ranks_on_node)] for i in range(len(ranks_on_node))]
+                node_cpus = sorted(chunks[ranks_on_node.index(local_rank)])
+            return node_cpus
+    if cpus == "auto":
+        return split_cpus(local_world_size)[local_rank % local_world_size]
+    if cpus is not None:
+        return parse_cpu_list(cpus)
+    return None
+
+def configure_runtime(num_threads=None, interop_threads=None, cpus=None, numa_node=None):
+    # Imported here so that scripts can parse their arguments before loading torch
+    import torch
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+
+    pinned = select_cpus(cpus, numa_node, local_rank, local_world_size)
+    if pinned:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, pinned)
+        else:
+            print("CPU affinity is not supported on this platform, ignoring")
+        if num_threads is None:
+            num_threads = len(pinned)
+
+    if num_threads is not None:
+        # Environment is inherited by DataLoader workers and other child processes
+        os.environ["OMP_NUM_THREADS"] = str(num_threads)
+        os.environ["MKL_NUM_THREADS"] = str(num_threads)
+        torch.set_num_threads(num_threads)
+
+    if interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            # Can only be set once, before any inter-op parallel work has started
+            print(f"Could not set inter-op threads: {e}")
+
+    settings = {"local_rank": local_rank,
+                "num_threads": torch.get_num_threads(),
+                "interop_threads": torch.get_num_interop_threads(),
+                "omp_num_threads": os.environ.get("OMP_NUM_THREADS"),
+                "mkl_num_threads": os.environ.get("MKL_NUM_THREADS"),
+                "cpus": format_cpu_list(available_cpus())}
+    print(f"Runtime settings: {settings}")
+    return settings
+
+def configure_from_args(args):
+    return configure_runtime(num_threads=args.num_threads,
+                             interop_threads=args.interop_threads,
+                             cpus=args.cpus,
+                             numa_node=args.numa_node)
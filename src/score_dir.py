@@ -0,0 +1,76 @@
+import argparse
+import runtime
+
+"""
+This script scores every tweet file under a directory, e.g. the daily dumps
+of a collector, with the multi-task model (Task 1 head, --model hydra) or
+the Strategy 1 model. Each input file is a CSV with id and text columns and
+gets a prediction file of the same relative path under --output-dir.
+
+Files are shared by --workers inference processes, each pinned to its share
+of the cores (--cpus or all available ones), see bulk_scoring.py. The
+multi-task checkpoint is memory-mapped, so the workers share one copy of
+its weights. Completed files and the rows done in partly scored ones are
+recorded in <output-dir>/manifest.jsonl: running the same command again
+after an interruption skips the completed files and continues the others
+where they stopped, and also picks up new or changed files.
+
+"""
+
+
+parser = argparse.ArgumentParser(description="Score every tweet file of a directory")
+parser.add_argument("dir", help="data directory")
+parser.add_argument("input", help="directory of tweet files (CSV with id and text columns)")
+parser.add_argument("--pattern", default="*.csv", help="file name pattern, searched in subdirectories too")
+parser.add_argument("--output-dir", default=None, help="prediction files and manifest (default: <dir>/predicts/bulk)")
+parser.add_argument("--model", choices=["hydra", "strategy1"], default="hydra")
+parser.add_argument("--checkpoint", default=None,
+                    help="model directory (default: <dir>/models/net_hydra or <dir>/trainer_results)")
+parser.add_argument("--exit-threshold", type=float, default=None,
+                    help="stop each tweet at the first early exit this confident (hydra checkpoints from early_exit.py)")
+parser.add_argument("--workers", type=int, default=2, help="inference processes")
+parser.add_argument("--batch-size", type=int, default=32)
+parser.add_argument("--chunk-size", type=int, default=10000,
+                    help="tweets read from a file at a time, the progress is recorded after each chunk")
+parser.add_argument("--keep-probs", action="store_true",
+                    help="add the label, its score and the probability of each class to the prediction files")
+runtime.add_runtime_args(parser)
+args = parser.parse_args()
+dir = args.dir
+if args.exit_threshold is not None and args.model != "hydra":
+    parser.error("--exit-threshold needs --model hydra")
+
+# Heavy dependencies are imported once the arguments are parsed, so --help
+# and argument errors return without loading them
+import sys
+import time
+from prediction_cache import model_version
+from bulk_scoring import Manifest, discover_files, plan_jobs, run_scoring
+
+if __name__ == "__main__":
+    # Only restricts the cores the workers split between them
+    runtime.configure_from_args(args)
+
+    checkpoint = args.checkpoint or (f"{dir}/models/net_hydra" if args.model == "hydra" else f"{dir}/trainer_results")
+    output_dir = args.output_dir or f"{dir}/predicts/bulk"
+    # Records of another model or other output columns do not count
+    settings = {"model": args.model, "version": model_version(checkpoint), "exit_threshold": args.exit_threshold,
+                "keep_probs": args.keep_probs}
+
+    manifest = Manifest(f"{output_dir}/manifest.jsonl")
+    files = discover_files(args.input, args.pattern, exclude=output_dir)
+    jobs, done = plan_jobs(files, manifest, output_dir, settings)
+    resumed = sum(1 for job in jobs if job.rows)
+    print(f"{len(files)} files under {args.input}: {done} already scored, {resumed} to resume, "
+          f"{len(jobs) - resumed} to score")
+
+    start = time.perf_counter()
+    errors = run_scoring(jobs, manifest, settings, (args.model, checkpoint, args.exit_threshold),
+                         workers=args.workers, batch_size=args.batch_size, chunk_size=args.chunk_size,
+                         keep_probs=args.keep_probs)
+    manifest.close()
+    print(f"Scored {len(jobs) - len(errors)} files in {time.perf_counter() - start:.1f}s, "
+          f"predictions in {output_dir}")
+    if errors:
+        print(f"{len(errors)} files failed and will be retried by the next run: {', '.join(sorted(errors))}")
+        sys.exit(1)
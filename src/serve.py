@@ -0,0 +1,231 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import runtime
+from predictor import HydraPredictor, Strategy1Predictor
+from prediction_cache import add_cache_args, cache_from_args
+from compiled import add_compile_args, parse_lengths
+
+"""
+This script serves disaster tweet predictions over HTTP. Incoming tweets are
+queued and run through the model in micro-batches, a batch is started once
+it holds --max-batch-size tweets or its first tweet has waited
+--max-wait-ms. Requests arriving while a batch runs form the next one.
+
+    POST /predict   {"text": "..."} or {"texts": ["...", ...]}
+    GET  /metrics   request latency percentiles, throughput, batch sizes and,
+                    with --cache-size, prediction cache hit rates (and the
+                    average encoder layers run with --exit-threshold)
+    GET  /health
+
+Use loadgen.py to drive it for capacity testing. With --compile the
+multi-task model runs compiled graphs for a few batch shapes, compiled
+before the server starts listening (see compiled.py).
+
+"""
+
+STATUS = {200: "200 OK", 400: "400 Bad Request", 404: "404 Not Found", 500: "500 Internal Server Error"}
+
+
+class ServerStats:
+    def __init__(self, window=10000):
+        # Percentiles are over the last `window` requests and batches
+        self.started = time.perf_counter()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.requests = 0
+        self.tweets = 0
+        self.batches = 0
+        self.errors = 0
+
+    def record_request(self, latency, tweets):
+        self.latencies.append(latency)
+        self.requests += 1
+        self.tweets += tweets
+
+    def record_batch(self, size):
+        self.batch_sizes.append(size)
+        self.batches += 1
+
+    def summary(self):
+        uptime = time.perf_counter() - self.started
+        latencies = np.array(self.latencies) * 1000
+        percentiles = np.percentile(latencies, [50, 90, 99]) if len(latencies) else [0.0, 0.0, 0.0]
+        return {"uptime_s": uptime,
+                "requests": self.requests,
+                "tweets": self.tweets,
+                "errors": self.errors,
+                "batches": self.batches,
+                "throughput_rps": self.requests / uptime if uptime else 0.0,
+                "throughput_tweets_per_s": self.tweets / uptime if uptime else 0.0,
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                "latency_ms": {"p50": float(percentiles[0]),
+                               "p90": float(percentiles[1]),
+                               "p99": float(percentiles[2]),
+                               "mean": float(latencies.mean()) if len(latencies) else 0.0}}
+
+class MicroBatcher:
+    def __init__(self, predict, max_batch_size, max_wait_ms, stats):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = stats
+        self.queue = asyncio.Queue()
+        # The model runs on one thread, off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, texts):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            self.queue.put_nowait((text, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.predict, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats.record_batch(len(batch))
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+class PredictionServer:
+    def __init__(self, batcher, stats, cache=None, model=None):
+        self.batcher = batcher
+        self.stats = stats
+        self.cache = cache
+        self.model = model
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            summary = self.stats.summary()
+            if self.cache is not None:
+                summary["cache"] = self.cache.stats()
+            if hasattr(self.model, "average_layers"):
+                summary["average_layers"] = self.model.average_layers
+            return 200, summary
+        if method == "POST" and path == "/predict":
+            try:
+                payload = json.loads(body or b"{}")
+                texts = [payload["text"]] if "text" in payload else payload["texts"]
+            except (ValueError, KeyError, TypeError):
+                texts = None
+            # Anything else than strings would reach the tokenizer and fail the whole batch
+            if not isinstance(texts, list) or not texts or not all(isinstance(text, str) for text in texts):
+                return 400, {"error": 'expected {"text": "..."} or {"texts": ["...", ...]}'}
+            start = time.perf_counter()
+            try:
+                results = await self.predict(texts)
+            except Exception as e:
+                self.stats.errors += 1
+                return 500, {"error": str(e)}
+            self.stats.record_request(time.perf_counter() - start, len(texts))
+            return 200, {"prediction": results[0]} if "text" in payload else {"predictions": results}
+        return 404, {"error": f"no route for {method} {path}"}
+
+    async def predict(self, texts):
+        # Cached tweets are answered here, only the misses are queued for the model
+        if self.cache is None:
+            return await self.batcher.submit(texts)
+        keys, results, missing = self.cache.lookup(texts)
+        if missing:
+            values = await self.batcher.submit(list(missing.values()))
+            results = self.cache.fill(keys, results, missing, values)
+        return results
+
+    async def handle(self, reader, writer):
+        # Minimal HTTP/1.1 with keep-alive, enough for JSON clients and loadgen.py
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self.route(method, path.split("?")[0], body)
+                data = json.dumps(payload).encode()
+                writer.write(f"HTTP/1.1 {STATUS[status]}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def main(args, predictor, cache=None):
+    stats = ServerStats()
+    batcher = MicroBatcher(predictor.predict, args.max_batch_size, args.max_wait_ms, stats)
+    server = PredictionServer(batcher, stats, cache, predictor)
+    batch_task = asyncio.create_task(batcher.run())
+    http = await asyncio.start_server(server.handle, args.host, args.port)
+    print(f"Serving on http://{args.host}:{args.port} "
+          f"(max batch {args.max_batch_size}, max wait {args.max_wait_ms}ms)")
+    async with http:
+        await http.serve_forever()
+    batch_task.cancel()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve disaster tweet predictions over HTTP")
+    model = parser.add_mutually_exclusive_group(required=True)
+    model.add_argument("--checkpoint", help="multi-task model checkpoint directory")
+    model.add_argument("--strategy1", help="Strategy 1 model directory")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--exit-threshold", type=float, default=None,
+                        help="early-exit confidence threshold for --checkpoint")
+    add_cache_args(parser)
+    add_compile_args(parser)
+    runtime.add_runtime_args(parser)
+    args = parser.parse_args()
+    runtime.configure_from_args(args)
+
+    predictor = (HydraPredictor(args.checkpoint, exit_threshold=args.exit_threshold, compile=args.compile,
+                                max_batch_size=args.max_batch_size, compile_mode=args.compile_mode,
+                                compile_lengths=parse_lengths(args.compile_lengths)) if args.checkpoint
+                 else Strategy1Predictor(args.strategy1))
+    # Warm-up, so the first request does not pay for lazy initialisation
+    predictor.predict(["warm up"])
+    cache = cache_from_args(args, args.checkpoint or args.strategy1, {"exit_threshold": args.exit_threshold})
+    asyncio.run(main(args, predictor, cache))
@@ -0,0 +1,72 @@
+import argparse
+import runtime
+
+"""
+This script finds the tweets of an exported corpus (see
+export_embeddings.py) most similar to new tweets, or to tweets of the
+corpus given by id. Only the query tweets are run through the model, the
+corpus is searched through its IVF index (or scanned with --exact) over
+the memory-mapped embeddings. Prints the neighbours with their cosine
+similarity, and the search time of each query.
+
+"""
+
+
+parser = argparse.ArgumentParser(description="Find the most similar tweets of an exported corpus")
+parser.add_argument("dir", help="data directory")
+parser.add_argument("texts", nargs="*", help="query tweets")
+parser.add_argument("--id", nargs="+", default=[], help="ids of corpus tweets to query")
+parser.add_argument("--embeddings-dir", default=None, help="exported embeddings and index (default: <dir>/embeddings)")
+parser.add_argument("--checkpoint", default=None,
+                    help="checkpoint embedding the query tweets (default: the one of the export)")
+parser.add_argument("--k", type=int, default=10, help="neighbours per query")
+parser.add_argument("--nprobe", type=int, default=8, help="index clusters searched per query")
+parser.add_argument("--exact", action="store_true", help="scan every embedding instead of using the index")
+runtime.add_runtime_args(parser)
+args = parser.parse_args()
+dir = args.dir
+if not args.texts and not args.id:
+    parser.error("give query tweets or --id")
+
+# Heavy dependencies are imported once the arguments are parsed, so --help
+# and argument errors return without loading them
+import time
+import numpy as np
+from prediction_cache import model_version
+from embedding_index import IVFIndex, load_embeddings, load_tweets, load_meta, exact_search
+
+runtime.configure_from_args(args)
+
+embeddings_dir = args.embeddings_dir or f"{dir}/embeddings"
+meta = load_meta(embeddings_dir)
+embeddings = load_embeddings(embeddings_dir)
+tweets = load_tweets(embeddings_dir)
+index = IVFIndex.load(embeddings_dir)
+
+queries, vectors = [], []
+if args.id:
+    rows = {str(tweet_id): row for row, tweet_id in enumerate(tweets["id"])}
+    missing = [tweet_id for tweet_id in args.id if tweet_id not in rows]
+    if missing:
+        parser.error(f"ids not in the corpus: {', '.join(missing)}")
+    queries += [f"id {tweet_id}: {tweets.text[rows[tweet_id]]}" for tweet_id in args.id]
+    vectors += [embeddings[rows[tweet_id]].astype(np.float32) for tweet_id in args.id]
+if args.texts:
+    from predictor import HydraPredictor
+    checkpoint = args.checkpoint or meta["checkpoint"]
+    if model_version(checkpoint) != meta["version"]:
+        print(f"{checkpoint} changed since the export, similarities mix two models; run export_embeddings.py again")
+    queries += args.texts
+    vectors += list(HydraPredictor(checkpoint).embed(args.texts))
+
+for query, vector in zip(queries, vectors):
+    start = time.perf_counter()
+    if args.exact:
+        found, scores = exact_search(embeddings, index.norms, vector, args.k)
+    else:
+        found, scores = index.search(embeddings, vector, args.k, args.nprobe)
+    milliseconds = (time.perf_counter() - start) * 1000
+    print(f"\n{query}  ({'exact scan' if args.exact else 'index'}, {milliseconds:.2f} ms)")
+    for rank, (row, score) in enumerate(zip(found[0], scores[0]), start=1):
+        if row >= 0:
+            print(f"{rank:3d}  {score:.3f}  {tweets['id'][row]}  {tweets.text[row]}")
@@ -0,0 +1,121 @@
+import os
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from transformers import RobertaTokenizer, TrainingArguments, Trainer
+from transformers.trainer_utils import get_last_checkpoint
+from transformers import AutoModelForSequenceClassification
+import evaluate
+from tweet_data import read_disaster, split_task
+
+"""
+Trainer of our team's Strategy 1: the sentiment model
+siebert/sentiment-roberta-large-english fine-tuned on the disaster tweets
+with the Hugging Face Trainer. The tweets are split like the other
+trainers (tweet_data.split_task), so the validation tweets are the same.
+
+    trainer = Strategy1Trainer(Strategy1Config(dir))
+    trainer.run()
+
+"""
+
+
+@dataclass
+class Strategy1Config:
+    dir: str
+    tokenizer: str = "roberta-large"
+    model: str = "siebert/sentiment-roberta-large-english"
+    learning_rate: float = 1e-5
+    epochs: int = 3
+    train_batch_size: int = 16
+    valid_batch_size: int = 32
+    checkpoint_steps: int = 500
+    resume: bool = False
+    seed: int = 2023
+    # Trainer checkpoints, <dir>/models/results by default
+    output: Optional[str] = None
+
+
+class HuggingData(Dataset):
+  def __init__(self, encodings, labels):
+    self.encodings = encodings
+    self.labels = labels
+
+  def __getitem__(self, idx):
+      item = {key: torch.tensor(val[idx]) for key, val in self.encodings.items()}
+      item['labels'] = torch.tensor(self.labels[idx])
+      return item
+
+  def __len__(self):
+      return len(self.labels)
+
+
+class Strategy1Trainer:
+    def __init__(self, config, tokenizer=None, datasets=None):
+        self.config = config
+        self.output = config.output or f"{config.dir}/models/results"
+        self.logs = f"{config.dir}/models/logs"
+        self.metric = evaluate.load("accuracy")
+
+        if datasets is not None:
+            # (train, validation) datasets with HuggingData items, e.g. the folds of crossval.py
+            self.tokenizer = tokenizer
+            self.train_dataset, self.val_dataset = datasets
+        else:
+            self.tokenizer = tokenizer or RobertaTokenizer.from_pretrained(config.tokenizer, do_lower_case=True)
+            d_train_data, d_val_data = split_task(read_disaster(config.dir), config.seed)
+            self.train_dataset = self.dataset(d_train_data)
+            self.val_dataset = self.dataset(d_val_data)
+
+    def dataset(self, df):
+        encodings = self.tokenizer(df.text.tolist(), truncation=True, padding="max_length", add_special_tokens=True,
+                                   return_token_type_ids=True)
+        return HuggingData(encodings, df.target)
+
+    def compute_metrics(self, eval_pred):
+        logits, labels = eval_pred
+        predictions = np.argmax(logits, axis=-1)
+        return self.metric.compute(predictions=predictions, references=labels)
+
+    def trainer(self, model=None):
+        config = self.config
+        training_args = TrainingArguments(
+            output_dir=self.output,
+            optim="adamw_torch",
+            num_train_epochs=config.epochs,
+            learning_rate= config.learning_rate,
+            lr_scheduler_type = "cosine",
+            per_device_train_batch_size=config.train_batch_size,
+            per_device_eval_batch_size=config.valid_batch_size,
+            save_strategy="steps" if config.checkpoint_steps > 0 else "no",
+            save_steps=max(config.checkpoint_steps, 1),
+            save_total_limit=2,
+            warmup_steps= 10,
+            weight_decay = 0.01,
+            logging_dir=self.logs,
+            logging_strategy="steps",
+            logging_steps=100,
+            evaluation_strategy="steps",
+            eval_steps=100
+        )
+        return Trainer(
+            model=model if model is not None else AutoModelForSequenceClassification.from_pretrained(config.model),
+            args=training_args,
+            train_dataset=self.train_dataset,
+            eval_dataset=self.val_dataset,
+            compute_metrics=self.compute_metrics
+        )
+
+    def run(self, model=None):
+        trainer = self.trainer(model)
+        # Trainer checkpoints hold model, optimizer, scheduler, RNG states and the data position
+        output = self.output
+        last_checkpoint = get_last_checkpoint(output) if self.config.resume and os.path.isdir(output) else None
+        if self.config.resume and last_checkpoint is None:
+            print(f"No checkpoint found in {output}, starting from scratch")
+        trainer.train(resume_from_checkpoint=last_checkpoint)
+
+        trainer.save_model(f"{self.config.dir}/models/")
+        return trainer
@@ -0,0 +1,157 @@
+import torch
+from tqdm import tqdm
+import wandb
+from evaluation import PredictionCollector
+from profiling import NO_TIMER
+
+"""
+Training and validation loops of a model trained on one task (Task 1 or
+Task 2 separately, see learn_multitask.py). `mode` picks the head of
+NetMultiTask that is scored. Rows may carry a count weight from dedup.py,
+losses and accuracies are weighted by it. Metrics go to wandb through
+`log`, and `timer` (a profiling.PhaseTimer) times each phase of a step.
+With accumulation_steps the gradients of several batches are summed before
+each optimizer step.
+
+"""
+
+# Per-row loss, averaged with the row weights in weighted_loss
+loss_function = torch.nn.CrossEntropyLoss(reduction='none')
+
+
+def log_metrics(metrics):
+    wandb.log({**metrics})
+
+def calcuate_accuracy(preds, targets, weights):
+    n_correct = ((preds==targets) * weights).sum().item()
+    return n_correct
+
+# Mean loss over the batch, each row standing for `weights` identical tweets
+def weighted_loss(output, targets, weights):
+    return (loss_function(output, targets) * weights).sum() / weights.sum()
+
+def task_output(outputs, mode):
+    if mode == 1:
+        return outputs[0]
+    elif mode == 2:
+        return outputs[1]
+    else:
+        assert False, 'Bad Task ID passed'
+
+# Training loop for multi-task learning to take into account the two outputs
+def train_task(model, optimizer, training_loader, testing_loader, mode, epoch=0, checkpointer=None, global_step=0,
+               start_batch=0, log=log_metrics, timer=NO_TIMER, accumulation_steps=1):
+    # The optimizer steps every accumulation_steps batches and after the last batch of the epoch
+    device = next(model.parameters()).device
+    num_batches = len(training_loader)
+    tr_loss = 0
+    n_correct = 0
+    nb_tr_steps = 0
+    nb_tr_examples = 0
+
+    tr_loss_val = 0
+    n_correct_val = 0
+    nb_tr_steps_val = 0
+    nb_tr_examples_val = 0
+
+    model.train()
+
+    for loop,data in enumerate(timer.iterate(tqdm(training_loader, 0))):
+        with timer.phase("to_device"):
+            ids = data['ids'].to(device, dtype = torch.long)
+            mask = data['mask'].to(device, dtype = torch.long)
+            #token_type_ids = data['token_type_ids'].to(device, dtype = torch.long)
+            targets = data['targets'].to(device, dtype = torch.long)
+            weights = data['weight'].to(device)
+
+        with timer.phase("forward"):
+            output = task_output(model(ids, mask), mode)
+
+        with timer.phase("loss"):
+            loss = weighted_loss(output, targets, weights)
+
+        with timer.phase("metrics"):
+            tr_loss += loss.item()
+            big_val, big_idx = torch.max(output.data, dim=1)
+            n_correct += calcuate_accuracy(big_idx, targets, weights)
+
+            nb_tr_steps += 1
+            nb_tr_examples+=weights.sum().item()
+
+            loss_step = tr_loss/nb_tr_steps
+            accu_step = (n_correct*100)/nb_tr_examples
+
+            train_metrics = {"train_loss": loss_step,
+                             "train_accuracy": accu_step}
+
+        with timer.phase("logging"):
+            log(train_metrics)
+
+        sync_step = (loop + 1) % accumulation_steps == 0 or loop + 1 == num_batches
+        with timer.phase("backward"):
+            if loop % accumulation_steps == 0:
+                optimizer.zero_grad()
+            (loss / accumulation_steps).backward()
+        # # When using GPU
+        if sync_step:
+            with timer.phase("optimizer"):
+                optimizer.step()
+            global_step += 1
+
+        if sync_step and checkpointer is not None and checkpointer.should_save(global_step):
+            with timer.phase("checkpoint"):
+                checkpointer.save(global_step, epoch, start_batch + loop + 1, model, optimizer)
+        timer.step()
+
+    model.eval()
+    with torch.no_grad():
+        for _, data in enumerate(timer.iterate(testing_loader, "val_data")):
+            with timer.phase("val_to_device"):
+                ids_val = data['ids'].to(device, dtype = torch.long)
+                mask_val = data['mask'].to(device, dtype = torch.long)
+                #token_type_ids_val = data['token_type_ids'].to(device, dtype = torch.long)
+                targets_val = data['targets'].to(device, dtype = torch.long)
+                weights_val = data['weight'].to(device)
+
+            with timer.phase("val_forward"):
+                output_val = task_output(model(ids_val, mask_val), mode)
+
+            with timer.phase("val_metrics"):
+                loss_val = weighted_loss(output_val, targets_val, weights_val)
+                tr_loss_val += loss_val.item()
+                big_val_val, big_idx_val = torch.max(output_val.data, dim=1)
+                n_correct_val += calcuate_accuracy(big_idx_val, targets_val, weights_val)
+
+                nb_tr_steps_val += 1
+                nb_tr_examples_val += weights_val.sum().item()
+
+                loss_step_val = tr_loss_val/nb_tr_steps_val
+                accu_step_val = (n_correct_val*100)/nb_tr_examples_val
+
+            val_metrics = {"val_loss": loss_step_val,
+                "val_accuracy": accu_step_val}
+
+        log(val_metrics)
+
+    return global_step
+
+def valid_task(model, testing_loader, mode, keep_probs=False, timer=NO_TIMER, writer=None):
+    device = next(model.parameters()).device
+    model.eval()
+    predicts = PredictionCollector(num_classes=2 if mode == 1 else 3,
+                                   size=len(testing_loader.dataset), keep_probs=keep_probs, writer=writer)
+
+    with torch.no_grad():
+        for _, data in enumerate(timer.iterate(tqdm(testing_loader, 0), "val_data")):
+            with timer.phase("val_to_device"):
+                ids = data['ids'].to(device, dtype = torch.long)
+                mask = data['mask'].to(device, dtype = torch.long)
+                #token_type_ids = data['token_type_ids'].to(device, dtype = torch.long)
+                targets = data['targets'].to(device, dtype = torch.long)
+
+            with timer.phase("val_forward"):
+                output = task_output(model(ids, mask), mode)
+
+            with timer.phase("val_collect"):
+                predicts.update(output.data, targets)
+    return predicts
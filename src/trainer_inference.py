@@ -1,61 +1,65 @@
-import sys
-import numpy as np 
-import pandas as pd
-import torch
-import transformers
-from transformers import RobertaTokenizer, RobertaModel
-from torch.utils.data import Dataset, DataLoader
-from torch import cuda
-from tqdm import tqdm
-device = 'cuda:0' if cuda.is_available() else 'cpu'
-from transformers import pipeline
+import argparse
+import runtime
+from prediction_cache import add_cache_args, cached_from_args
+from profiling import add_profiling_args, timer_from_args
 
 """
-This code creates a pipline for inference on Strategy 1 model
+This code creates a pipline for inference on Strategy 1 model. The train
+and test tweets are read in chunks and their predictions streamed, id by
+id, to submit_train.csv and submit_test.csv by background writers (see
+prediction_writer.py). With --cache-size repeated tweets are scored once,
+see prediction_cache.py. --profile times the pipeline calls, see
+profiling.py.
 
 """
 
 
-def data_iterator(df):
-    for i in range(df.shape[0]):
-        yield str(df.text[i])
-
-def get_predict(iterator, pipeline):
-    df = pd.DataFrame(columns = ['label', 'score'])
-    for idx, out in enumerate(tqdm(pipeline(iterator))):
-        df.loc[idx] = out
-    return df
-
-def clean_submit(preds):
-    df = preds.copy()
-    df.reset_index(inplace=True)
-    df.rename(columns = {'index':'id'}, inplace = True)
-    df.set_index("id", inplace=True)
-    df['target'] = df.apply(lambda x: 1 if x['label'] == 'POSITIVE' else 0, axis = 1)
-    df.drop(columns=['score', 'label'], inplace=True)
-    return df
+def write_predict(tweets, predictor, batch_size, writer, timer, keep_probs=False):
+    # tweets: DataFrames with id and text columns, e.g. the chunks of read_csv
+    progress = tqdm(unit="tweets")
+    for chunk in tweets:
+        ids, texts = chunk["id"].tolist(), chunk.text.astype(str).tolist()
+        for start in range(0, len(texts), batch_size):
+            results = predictor.predict(texts[start:start + batch_size])
+            writer.write(prediction_frame(ids[start:start + batch_size], results, keep_probs))
+            progress.update(len(results))
+            timer.step()
+    progress.close()
 
-dir = sys.argv[1]
-d_train = pd.read_csv(f"{dir}/train.csv")
-d_test = pd.read_csv(f"{dir}/test.csv")
+parser = argparse.ArgumentParser(description="Predict with the Strategy 1 model")
+parser.add_argument("dir", help="data directory")
+parser.add_argument("--batch-size", type=int, default=32)
+parser.add_argument("--keep-probs", action="store_true",
+                    help="add the label, its score and the probability of each class to the prediction files")
+parser.add_argument("--chunk-size", type=int, default=10000, help="tweets read from each csv at a time")
+add_cache_args(parser)
+add_profiling_args(parser)
+runtime.add_runtime_args(parser)
+args = parser.parse_args()
+dir = args.dir
 
-tokenizer = RobertaTokenizer.from_pretrained('roberta-large')
-disaster = pipeline("text-classification", model=f"{dir}/trainer_results", 
-                    tokenizer = tokenizer, device=device, function_to_apply="softmax")
-
-
-preds_train = get_predict(data_iterator(d_train), disaster)
-preds_test = get_predict(data_iterator(d_test), disaster)
+# Heavy dependencies are imported once the arguments are parsed, so --help
+# and argument errors return without loading them
+import pandas as pd
+from torch import cuda
+from tqdm import tqdm
+from predictor import Strategy1Predictor
+from prediction_writer import PredictionWriter, prediction_frame
+device = 'cuda:0' if cuda.is_available() else 'cpu'
 
-submit_train = clean_submit(preds_train)
-submit_test = clean_submit(preds_test)
+runtime.configure_from_args(args)
 
-d_test.reset_index(inplace=True)
-submit_test.reset_index(inplace=True)
-test = d_test[["id"]].copy()
-merged = test.merge(submit_test, left_index=True, right_index=True, suffixes=(None, "_s"))
-merged.drop(labels=["id_s"],axis=1,inplace=True)
-merged.set_index("id",inplace=True)
+model_dir = f"{dir}/trainer_results"
+timer = timer_from_args(args)
+disaster = cached_from_args(args, Strategy1Predictor(model_dir, device=device, timer=timer), model_dir)
 
-submit_train.to_csv("submit_train.csv")
-merged.to_csv("submit_test.csv")
\ No newline at end of file
+for split in ("train", "test"):
+    with PredictionWriter(f"submit_{split}.csv") as writer:
+        write_predict(pd.read_csv(f"{dir}/{split}.csv", chunksize=args.chunk_size), disaster, args.batch_size,
+                      writer, timer, keep_probs=args.keep_probs)
+    print(f"Wrote {writer.rows} predictions to submit_{split}.csv")
+timer.close()
+if hasattr(disaster, "cache"):
+    print(f"Prediction cache: {disaster.cache.stats()}")
+    disaster.cache.close()
+timer.print_summary()
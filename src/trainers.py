@@ -0,0 +1,506 @@
+import copy
+from dataclasses import dataclass, replace
+from typing import Optional
+import torch
+from torch import cuda
+from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from transformers import RobertaModel, RobertaTokenizer
+from sklearn.metrics import classification_report
+import wandb
+import distributed
+from hydra_model import NetMultiTask, DISASTER_LABELS, SENTIMENT_LABELS
+from hydra_training import train_hydra, valid_hydra, log_metrics, packing_inputs
+from task_training import train_task, valid_task
+from checkpoint import save_checkpoint, TrainingCheckpointer, latest_training_checkpoint, resume_training
+from profiling import NO_TIMER
+from packing import PackedData, collate_packed
+from loss_weighting import make_weighting
+from batch_sizing import find_batch_size, accumulation_for
+from compiled import CompiledForward, padded_collate, warm_up, measure_speedup
+from prediction_writer import PredictionWriter
+from tweet_data import load_splits, combine_tasks, DataCombined, DisasterData, SentimentData
+
+"""
+Trainers of the multi-task model, importable so that many runs can share
+one process. A trainer reads the data, builds its loaders and loads the
+pretrained encoder once; every model it hands out starts from a copy of
+that encoder.
+
+    trainer = HydraTrainer(HydraConfig(dir))
+    model = trainer.new_model()
+    trainer.train(model, lambda1=0.7, lambda2=0.4)
+    d1_predict, d2_predict = trainer.evaluate(model)
+
+HydraTrainer trains both heads (multitask_hydra.py), SingleTaskTrainer one
+task at a time (learn_multitask.py). run() is the full pipeline of the
+scripts.
+
+"""
+
+LABEL_MAPS = {"disaster": DISASTER_LABELS, "sentiment": SENTIMENT_LABELS}
+
+
+@dataclass
+class HydraConfig:
+    dir: str
+    encoder: str = "roberta-base"
+    max_len: int = 512
+    train_batch_size: int = 32
+    valid_batch_size: int = 32
+    learning_rate: float = 1e-05
+    epochs: int = 2
+    lambda1: float = 0.6899408753961325
+    lambda2: float = 0.4041465884074569
+    # Task loss weights, "fixed" (lambda1/lambda2) or learnt online, see loss_weighting.py
+    loss_weighting: str = "fixed"
+    checkpoint_steps: int = 500
+    resume: bool = False
+    keep_probs: bool = False
+    dedup: bool = True
+    seed: int = 2023
+    # Training rows of several tweets (packing.py), batches of packed_batch_size rows
+    pack: bool = False
+    packed_batch_size: int = 2
+    # Activation checkpointing of the encoder, and batches summed per optimizer step
+    gradient_checkpointing: bool = False
+    accumulation_steps: int = 1
+    # torch.compile forward for training and validation, see compiled.py
+    compile: bool = False
+    compile_mode: str = "default"
+    # Training metrics are computed and logged every log_steps batches
+    log_steps: int = 10
+    # None trains without wandb
+    wandb_project: Optional[str] = "bt5151_hydra"
+    wandb_group: Optional[str] = "fix_loss"
+
+@dataclass
+class SingleTaskConfig:
+    dir: str
+    task: int = 1
+    encoder: str = "roberta-base"
+    max_len: int = 512
+    train_batch_size: int = 8
+    valid_batch_size: int = 32
+    learning_rate: float = 1e-05
+    epochs: int = 2
+    checkpoint_steps: int = 500
+    resume: bool = False
+    keep_probs: bool = False
+    dedup: bool = True
+    seed: int = 2023
+    gradient_checkpointing: bool = False
+    accumulation_steps: int = 1
+    wandb_project: Optional[str] = "bt5151_multitask"
+
+
+def training_device():
+    if distributed.is_distributed() and cuda.is_available():
+        return f"cuda:{distributed.get_local_rank()}"
+    return 'cuda' if cuda.is_available() else 'cpu'
+
+def wandb_login(dir):
+    with open(f"{dir}/wandb_key.txt", "r") as f:
+        wandb_key = f.read()
+    wandb.login(key=wandb_key)
+
+def no_log(metrics):
+    pass
+
+def training_tokenizer(config, tokenizer=None):
+    if tokenizer is not None:
+        return tokenizer
+    return RobertaTokenizer.from_pretrained(config.encoder, do_lower_case=True)
+
+def restart_point(checkpoint_dir, resume, model, optimizer, scheduler=None, loader_generator=None,
+                  loss_weighting=None):
+    # (global_step, epoch, batch in epoch) of the latest training checkpoint with resume
+    if not resume or checkpoint_dir is None:
+        return 0, 0, 0
+    last_checkpoint = latest_training_checkpoint(checkpoint_dir)
+    if last_checkpoint is None:
+        print(f"No checkpoint found in {checkpoint_dir}, starting from scratch")
+        return 0, 0, 0
+    return resume_training(last_checkpoint, model, optimizer, scheduler, rank=distributed.get_rank(),
+                           loader_generator=loader_generator, loss_weighting=loss_weighting)
+
+def probe_inputs(loader, size, device):
+    # Model inputs of a training batch of `size` rows of the loader's dataset, for find_batch_size
+    dataset = loader.dataset
+    data = loader.collate_fn([dataset[index % len(dataset)] for index in range(size)])
+    inputs = {"input_ids": data['ids'].to(device, dtype = torch.long),
+              "attention_mask": data['mask'].to(device, dtype = torch.long)}
+    if 'token_type_ids' in data:
+        inputs["token_type_ids"] = data['token_type_ids'].to(device, dtype = torch.long)
+    return {**inputs, **packing_inputs(data, device)}
+
+def memory_budget_batch(model, loader, budget, effective_batch_size, device):
+    # (batch size, accumulation steps) of the largest batch of the loader that fits `budget` bytes
+    fitted = find_batch_size(model, lambda size: probe_inputs(loader, size, device), budget,
+                             max_batch_size=effective_batch_size)
+    batch_size, accumulation_steps = accumulation_for(effective_batch_size, fitted)
+    print(f"Training batch size {batch_size} with {accumulation_steps} accumulation steps "
+          f"(effective batch size {batch_size * accumulation_steps})")
+    return batch_size, accumulation_steps
+
+
+class HydraTrainer:
+    def __init__(self, config, splits=None, tokenizer=None, datasets=None, encoder=None):
+        self.config = config
+        self.device = training_device()
+        if config.compile and config.pack:
+            raise ValueError("Packed batches vary in shape, compile needs unpacked batches")
+        if config.compile and config.loss_weighting == "gradnorm":
+            raise ValueError("GradNorm needs a double backward, which compiled graphs do not support")
+        # Pretrained encoder copied by new_model, loaded on first use unless given
+        self.encoder = encoder
+        self.log = log_metrics if config.wandb_project else no_log
+
+        if datasets is not None:
+            # (train, validation) datasets with DataCombined items, e.g. the folds of crossval.py
+            self.tokenizer = tokenizer
+            self.splits = splits
+            self.train_dataset, self.val_dataset = datasets
+        else:
+            self.tokenizer = training_tokenizer(config, tokenizer)
+            self.splits = splits if splits is not None else load_splits(config.dir, config.seed, config.dedup)
+            train_data = combine_tasks(self.splits.d_train, self.splits.s_train)
+            if config.pack:
+                self.train_dataset = PackedData(train_data, self.tokenizer, config.max_len, seed=config.seed)
+                print(f"Packed {self.train_dataset.num_tweets} training tweets into {len(self.train_dataset)} rows")
+            else:
+                self.train_dataset = DataCombined(train_data, tokenizer=self.tokenizer, max_len=config.max_len)
+            self.val_dataset = DataCombined(combine_tasks(self.splits.d_val, self.splits.s_val),
+                                            tokenizer=self.tokenizer, max_len=config.max_len)
+
+        # Shuffled (and sharded over ranks) by a sampler that can restart mid-epoch
+        self.train_sampler = distributed.ResumableSampler(self.train_dataset, shuffle=True, seed=config.seed)
+        # Starting an iterator draws a seed, from this generator instead of the global one
+        self.loader_generator = torch.Generator().manual_seed(config.seed)
+        self.train_loader = self.training_loader()
+        # Compiled graphs have static shapes, the last batch is padded to a full one
+        val_collate = padded_collate(config.valid_batch_size) if config.compile else None
+        self.val_loader = DataLoader(self.val_dataset, batch_size=config.valid_batch_size, shuffle=False,
+                                     collate_fn=val_collate, num_workers=0)
+        if distributed.is_distributed():
+            # Every validation tweet on exactly one rank, the metrics are summed over ranks
+            self.val_loader_epoch = DataLoader(self.val_dataset, sampler=distributed.ShardSampler(self.val_dataset),
+                                               batch_size=config.valid_batch_size, collate_fn=val_collate,
+                                               num_workers=0)
+        else:
+            self.val_loader_epoch = self.val_loader
+        self.d1_val_loader = None
+        # Loss weighting of the last train() call, its weights() are the final task weights
+        self.weighting = None
+
+    def training_loader(self):
+        config = self.config
+        packed = isinstance(self.train_dataset, PackedData)
+        if packed:
+            collate = collate_packed
+        else:
+            collate = padded_collate(config.train_batch_size) if config.compile else None
+        return DataLoader(self.train_dataset, sampler=self.train_sampler,
+                          batch_size=config.packed_batch_size if packed else config.train_batch_size,
+                          collate_fn=collate, num_workers=0, generator=self.loader_generator)
+
+    def new_model(self, tasks=(1, 2)):
+        # The pretrained encoder is read once, each model gets its own copy
+        if self.encoder is None:
+            self.encoder = RobertaModel.from_pretrained(self.config.encoder)
+        model = NetMultiTask(self.config.encoder, tasks=tasks, net=copy.deepcopy(self.encoder))
+        if self.config.gradient_checkpointing:
+            model.enable_gradient_checkpointing()
+        return model.to(self.device)
+
+    def fit_memory_budget(self, budget, effective_batch_size=None):
+        # Largest training batch (packed rows with pack) that fits `budget` bytes, with the accumulation
+        # steps that keep the effective batch per rank, the configured one by default
+        config = self.config
+        effective_batch_size = effective_batch_size or self.train_loader.batch_size * config.accumulation_steps
+        batch_size, accumulation_steps = memory_budget_batch(self.new_model(), self.train_loader, budget,
+                                                             effective_batch_size, self.device)
+        if isinstance(self.train_dataset, PackedData):
+            self.config = replace(config, packed_batch_size=batch_size, accumulation_steps=accumulation_steps)
+        else:
+            self.config = replace(config, train_batch_size=batch_size, accumulation_steps=accumulation_steps)
+        self.train_loader = self.training_loader()
+        return batch_size, accumulation_steps
+
+    def compile_model(self, model):
+        # Compiles the training step and the validation forward of the model in place, at their
+        # batch shapes, and reports the compile time and the steady-state speedup
+        config = self.config
+        compiled = CompiledForward(model, mode=config.compile_mode)
+        warm_up(compiled, lambda rows, _: probe_inputs(self.train_loader, rows, self.device),
+                [(config.train_batch_size, None)], train=True)
+        warm_up(compiled, lambda rows, _: probe_inputs(self.val_loader, rows, self.device),
+                [(config.valid_batch_size, None)])
+        measure_speedup(compiled, probe_inputs(self.train_loader, config.train_batch_size, self.device), train=True)
+        if distributed.is_main_process():
+            compiled.print_report()
+        return compiled
+
+    def train(self, model, lambda1=None, lambda2=None, checkpoint_dir=None, log=None, timer=NO_TIMER):
+        # Returns the global step, the loss weighting is kept in self.weighting
+        config = self.config
+        lambda1 = config.lambda1 if lambda1 is None else lambda1
+        lambda2 = config.lambda2 if lambda2 is None else lambda2
+        log = self.log if log is None else log
+        optimizer = torch.optim.Adam(params = model.parameters(), lr = config.learning_rate)
+        weighting = self.weighting = make_weighting(config.loss_weighting, model, lambda1, lambda2)
+
+        global_step, start_epoch, start_batch = restart_point(checkpoint_dir, config.resume, model, optimizer,
+                                                              loader_generator=self.loader_generator,
+                                                              loss_weighting=weighting)
+        checkpointer = None
+        if checkpoint_dir is not None:
+            checkpointer = TrainingCheckpointer(checkpoint_dir, config.checkpoint_steps, rank=distributed.get_rank(),
+                                                world_size=distributed.get_world_size(),
+                                                loader_generator=self.loader_generator)
+        if distributed.is_distributed():
+            # Before compiling, so that the graphs see the final requires_grad flags
+            model.freeze_pooler()
+        if config.compile:
+            self.compile_model(model)
+
+        if distributed.is_distributed():
+            ddp_model = DistributedDataParallel(model, device_ids=[distributed.get_local_rank()] if cuda.is_available() else None)
+        else:
+            ddp_model = model
+
+        for epoch in range(start_epoch, config.epochs):
+            epoch_start_batch = start_batch if epoch == start_epoch else 0
+            self.train_sampler.set_epoch(epoch, start_index=epoch_start_batch*self.train_loader.batch_size)
+            global_step = train_hydra(ddp_model, optimizer, epoch, self.train_loader, self.val_loader_epoch,
+                                      lambda1 = lambda1, lambda2 = lambda2, checkpointer = checkpointer,
+                                      global_step = global_step, start_batch = epoch_start_batch, log = log,
+                                      timer = timer, weighting = weighting,
+                                      accumulation_steps = config.accumulation_steps, log_steps = config.log_steps)
+            if checkpointer is not None and config.checkpoint_steps > 0:
+                checkpointer.save(global_step, epoch + 1, 0, model, optimizer, loss_weighting=weighting)
+        if checkpointer is not None:
+            checkpointer.close()
+        print('Finished training')
+        if distributed.is_main_process() and weighting.name != "fixed":
+            lambda1, lambda2 = weighting.weights()
+            print(f"Final {weighting.name} loss weights: lambda1 {lambda1}, lambda2 {lambda2}")
+        return global_step
+
+    def evaluate(self, model, keep_probs=False, timer=NO_TIMER, writers=(None, None)):
+        return valid_hydra(model, self.val_loader, keep_probs = keep_probs, timer = timer, writers = writers)
+
+    def evaluate_task1(self, model):
+        # Weighted F1 of the disaster head alone, the Bayesian Optimization objective
+        if self.d1_val_loader is None:
+            self.d1_val_loader = DataLoader(DisasterData(self.splits.d_val, self.tokenizer, self.config.max_len),
+                                            batch_size=self.config.valid_batch_size, shuffle=False, num_workers=0)
+        d1_metrics = valid_task(model, self.d1_val_loader, mode=1).metrics()
+        print(f"f1_Score: {d1_metrics['f1_weighted']}")
+        print(f"accuracy_Score: {d1_metrics['accuracy']}")
+        return d1_metrics["f1_weighted"]
+
+    def init_wandb(self, group=None, **extra):
+        config = self.config
+        if not config.wandb_project or not distributed.is_main_process():
+            return
+        wandb.init(
+                project=config.wandb_project,
+                group=group or config.wandb_group,
+                config={
+                    "epochs": config.epochs,
+                    "batch_size": config.train_batch_size,
+                    "world_size": distributed.get_world_size(),
+                    "lr": config.learning_rate,
+                    "optimizer": "Adam",
+                    "loss": "CrossEntropyLoss",
+                    "max_length": config.max_len,
+                    "lambda1": config.lambda1,
+                    "lambda2": config.lambda2,
+                    "loss_weighting": config.loss_weighting,
+                    "dedup": config.dedup,
+                    "pack": config.pack,
+                    "accumulation_steps": config.accumulation_steps,
+                    "gradient_checkpointing": config.gradient_checkpointing,
+                    "compile": config.compile,
+                    **extra,
+                    })
+
+    def finish_wandb(self, metrics=None):
+        if not self.config.wandb_project or not distributed.is_main_process():
+            return
+        if metrics:
+            wandb.log({**metrics})
+        wandb.finish()
+
+    def run(self, timer=NO_TIMER):
+        # Trains, evaluates and writes the model and predictions, returns the final metrics on rank 0
+        config = self.config
+        if config.wandb_project and distributed.is_main_process():
+            wandb_login(config.dir)
+        self.init_wandb()
+        net_hydra = self.new_model()
+        self.train(net_hydra, checkpoint_dir=f"{config.dir}/models/checkpoints/net_hydra", timer=timer)
+        timer.close()
+
+        # Final evaluation and outputs are done once, on rank 0
+        if not distributed.is_main_process():
+            return None
+
+        # Prediction files are written by background threads while the validation batches run
+        writers = (PredictionWriter(f"{config.dir}/predicts/d1_predict.csv"),
+                   PredictionWriter(f"{config.dir}/predicts/d2_predict.csv"))
+        d1_predict, d2_predict = self.evaluate(net_hydra, keep_probs = config.keep_probs, timer = timer,
+                                               writers = writers)
+        timer.print_summary()
+        d1_metrics = d1_predict.metrics()
+        d2_metrics = d2_predict.metrics()
+        fin_metrics = {"f1_score": d1_metrics["f1_weighted"],
+                       "d2_f1": d2_metrics["f1_weighted"],
+                       "d1_fin_accuracy": d1_metrics["accuracy"],
+                       "d2_fin_accuracy": d2_metrics["accuracy"]}
+        self.finish_wandb(fin_metrics)
+        try:
+            save_checkpoint(net_hydra, f"{config.dir}/models/net_hydra", tokenizer=self.tokenizer,
+                            max_len=config.max_len, label_maps=LABEL_MAPS)
+        except Exception as e:
+            print(e)
+
+        try:
+            for writer in writers:
+                writer.close()
+        except Exception as e:
+            print(e)
+
+        try:
+            print(classification_report(d1_predict.targets, d1_predict.predicts))
+            print(classification_report(d2_predict.targets, d2_predict.predicts))
+
+            print(f"D1 F1: {d1_metrics['f1_weighted']}\n"
+                f"D2 F2: {d2_metrics['f1_weighted']}\n"
+                f"D1 Accuracy: {d1_metrics['accuracy']}\n"
+                f"D2 Accuracy: {d2_metrics['accuracy']}\n")
+        except Exception as e:
+            print(e)
+        else:
+            print("Success")
+        return fin_metrics
+
+
+class SingleTaskTrainer:
+    def __init__(self, config, splits=None, tokenizer=None):
+        self.config = config
+        self.mode = config.task
+        self.device = training_device()
+        self.tokenizer = training_tokenizer(config, tokenizer)
+        self.splits = splits if splits is not None else load_splits(config.dir, config.seed, config.dedup)
+        self.encoder = None
+        self.log = log_metrics if config.wandb_project else no_log
+
+        if self.mode == 1:
+            self.train_dataset = DisasterData(self.splits.d_train, self.tokenizer, config.max_len)
+            self.val_dataset = DisasterData(self.splits.d_val, self.tokenizer, config.max_len)
+        else:
+            self.train_dataset = SentimentData(self.splits.s_train, self.tokenizer, config.max_len)
+            self.val_dataset = SentimentData(self.splits.s_val, self.tokenizer, config.max_len)
+
+        # Shuffled by a sampler that can restart mid-epoch, iterators draw from their own generator
+        self.train_sampler = distributed.ResumableSampler(self.train_dataset, shuffle=True, seed=config.seed)
+        self.loader_generator = torch.Generator().manual_seed(config.seed)
+        self.train_loader = self.training_loader()
+        self.val_loader = DataLoader(self.val_dataset, batch_size=config.valid_batch_size, shuffle=False,
+                                     num_workers=0)
+
+    def training_loader(self):
+        return DataLoader(self.train_dataset, sampler=self.train_sampler, batch_size=self.config.train_batch_size,
+                          num_workers=0, generator=self.loader_generator)
+
+    def new_model(self):
+        # Only the head of the task is built (and saved)
+        if self.encoder is None:
+            self.encoder = RobertaModel.from_pretrained(self.config.encoder)
+        model = NetMultiTask(self.config.encoder, tasks=(self.mode,), net=copy.deepcopy(self.encoder))
+        if self.config.gradient_checkpointing:
+            model.enable_gradient_checkpointing()
+        return model.to(self.device)
+
+    def fit_memory_budget(self, budget, effective_batch_size=None):
+        # Like HydraTrainer.fit_memory_budget
+        config = self.config
+        effective_batch_size = effective_batch_size or config.train_batch_size * config.accumulation_steps
+        batch_size, accumulation_steps = memory_budget_batch(self.new_model(), self.train_loader, budget,
+                                                             effective_batch_size, self.device)
+        self.config = replace(config, train_batch_size=batch_size, accumulation_steps=accumulation_steps)
+        self.train_loader = self.training_loader()
+        return batch_size, accumulation_steps
+
+    def train(self, model, checkpoint_dir=None, log=None, timer=NO_TIMER):
+        config = self.config
+        log = self.log if log is None else log
+        optimizer = torch.optim.Adam(params = model.parameters(), lr = config.learning_rate)
+
+        global_step, start_epoch, start_batch = restart_point(checkpoint_dir, config.resume, model, optimizer,
+                                                              loader_generator=self.loader_generator)
+        checkpointer = None
+        if checkpoint_dir is not None:
+            checkpointer = TrainingCheckpointer(checkpoint_dir, config.checkpoint_steps,
+                                                loader_generator=self.loader_generator)
+
+        for epoch in range(start_epoch, config.epochs):
+            epoch_start_batch = start_batch if epoch == start_epoch else 0
+            self.train_sampler.set_epoch(epoch, start_index=epoch_start_batch*config.train_batch_size)
+            global_step = train_task(model, optimizer, self.train_loader, self.val_loader, self.mode, epoch=epoch,
+                                     checkpointer=checkpointer, global_step=global_step,
+                                     start_batch=epoch_start_batch, log=log, timer=timer,
+                                     accumulation_steps=config.accumulation_steps)
+            if checkpointer is not None and config.checkpoint_steps > 0:
+                checkpointer.save(global_step, epoch + 1, 0, model, optimizer)
+            print('Finished training')
+        if checkpointer is not None:
+            checkpointer.close()
+        return global_step
+
+    def evaluate(self, model, keep_probs=False, timer=NO_TIMER, writer=None):
+        return valid_task(model, self.val_loader, self.mode, keep_probs = keep_probs, timer = timer, writer = writer)
+
+    def run(self, timer=NO_TIMER):
+        # Trains, evaluates and writes the model and predictions, returns (f1, accuracy)
+        config = self.config
+        mode = self.mode
+        if config.wandb_project:
+            wandb_login(config.dir)
+            wandb.init(
+                    project=config.wandb_project,
+                    group=f'task{mode}',
+                    config={
+                        "epochs": config.epochs,
+                        "batch_size": config.train_batch_size,
+                        "lr": config.learning_rate,
+                        "optimizer": "Adam",
+                        "loss": "CrossEntropyLoss",
+                        "max_length": config.max_len,
+                        "dedup": config.dedup,
+                        "accumulation_steps": config.accumulation_steps,
+                        "gradient_checkpointing": config.gradient_checkpointing
+                        })
+        # The model is released when run returns, before the next task starts
+        net = self.new_model()
+        self.train(net, checkpoint_dir=f"{config.dir}/models/checkpoints/net{mode}", timer=timer)
+        timer.close()
+
+        writer = PredictionWriter(f"{config.dir}/predicts/predicts_d{mode}.csv")
+        predicts = self.evaluate(net, keep_probs = config.keep_probs, timer = timer, writer = writer)
+        timer.print_summary(f"Task {mode} phase timings")
+        val_metrics = predicts.metrics()
+        f1 = val_metrics["f1_weighted"]
+        accuracy = val_metrics["accuracy"]
+
+        if config.wandb_project:
+            wandb.log({"val_f1_score": f1, "val_fin_accuracy": accuracy})
+            wandb.finish()
+        print(classification_report(predicts.targets, predicts.predicts))
+
+        writer.close()
+        save_checkpoint(net, f"{config.dir}/models/net{mode}", tokenizer=self.tokenizer, max_len=config.max_len,
+                        label_maps=LABEL_MAPS)
+        return f1, accuracy
@@ -0,0 +1,180 @@
+from dataclasses import dataclass
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+from sklearn.model_selection import train_test_split
+from dedup import dedup_task
+
+"""
+Tweets of the two tasks and their PyTorch datasets, shared by the training
+scripts. load_splits reads the data directory and returns the stratified
+train/validation splits every script uses, with repeated training tweets
+collapsed into weighted rows (see dedup.py).
+
+DataCombined holds the rows of both tasks (the label of the other task is
+NaN) for the multi-task model, DisasterData and SentimentData hold one task
+each. Rows may carry a count weight from dedup.py.
+
+"""
+
+# Sentiment tweet without text
+BAD_SENTIMENT_IDS = ["fdb77c3752"]
+
+
+def map_sentiment(x):
+    if x == "negative":
+        return 1
+    elif x =="neutral":
+        return 0
+    elif x =="positive":
+        return 2
+    else:
+        return None
+
+@dataclass
+class TweetSplits:
+    # (text, target) frames of each task, training splits with a weight column
+    d_train: pd.DataFrame
+    d_val: pd.DataFrame
+    s_train: pd.DataFrame
+    s_val: pd.DataFrame
+
+def read_disaster(dir):
+    d_train = pd.read_csv(f"{dir}/train.csv")
+    return d_train[['text','target']].copy()
+
+def read_sentiment(dir):
+    s_train = pd.read_csv(f"{dir}/tweets.csv")
+    s_train = s_train[~s_train["textID"].isin(BAD_SENTIMENT_IDS)]
+    return pd.DataFrame({"text": s_train.text, "target": s_train.sentiment.map(map_sentiment)})
+
+def split_task(df, seed=2023, test_size=0.2):
+    train, val = train_test_split(df, test_size=test_size, stratify=df['target'], random_state=seed)
+    return train.reset_index(drop=True), val.reset_index(drop=True)
+
+def load_splits(dir, seed=2023, dedup=True):
+    d_train, d_val = split_task(read_disaster(dir), seed)
+    s_train, s_val = split_task(read_sentiment(dir), seed)
+    # Collapse repeated tweets of the training splits into weighted rows
+    d_train = dedup_task("Disaster train", d_train, enabled=dedup)
+    s_train = dedup_task("Sentiment train", s_train, enabled=dedup)
+    return TweetSplits(d_train, d_val, s_train, s_val)
+
+def combine_tasks(disaster, sentiment):
+    # Rows of both tasks for DataCombined, the label of the other task is NaN
+    return pd.concat([disaster, sentiment.rename(columns={"target": "sentiment"})], ignore_index=True)
+
+class DataCombined(Dataset):
+    def __init__(self, dataframe, tokenizer, max_len):
+        self.tokenizer = tokenizer
+        self.data = dataframe
+        self.text = dataframe.text
+        self.target = self.data.target
+        self.sentiment = self.data.sentiment
+        self.weight = self.data.weight if "weight" in self.data else pd.Series(1.0, index=self.data.index)
+        self.max_len = max_len
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, index):
+        text = str(self.text[index])
+        text = " ".join(text.split())
+
+        inputs = self.tokenizer(
+            text,
+            None,
+            add_special_tokens=True,
+            max_length=self.max_len,
+            truncation=True,
+            padding = 'max_length',
+            return_token_type_ids=True
+        )
+        ids = inputs['input_ids']
+        mask = inputs['attention_mask']
+        token_type_ids = inputs["token_type_ids"]
+
+
+        return {
+            'ids': torch.tensor(ids, dtype=torch.long),
+            'mask': torch.tensor(mask, dtype=torch.long),
+            'token_type_ids': torch.tensor(token_type_ids, dtype=torch.long),
+            'labels': (self.target[index], self.sentiment[index]),
+            'weight': torch.tensor(self.weight[index], dtype=torch.float)
+        }
+
+class DisasterData(Dataset):
+    def __init__(self, dataframe, tokenizer, max_len):
+        self.tokenizer = tokenizer
+        self.data = dataframe
+        self.text = dataframe.text
+        self.targets = self.data.target
+        self.weight = self.data.weight if "weight" in self.data else pd.Series(1.0, index=self.data.index)
+        self.max_len = max_len
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, index):
+        text = str(self.text[index])
+        text = " ".join(text.split())
+
+        inputs = self.tokenizer(
+            text,
+            None,
+            add_special_tokens=True,
+            max_length=self.max_len,
+            truncation=True,
+            padding = 'max_length',
+            return_token_type_ids=False
+        )
+        ids = inputs['input_ids']
+        mask = inputs['attention_mask']
+        #token_type_ids = inputs["token_type_ids"]
+
+
+        return {
+            'ids': torch.tensor(ids, dtype=torch.long),
+            'mask': torch.tensor(mask, dtype=torch.long),
+            #'token_type_ids': torch.tensor(token_type_ids, dtype=torch.long),
+            'targets': torch.tensor(self.targets[index], dtype=torch.long),
+            'weight': torch.tensor(self.weight[index], dtype=torch.float)
+        }
+
+class SentimentData(Dataset):
+    def __init__(self, dataframe, tokenizer, max_len):
+        self.tokenizer = tokenizer
+        self.data = dataframe
+        self.text = dataframe.text
+        self.targets = self.data.target
+        self.weight = self.data.weight if "weight" in self.data else pd.Series(1.0, index=self.data.index)
+        self.max_len = max_len
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, index):
+        text = str(self.text[index])
+        text = " ".join(text.split())
+
+        inputs = self.tokenizer(
+            text,
+            None,
+            add_special_tokens=True,
+            max_length=self.max_len,
+            truncation=True,
+            padding = 'max_length',
+            return_token_type_ids=True
+        )
+        ids = inputs['input_ids']
+        mask = inputs['attention_mask']
+        #token_type_ids = inputs["token_type_ids"]
+
+
+        return {
+            'ids': torch.tensor(ids, dtype=torch.long),
+            'mask': torch.tensor(mask, dtype=torch.long),
+            #'token_type_ids': torch.tensor(token_type_ids, dtype=torch.long),
+            'targets': torch.tensor(self.targets[index], dtype=torch.long),
+            'weight': torch.tensor(self.weight[index], dtype=torch.float)
+        }
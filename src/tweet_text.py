@@ -0,0 +1,10 @@
+"""
+Tweet normalisation shared by the predictors, the prediction cache and the
+deduplication of training data. Kept free of heavy imports so that the data
+preparation and argument parsing paths do not load torch.
+
+"""
+
+
+def normalise_text(text):
+    return " ".join(str(text).split())